@@ -0,0 +1,36 @@
+"""Materialize product stock from the movement ledger
+
+Revision ID: 3c9e1f7a2b64
+Revises: b5085c35fa71
+Create Date: 2026-10-16 09:12:40.118302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e1f7a2b64'
+down_revision = 'b5085c35fa71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Backfill from the ledger: IN adds, OUT subtracts, ADJ is signed
+    op.execute("""
+        UPDATE products SET stock = COALESCE((
+            SELECT SUM(CASE WHEN m.movement_type = 'IN' THEN m.quantity
+                            WHEN m.movement_type = 'OUT' THEN -m.quantity
+                            ELSE m.quantity END)
+            FROM inventory_movements m WHERE m.product_id = products.id), 0)
+    """)
+    with op.batch_alter_table('products') as batch:
+        batch.alter_column('stock', existing_type=sa.Integer(), nullable=False, server_default='0')
+    op.create_index('ix_products_stock', 'products', ['stock'])
+
+
+def downgrade():
+    op.drop_index('ix_products_stock', table_name='products')
+    with op.batch_alter_table('products') as batch:
+        batch.alter_column('stock', existing_type=sa.Integer(), nullable=True, server_default=None)
@@ -0,0 +1,50 @@
+"""Stock snapshots for point-in-time balances; warehouse on movements
+
+Revision ID: 5a2d8e61b9c3
+Revises: f41c7a9d2e60
+Create Date: 2026-10-16 20:31:52.640217
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a2d8e61b9c3'
+down_revision = 'f41c7a9d2e60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'warehouse_id' not in {c['name'] for c in insp.get_columns('inventory_movements')}:
+        with op.batch_alter_table('inventory_movements') as batch:
+            batch.add_column(sa.Column('warehouse_id', sa.Integer(), nullable=True))
+            batch.create_foreign_key('fk_inventory_movements_warehouse_id', 'warehouses', ['warehouse_id'], ['id'])
+    # alembic/env.py imports main, whose create_all() may already have created the tables
+    if not insp.has_table('stock_snapshots'):
+        op.create_table('stock_snapshots',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('taken_at', sa.DateTime(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+        )
+        op.create_index('ix_stock_snapshots_taken_at', 'stock_snapshots', ['taken_at'], unique=True)
+    if not insp.has_table('stock_snapshot_lines'):
+        op.create_table('stock_snapshot_lines',
+            sa.Column('snapshot_id', sa.Integer(), sa.ForeignKey('stock_snapshots.id', ondelete='CASCADE'),
+                      primary_key=True),
+            sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id'), primary_key=True),
+            sa.Column('warehouse_id', sa.Integer(), primary_key=True),
+            sa.Column('quantity', sa.Integer(), nullable=False),
+        )
+
+
+def downgrade():
+    op.drop_table('stock_snapshot_lines')
+    op.drop_index('ix_stock_snapshots_taken_at', table_name='stock_snapshots')
+    op.drop_table('stock_snapshots')
+    with op.batch_alter_table('inventory_movements') as batch:
+        batch.drop_constraint('fk_inventory_movements_warehouse_id', type_='foreignkey')
+        batch.drop_column('warehouse_id')
@@ -0,0 +1,101 @@
+"""Stock reservations for pending sales orders; reserved counter on warehouse_stocks
+
+Revision ID: 7c4a1e9f3b52
+Revises: d62a0f9c7e15
+Create Date: 2026-10-16 23:12:44.208133
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c4a1e9f3b52'
+down_revision = 'd62a0f9c7e15'
+branch_labels = None
+depends_on = None
+
+log = logging.getLogger('alembic.runtime.migration')
+
+
+def upgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    if 'reserved' not in {c['name'] for c in insp.get_columns('warehouse_stocks')}:
+        with op.batch_alter_table('warehouse_stocks') as batch:
+            batch.add_column(sa.Column('reserved', sa.Integer(), nullable=False, server_default='0'))
+    # alembic/env.py imports main, whose create_all() may already have created the table
+    if not insp.has_table('stock_reservations'):
+        op.create_table('stock_reservations',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('order_id', sa.Integer(), sa.ForeignKey('orders.id'), nullable=False),
+            sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id'), nullable=False),
+            sa.Column('warehouse_id', sa.Integer(), sa.ForeignKey('warehouses.id'), nullable=False),
+            sa.Column('quantity', sa.Integer(), nullable=False),
+            sa.Column('status', sa.String(), nullable=False),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+            sa.Column('closed_at', sa.DateTime(), nullable=True),
+        )
+        op.create_index('ix_stock_reservations_order_status', 'stock_reservations', ['order_id', 'status'])
+    # Pending sales orders created before reservations existed reserve from the default warehouse (id 1),
+    # oldest first and only as far as its unreserved stock goes: each line gets what is left after the
+    # earlier orders (running sum per product), so reserved never exceeds quantity
+    op.execute("""
+        INSERT INTO stock_reservations (order_id, product_id, warehouse_id, quantity, status, created_at)
+        SELECT order_id, product_id, 1,
+               CASE WHEN free - earlier >= wanted THEN wanted ELSE free - earlier END, 'ACTIVE', created_at
+        FROM (
+            SELECT d.order_id, d.product_id, d.wanted, d.created_at,
+                   COALESCE(s.quantity, 0) - COALESCE(s.reserved, 0) AS free,
+                   SUM(d.wanted) OVER (PARTITION BY d.product_id ORDER BY d.created_at, d.order_id
+                                       ROWS UNBOUNDED PRECEDING) - d.wanted AS earlier
+            FROM (
+                SELECT o.id AS order_id, i.product_id, SUM(i.quantity) AS wanted, o.created_at
+                FROM orders o JOIN order_items i ON i.order_id = o.id
+                WHERE o.status IN ('PENDING', 'IN_PROGRESS') AND COALESCE(o.type, '') <> 'PURCHASE'
+                  AND i.product_id IS NOT NULL AND i.quantity > 0
+                  AND EXISTS (SELECT 1 FROM warehouses w WHERE w.id = 1)
+                  AND NOT EXISTS (SELECT 1 FROM stock_reservations r WHERE r.order_id = o.id)
+                GROUP BY o.id, i.product_id, o.created_at
+            ) d
+            LEFT JOIN warehouse_stocks s ON s.product_id = d.product_id AND s.warehouse_id = 1
+        ) a
+        WHERE free - earlier > 0
+    """)
+    # What the stock didn't cover stays unreserved; completing those orders needs free stock again
+    uncovered = bind.execute(sa.text("""
+        SELECT o.order_code, i.product_id, SUM(i.quantity) - COALESCE((
+                   SELECT SUM(r.quantity) FROM stock_reservations r
+                   WHERE r.order_id = o.id AND r.product_id = i.product_id AND r.status = 'ACTIVE'), 0)
+        FROM orders o JOIN order_items i ON i.order_id = o.id
+        WHERE o.status IN ('PENDING', 'IN_PROGRESS') AND COALESCE(o.type, '') <> 'PURCHASE'
+          AND i.product_id IS NOT NULL AND i.quantity > 0
+        GROUP BY o.id, o.order_code, i.product_id
+        HAVING SUM(i.quantity) > COALESCE((
+                   SELECT SUM(r.quantity) FROM stock_reservations r
+                   WHERE r.order_id = o.id AND r.product_id = i.product_id AND r.status = 'ACTIVE'), 0)
+        ORDER BY o.order_code, i.product_id
+    """)).all()
+    for code, product_id, short in uncovered:
+        log.warning("Order %s: %s unit(s) of product %s not reserved (not enough stock)", code, short, product_id)
+    op.execute("""
+        INSERT INTO warehouse_stocks (product_id, warehouse_id, quantity, reserved)
+        SELECT DISTINCT r.product_id, r.warehouse_id, 0, 0 FROM stock_reservations r
+        WHERE r.status = 'ACTIVE' AND NOT EXISTS (
+            SELECT 1 FROM warehouse_stocks s WHERE s.product_id = r.product_id AND s.warehouse_id = r.warehouse_id)
+    """)
+    op.execute("""
+        UPDATE warehouse_stocks SET reserved = COALESCE((
+            SELECT SUM(r.quantity) FROM stock_reservations r
+            WHERE r.status = 'ACTIVE' AND r.product_id = warehouse_stocks.product_id
+              AND r.warehouse_id = warehouse_stocks.warehouse_id), 0)
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_stock_reservations_order_status', table_name='stock_reservations')
+    op.drop_table('stock_reservations')
+    with op.batch_alter_table('warehouse_stocks') as batch:
+        batch.drop_column('reserved')
@@ -0,0 +1,33 @@
+"""Composite indexes for keyset pagination
+
+Revision ID: 8d41a6c0e2f9
+Revises: 3c9e1f7a2b64
+Create Date: 2026-10-16 10:05:11.402957
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d41a6c0e2f9'
+down_revision = '3c9e1f7a2b64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_inventory_movements_moved_at_id', 'inventory_movements', ['moved_at', 'id'])
+    op.create_index('ix_inventory_movements_product_moved_at_id', 'inventory_movements', ['product_id', 'moved_at', 'id'])
+    # Superseded by (moved_at, id); only present on databases created with create_all()
+    op.execute('DROP INDEX IF EXISTS ix_inventory_movements_moved_at')
+    op.create_index('ix_sales_created_at_id', 'sales', ['created_at', 'id'])
+    op.create_index('ix_sale_items_sale_id', 'sale_items', ['sale_id'])
+
+
+def downgrade():
+    op.drop_index('ix_sale_items_sale_id', table_name='sale_items')
+    op.drop_index('ix_sales_created_at_id', table_name='sales')
+    op.create_index('ix_inventory_movements_moved_at', 'inventory_movements', ['moved_at'])
+    op.drop_index('ix_inventory_movements_product_moved_at_id', table_name='inventory_movements')
+    op.drop_index('ix_inventory_movements_moved_at_id', table_name='inventory_movements')
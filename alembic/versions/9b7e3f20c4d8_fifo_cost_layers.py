@@ -0,0 +1,158 @@
+"""FIFO cost layers, movement costs and sale line movement link
+
+Revision ID: 9b7e3f20c4d8
+Revises: 5a2d8e61b9c3
+Create Date: 2026-10-16 21:48:03.517926
+
+"""
+import bisect
+import itertools
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b7e3f20c4d8'
+down_revision = '5a2d8e61b9c3'
+branch_labels = None
+depends_on = None
+
+_movements = sa.table('inventory_movements', sa.column('id'), sa.column('product_id'), sa.column('movement_type'),
+                      sa.column('movement_reason'), sa.column('quantity'), sa.column('unit_cost'),
+                      sa.column('moved_at', sa.DateTime()))
+_layers = sa.table('cost_layers', sa.column('product_id'), sa.column('movement_id'),
+                   sa.column('received_at', sa.DateTime()), sa.column('unit_cost'), sa.column('quantity'),
+                   sa.column('remaining'))
+_costs = sa.table('movement_costs', sa.column('movement_id'), sa.column('product_id'), sa.column('quantity'),
+                  sa.column('cost'), sa.column('estimated_quantity'))
+_FLUSH_ROWS = 20000
+
+
+def upgrade():
+    bind = op.get_bind()
+    insp = sa.inspect(bind)
+    # alembic/env.py imports main, whose create_all() may already have created the tables
+    if not insp.has_table('cost_layers'):
+        op.create_table('cost_layers',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id'), nullable=False),
+            sa.Column('movement_id', sa.Integer(), sa.ForeignKey('inventory_movements.id'), nullable=True),
+            sa.Column('received_at', sa.DateTime(), nullable=False),
+            sa.Column('unit_cost', sa.Float(), nullable=False),
+            sa.Column('quantity', sa.Integer(), nullable=False),
+            sa.Column('remaining', sa.Integer(), nullable=False),
+        )
+        op.create_index('ix_cost_layers_product_received_id', 'cost_layers', ['product_id', 'received_at', 'id'])
+    if not insp.has_table('movement_costs'):
+        op.create_table('movement_costs',
+            sa.Column('movement_id', sa.Integer(), sa.ForeignKey('inventory_movements.id'), primary_key=True),
+            sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id'), nullable=False),
+            sa.Column('quantity', sa.Integer(), nullable=False),
+            sa.Column('cost', sa.Float(), nullable=False),
+            sa.Column('estimated_quantity', sa.Integer(), nullable=False),
+        )
+        op.create_index('ix_movement_costs_product_id', 'movement_costs', ['product_id'])
+    if 'movement_id' not in {c['name'] for c in insp.get_columns('sale_items')}:
+        with op.batch_alter_table('sale_items') as batch:
+            batch.add_column(sa.Column('movement_id', sa.Integer(), nullable=True))
+            batch.create_foreign_key('fk_sale_items_movement_id', 'inventory_movements', ['movement_id'], ['id'])
+    # Link existing sale lines to their OUT movement (note "SALE #<id>[ · ...]")
+    op.execute("""
+        UPDATE sale_items SET movement_id = (
+            SELECT MIN(m.id) FROM inventory_movements m
+            WHERE m.movement_reason = 'SALE' AND m.product_id = sale_items.product_id
+              AND (m.note = 'SALE #' || sale_items.sale_id OR m.note LIKE 'SALE #' || sale_items.sale_id || ' %'))
+        WHERE movement_id IS NULL
+    """)
+    # Fill layers and movement costs from the ledger now: empty tables would leave existing stock out of
+    # the valuation and make the next issues draw estimated layers. Same FIFO rules as `stock_balance.py
+    # costs`, frozen here so later changes to main can't alter what this revision writes.
+    _fill_cost_layers(bind)
+
+
+def _transfer_pairs(moves):
+    """Ids of transfer OUT/IN pairs (consecutive, same quantity): the goods keep their layer."""
+    ids = set()
+    for a, b in zip(moves, moves[1:]):
+        if (a.movement_reason == b.movement_reason == 'transfer' and a.id not in ids
+                and a.movement_type == 'OUT' and b.movement_type == 'IN' and a.quantity == b.quantity):
+            ids.update((a.id, b.id))
+    return ids
+
+
+def _replay(pid, moves, fallback, layers_out, costs_out):
+    """FIFO over one product's movements (id order); layers are [received_at, unit_cost, remaining, movement_id, quantity]."""
+    layers = []
+    neutral = _transfer_pairs(moves)
+    for m in moves:
+        if m.id in neutral:
+            continue
+        delta = -m.quantity if m.movement_type == 'OUT' else m.quantity
+        if delta > 0:
+            for layer in layers:
+                if delta == 0:
+                    break
+                if layer[2] < 0:
+                    take = min(delta, -layer[2])
+                    layer[2] += take
+                    delta -= take
+            if delta > 0:
+                cost = m.unit_cost if m.unit_cost is not None else fallback
+                bisect.insort(layers, [m.moved_at, float(cost or 0), delta, m.id, delta], key=lambda l: l[0])
+        elif delta < 0:
+            need, total = -delta, 0.0
+            for layer in layers:
+                if need == 0:
+                    break
+                if layer[2] > 0:
+                    take = min(need, layer[2])
+                    layer[2] -= take
+                    need -= take
+                    total += take * layer[1]
+            if need:
+                cost = float(fallback or 0)
+                total += need * cost
+                bisect.insort(layers, [m.moved_at, cost, -need, m.id, -need], key=lambda l: l[0])
+            costs_out.append({'movement_id': m.id, 'product_id': pid, 'quantity': -delta, 'cost': total,
+                              'estimated_quantity': need})
+    layers_out += [{'product_id': pid, 'movement_id': movement_id, 'received_at': received_at,
+                    'unit_cost': unit_cost, 'quantity': quantity, 'remaining': remaining}
+                   for received_at, unit_cost, remaining, movement_id, quantity in layers if remaining]
+
+
+def _fill_cost_layers(bind):
+    bind.execute(_costs.delete())
+    bind.execute(_layers.delete())
+    fallback = dict(bind.execute(sa.text('SELECT id, unit_cost FROM products')).all())
+    stream = bind.execute(
+        sa.select(_movements.c.id, _movements.c.product_id, _movements.c.movement_type,
+                  _movements.c.movement_reason, _movements.c.quantity, _movements.c.unit_cost,
+                  _movements.c.moved_at).order_by(_movements.c.product_id, _movements.c.id)
+        .execution_options(yield_per=_FLUSH_ROWS))
+    layers, costs, pending = [], [], 0
+    for pid, group in itertools.groupby(stream, key=lambda r: r.product_id):
+        moves = list(group)
+        _replay(pid, moves, fallback.get(pid), layers, costs)
+        pending += len(moves)
+        if pending >= _FLUSH_ROWS:
+            _flush(bind, layers, costs)
+            layers, costs, pending = [], [], 0
+    _flush(bind, layers, costs)
+
+
+def _flush(bind, layers, costs):
+    if layers:
+        bind.execute(_layers.insert(), layers)
+    if costs:
+        bind.execute(_costs.insert(), costs)
+
+
+def downgrade():
+    with op.batch_alter_table('sale_items') as batch:
+        batch.drop_constraint('fk_sale_items_movement_id', type_='foreignkey')
+        batch.drop_column('movement_id')
+    op.drop_index('ix_movement_costs_product_id', table_name='movement_costs')
+    op.drop_table('movement_costs')
+    op.drop_index('ix_cost_layers_product_received_id', table_name='cost_layers')
+    op.drop_table('cost_layers')
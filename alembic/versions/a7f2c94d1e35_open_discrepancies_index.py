@@ -0,0 +1,69 @@
+"""Open discrepancies index
+
+Revision ID: a7f2c94d1e35
+Revises: 8d41a6c0e2f9
+Create Date: 2026-10-16 11:20:37.551904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7f2c94d1e35'
+down_revision = '8d41a6c0e2f9'
+branch_labels = None
+depends_on = None
+
+# (type, condition, detail) — same rules as main._detect_discrepancies
+RULES = [
+    ("UNIT_COST_MISSING", "(p.unit_cost IS NULL OR p.unit_cost = 0) AND p.stock > 0",
+     "'Stock > 0 pero unit_cost nulo o 0'"),
+    ("BELOW_MIN_STOCK", "p.min_stock IS NOT NULL AND p.stock < p.min_stock",
+     "'Stock ' || p.stock || ' < Min ' || p.min_stock"),
+    ("ABOVE_MAX_STOCK", "p.max_stock IS NOT NULL AND p.stock > p.max_stock",
+     "'Stock ' || p.stock || ' > Max ' || p.max_stock"),
+]
+
+
+def upgrade():
+    # alembic/env.py imports main, whose create_all() may already have created the table
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table('open_discrepancies'):
+        op.create_table('open_discrepancies',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id'), nullable=False),
+            sa.Column('discrepancy_type', sa.String(), nullable=False),
+            sa.Column('detail', sa.Text(), nullable=False),
+            sa.Column('stock_at', sa.Integer(), nullable=False),
+            sa.Column('unit_cost_at', sa.Float(), nullable=True),
+            sa.Column('status', sa.String(), nullable=False),
+            sa.Column('detected_at', sa.DateTime(), nullable=True),
+            sa.Column('resolution_id', sa.Integer(), sa.ForeignKey('discrepancy_resolutions.id'), nullable=True),
+            sa.UniqueConstraint('product_id', 'discrepancy_type', name='_product_discrepancy_uc'),
+        )
+        op.create_index('ix_open_discrepancies_status_type', 'open_discrepancies',
+                        ['status', 'discrepancy_type', 'product_id'])
+    if bind.execute(sa.text("SELECT COUNT(*) FROM open_discrepancies")).scalar():
+        return
+
+    # Populate from current balances; keep resolutions recorded at the same stock/unit_cost
+    for dtype, condition, detail in RULES:
+        op.execute(f"""
+            INSERT INTO open_discrepancies (product_id, discrepancy_type, detail, stock_at, unit_cost_at, status,
+                                            detected_at, resolution_id)
+            SELECT p.id, '{dtype}', {detail}, p.stock, p.unit_cost,
+                   CASE WHEN r.id IS NULL THEN 'OPEN' ELSE 'RESOLVED' END, CURRENT_TIMESTAMP, r.id
+            FROM products p
+            LEFT JOIN (
+                SELECT MAX(id) AS id, product_id, stock_at, unit_cost_at FROM discrepancy_resolutions
+                WHERE discrepancy_type = '{dtype}' GROUP BY product_id, stock_at, unit_cost_at
+            ) r ON r.product_id = p.id AND r.stock_at = p.stock
+               AND (r.unit_cost_at = p.unit_cost OR (r.unit_cost_at IS NULL AND p.unit_cost IS NULL))
+            WHERE {condition}
+        """)
+
+
+def downgrade():
+    op.drop_index('ix_open_discrepancies_status_type', table_name='open_discrepancies')
+    op.drop_table('open_discrepancies')
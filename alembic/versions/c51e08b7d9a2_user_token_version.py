@@ -0,0 +1,26 @@
+"""Add users.token_version
+
+Revision ID: c51e08b7d9a2
+Revises: a7f2c94d1e35
+Create Date: 2026-10-16 12:02:48.730115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c51e08b7d9a2'
+down_revision = 'a7f2c94d1e35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users') as batch:
+        batch.add_column(sa.Column('token_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch:
+        batch.drop_column('token_version')
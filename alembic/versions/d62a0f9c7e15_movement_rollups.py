@@ -0,0 +1,47 @@
+"""Daily movement rollups
+
+Revision ID: d62a0f9c7e15
+Revises: 9b7e3f20c4d8
+Create Date: 2026-10-16 22:40:27.081455
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd62a0f9c7e15'
+down_revision = '9b7e3f20c4d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # alembic/env.py imports main, whose create_all() may already have created the table
+    if not sa.inspect(op.get_bind()).has_table('movement_rollups'):
+        op.create_table('movement_rollups',
+            sa.Column('day', sa.Date(), primary_key=True),
+            sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id'), primary_key=True),
+            sa.Column('movement_type', sa.String(), primary_key=True),
+            sa.Column('movement_reason', sa.String(), primary_key=True),
+            sa.Column('quantity', sa.Integer(), nullable=False),
+            sa.Column('value', sa.Float(), nullable=False),
+            sa.Column('cost', sa.Float(), nullable=False),
+            sa.Column('movements', sa.Integer(), nullable=False),
+        )
+        op.create_index('ix_movement_rollups_product_day', 'movement_rollups', ['product_id', 'day'])
+    # Backfill from the ledger; FIFO costs come from movement_costs, filled by the previous revision
+    op.execute("DELETE FROM movement_rollups")
+    op.execute("""
+        INSERT INTO movement_rollups (day, product_id, movement_type, movement_reason, quantity, value, cost, movements)
+        SELECT date(m.moved_at), m.product_id, m.movement_type, COALESCE(m.movement_reason, ''), SUM(m.quantity),
+               SUM(m.quantity * COALESCE(m.unit_cost, 0)), SUM(COALESCE(c.cost, 0)), COUNT(*)
+        FROM inventory_movements m LEFT JOIN movement_costs c ON c.movement_id = m.id
+        WHERE m.moved_at IS NOT NULL
+        GROUP BY date(m.moved_at), m.product_id, m.movement_type, COALESCE(m.movement_reason, '')
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_movement_rollups_product_day', table_name='movement_rollups')
+    op.drop_table('movement_rollups')
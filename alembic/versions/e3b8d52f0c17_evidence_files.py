@@ -0,0 +1,35 @@
+"""Content-addressed evidence files
+
+Revision ID: e3b8d52f0c17
+Revises: c51e08b7d9a2
+Create Date: 2026-10-16 19:10:05.284611
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3b8d52f0c17'
+down_revision = 'c51e08b7d9a2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # alembic/env.py imports main, whose create_all() may already have created the table
+    if not sa.inspect(op.get_bind()).has_table('evidence_files'):
+        op.create_table('evidence_files',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('sha256', sa.String(length=64), nullable=False),
+            sa.Column('content_type', sa.String(), nullable=True),
+            sa.Column('size_bytes', sa.Integer(), nullable=False),
+            sa.Column('original_filename', sa.String(), nullable=True),
+            sa.Column('created_at', sa.DateTime(), nullable=True),
+        )
+        op.create_index('ix_evidence_files_sha256', 'evidence_files', ['sha256'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_evidence_files_sha256', table_name='evidence_files')
+    op.drop_table('evidence_files')
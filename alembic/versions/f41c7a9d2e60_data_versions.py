@@ -0,0 +1,36 @@
+"""Data versions for conditional GETs
+
+Revision ID: f41c7a9d2e60
+Revises: e3b8d52f0c17
+Create Date: 2026-10-16 19:42:18.907134
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f41c7a9d2e60'
+down_revision = 'e3b8d52f0c17'
+branch_labels = None
+depends_on = None
+
+NAMES = ('products', 'types', 'warehouses', 'movements')
+
+
+def upgrade():
+    # alembic/env.py imports main, whose create_all() may already have created the table
+    bind = op.get_bind()
+    if not sa.inspect(bind).has_table('data_versions'):
+        op.create_table('data_versions',
+            sa.Column('name', sa.String(), primary_key=True),
+            sa.Column('version', sa.Integer(), nullable=False),
+        )
+    existing = {r[0] for r in bind.execute(sa.text("SELECT name FROM data_versions"))}
+    for name in NAMES:
+        if name not in existing:
+            bind.execute(sa.text("INSERT INTO data_versions (name, version) VALUES (:n, 0)"), {"n": name})
+
+
+def downgrade():
+    op.drop_table('data_versions')
@@ -0,0 +1,43 @@
+# Barcode decoding for main's process pool. Workers import only this module (spawn and forkserver
+# re-import the target's module), so it must stay free of side effects: no database, no app, no env reads.
+import io
+
+from PIL import Image
+
+try:
+    from pyzbar.pyzbar import decode as zbar_decode
+    HAS_PYZBAR = True
+    PYZBAR_ERR = ""
+except Exception as _e:
+    HAS_PYZBAR = False
+    PYZBAR_ERR = str(_e)
+
+
+class BarcodeDecodeError(ValueError):
+    """The upload is not an image Pillow can read (the request's fault, unlike a pool failure)."""
+
+
+def decode_barcode_image(data: bytes, sides):
+    """
+    JPEG draft mode lets the decoder downscale while reading; the grayscale image is then tried at
+    each of `sides` (longest side, px, ascending) until something decodes. Returns [(code, symbology)].
+    """
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("L", (sides[-1], sides[-1]))
+        gray = img.convert("L")
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as e:
+        raise BarcodeDecodeError(str(e) or type(e).__name__) from None
+    for side in sides:
+        scale = side / max(gray.size)
+        attempt = gray if scale >= 1 else gray.resize((max(1, round(gray.width * scale)),
+                                                       max(1, round(gray.height * scale))), Image.BILINEAR)
+        found = zbar_decode(attempt)
+        if found:
+            codes = {}
+            for r in found:
+                codes.setdefault(r.data.decode("utf-8", errors="ignore").strip(), r.type)
+            return list(codes.items())
+        if scale >= 1:
+            break
+    return []
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks against a throwaway SQLite database (never the configured DATABASE_URL).
+
+    python bench.py search --sizes 10000 100000 200000
+    python bench.py serialize --sizes 1000 10000 100000
+    python bench.py as_of --sizes 100000 1000000
+    python bench.py summary --sizes 100000 1000000
+    python bench.py transfers --threads 16 --transfers 4000
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="inventory-bench-"), "bench.db")
+
+from fastapi import HTTPException  # noqa: E402
+from sqlalchemy import case, func, insert, or_  # noqa: E402
+
+import main  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from main import (SessionLocal, Product, ProductFull, InventoryMovement, StockSnapshot, StockSnapshotLine,  # noqa: E402
+                  Warehouse, WarehouseStock, Principal, _product_search, _rows_json, _PRODUCT_FULL_FIELDS,
+                  _stock_as_of, _take_snapshot, _rebuild_rollups, _rollup_summary_query, _transfer_stock)
+
+WORDS = ["BOMBA", "CALENTADOR", "PRESIÓN", "VÁLVULA", "TUBO", "SOLAR", "ALUMINIO", "ÁNGULO", "KIT", "BAJA",
+         "ALTA", "MANGUERA", "EMPAQUE", "SILICÓN", "TANQUE", "REFACCIÓN", "CONEXIÓN", "ACERO", "PANEL", "INVERSOR"]
+SYLLABLES = ["ca", "lo", "ré", "ma", "ti", "zo", "pe", "ñu", "ga", "ví", "dro", "sol", "ter", "mon", "cu", "fa"]
+QUERIES = ["presion", "bomba presu", "valvula", "calent baja", "inversor panel"]
+
+
+def _vocabulary(rng, size: int = 20_000):
+    """Many rare synthetic part words; WORDS are mixed in separately at a realistic rate."""
+    words = {"".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).upper() for _ in range(size)}
+    return sorted(words)
+
+
+def _fill_products(target: int) -> None:
+    """Grow the catalog to `target` products with synthetic Spanish descriptions."""
+    with SessionLocal() as db:
+        start = db.query(Product).count()
+        rng = random.Random(start)
+        vocab = _vocabulary(rng)
+        batch = []
+        for i in range(start, target):
+            words = [rng.choice(vocab) for _ in range(rng.randint(3, 6))]
+            words.insert(rng.randrange(len(words)), rng.choice(WORDS) if rng.random() < 0.05 else rng.choice(vocab))
+            desc = " ".join(words)
+            batch.append({"id_code": f"SKU-{i:07d}", "description": desc, "stock": 0})
+            if len(batch) == 5000:
+                db.execute(insert(Product), batch); batch = []
+        if batch:
+            db.execute(insert(Product), batch)
+        db.commit()
+
+
+def _time_query(build, repeat: int) -> float:
+    """Median milliseconds to fetch the first page (limit 50) of `build(db)`."""
+    samples = []
+    with SessionLocal() as db:
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            build(db).limit(50).all()
+            samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def bench_search(sizes, repeat: int) -> None:
+    print(f"search backend: {main._search_backend or 'like'}")
+    print(f"{'products':>10} {'query':>16} {'LIKE ms':>9} {'index ms':>9}")
+    for size in sizes:
+        _fill_products(size)
+        for q in QUERIES:
+            def like(db, q=q):
+                pattern = f"%{q}%"
+                return db.query(Product.id).filter(or_(Product.id_code.like(pattern),
+                                                       Product.description.like(pattern))).order_by(Product.id_code)
+
+            def indexed(db, q=q):
+                query, relevance = _product_search(db.query(Product.id), q)
+                return query.order_by(relevance if relevance is not None else Product.id_code)
+
+            print(f"{size:>10} {q:>16} {_time_query(like, repeat):>9.2f} {_time_query(indexed, repeat):>9.2f}")
+
+
+def _product_full_rows(size: int):
+    """Synthetic /products_full rows, in _PRODUCT_FULL_FIELDS order."""
+    rng = random.Random(size)
+    rows = []
+    for i in range(size):
+        cost, stock = round(rng.uniform(1, 5000), 2), rng.randint(0, 5000)
+        rows.append((i + 1, f"SKU-{i:07d}", " ".join(rng.choice(WORDS) for _ in range(4)), cost, stock,
+                     round(cost * stock, 2), round(stock * rng.uniform(0.8, 1.2) * cost, 2), rng.choice(WORDS),
+                     rng.randint(0, 50), None))
+    return rows
+
+
+def _time_call(fn, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def bench_serialize(sizes, repeat: int) -> None:
+    """Old path (model per row + jsonable_encoder + json.dumps, as FastAPI's response_model did) vs. _rows_json."""
+    def models(rows):
+        data = [ProductFull(**dict(zip(_PRODUCT_FULL_FIELDS, r))) for r in rows]
+        return json.dumps(jsonable_encoder(data)).encode()
+
+    print(f"{'rows':>8} {'models ms':>10} {'rows ms':>9} {'columns ms':>11} {'rows KB':>9} {'columns KB':>11}")
+    for size in sizes:
+        rows = _product_full_rows(size)
+        as_rows, as_columns = _rows_json(_PRODUCT_FULL_FIELDS, rows), _rows_json(_PRODUCT_FULL_FIELDS, rows, "columns")
+        print(f"{size:>8} {_time_call(lambda: models(rows), repeat):>10.1f} "
+              f"{_time_call(lambda: _rows_json(_PRODUCT_FULL_FIELDS, rows), repeat):>9.1f} "
+              f"{_time_call(lambda: _rows_json(_PRODUCT_FULL_FIELDS, rows, 'columns'), repeat):>11.1f} "
+              f"{len(as_rows) / 1024:>9.0f} {len(as_columns) / 1024:>11.0f}")
+
+
+def _fill_movements(target: int, start: datetime, days: int, products: int = 2_000) -> None:
+    """Grow the ledger to `target` movements on `products` products, spread evenly over `days` days from `start`."""
+    _fill_products(products)
+    with SessionLocal() as db:
+        done = db.query(InventoryMovement).count()
+        rng = random.Random(done)
+        step = days * 86400 / max(target, 1)
+        batch = []
+        for i in range(done, target):
+            batch.append({"product_id": rng.randint(1, products), "movement_type": rng.choice(("IN", "OUT", "ADJ")),
+                          "quantity": rng.randint(1, 50), "moved_at": start + timedelta(seconds=i * step),
+                          "warehouse_id": None})
+            if len(batch) == 20_000:
+                db.execute(insert(InventoryMovement), batch); batch = []
+        if batch:
+            db.execute(insert(InventoryMovement), batch)
+        db.commit()
+
+
+def bench_as_of(sizes, repeat: int) -> None:
+    """/stock/as_of over a 5-year ledger: full scan vs. nearest monthly snapshot + delta."""
+    start, days = datetime(2021, 1, 1), 5 * 365
+    at = start + timedelta(days=days - 20, hours=13)
+    print(f"{'movements':>10} {'scan ms':>9} {'snapshot ms':>12}")
+    for size in sizes:
+        _fill_movements(size, start, days)
+        with SessionLocal() as db:
+            db.query(StockSnapshotLine).delete()
+            db.query(StockSnapshot).delete()
+            db.commit()
+            scan = _time_call(lambda: _stock_as_of(db, at), repeat)
+            month = start
+            while month <= at:
+                _take_snapshot(db, month)
+                month = (month + timedelta(days=32)).replace(day=1)
+            db.commit()
+            snap = _time_call(lambda: _stock_as_of(db, at), repeat)
+        print(f"{size:>10} {scan:>9.1f} {snap:>12.1f}")
+
+
+def bench_summary(sizes, repeat: int, products: int) -> None:
+    """Weekly IN/OUT/ADJ totals for a year: grouped ledger scan vs. the daily rollups."""
+    start, days = datetime(2025, 1, 1), 365
+    groups = {"movement_type": [("movement_type", main.MovementRollup.movement_type)]}
+    mv = InventoryMovement
+    print(f"{'movements':>10} {'ledger ms':>10} {'rollup ms':>10} {'rollup rows':>12}")
+    for size in sizes:
+        _fill_movements(size, start, days, products)
+        with SessionLocal() as db:
+            written = _rebuild_rollups(db)
+            week = func.date(mv.moved_at, "weekday 0", "-6 days")
+            ledger = _time_call(lambda: db.query(week, mv.movement_type, func.sum(mv.quantity))
+                                          .group_by(week, mv.movement_type).all(), repeat)
+            rollup = _time_call(lambda: _rollup_summary_query(db, "week", "movement_type", groups, None, None,
+                                                              None, None)[0].all(), repeat)
+        print(f"{size:>10} {ledger:>10.1f} {rollup:>10.1f} {written:>12}")
+
+
+def bench_transfers(threads: int, transfers: int, products: int, warehouses: int) -> None:
+    """
+    Random multi-line transfers from many threads over a small, contended set of products, then check
+    that no update was lost: every warehouse quantity equals its opening stock plus the committed
+    transfer movements, none went negative, and each product's total across warehouses is unchanged.
+    """
+    opening = 20
+    _fill_products(products)
+    with SessionLocal() as db:
+        db.execute(insert(Warehouse), [{"name": f"BENCH-{w}", "location": ""} for w in range(warehouses)])
+        wids = [w for (w,) in db.query(Warehouse.id).filter(Warehouse.name.like("BENCH-%")).order_by(Warehouse.id)]
+        db.execute(insert(WarehouseStock), [{"product_id": p, "warehouse_id": w, "quantity": opening}
+                                            for p in range(1, products + 1) for w in wids])
+        db.commit()
+    user = Principal(id=0, email="bench@example.com", role="admin")
+    outcomes, lock = {"ok": 0, "400": 0, "409": 0}, threading.Lock()
+
+    def worker(seed: int, count: int) -> None:
+        rng = random.Random(seed)
+        for _ in range(count):
+            src, dst = rng.sample(wids, 2)
+            lines = [(rng.randint(1, products), rng.randint(1, 8)) for _ in range(rng.randint(1, 5))]
+            with SessionLocal() as db:
+                try:
+                    _transfer_stock(db, src, dst, lines, "bench", user)
+                    db.commit()
+                    outcome = "ok"
+                except HTTPException as exc:
+                    db.rollback()
+                    outcome = str(exc.status_code)
+            with lock:
+                outcomes[outcome] += 1
+
+    pool = [threading.Thread(target=worker, args=(i, transfers // threads)) for i in range(threads)]
+    t0 = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    mv = InventoryMovement
+    with SessionLocal() as db:
+        signed = func.sum(case((mv.movement_type == "IN", mv.quantity), else_=-mv.quantity))
+        moved = {(p, w): int(q) for p, w, q in db.query(mv.product_id, mv.warehouse_id, signed)
+                 .filter(mv.movement_reason == "transfer").group_by(mv.product_id, mv.warehouse_id)}
+        stock = {(p, w): q for p, w, q in db.query(WarehouseStock.product_id, WarehouseStock.warehouse_id,
+                                                    WarehouseStock.quantity).filter(WarehouseStock.warehouse_id.in_(wids))}
+    lost = sum(1 for key, q in stock.items() if q != opening + moved.get(key, 0))
+    negative = sum(1 for q in stock.values() if q < 0)
+    totals = {}
+    for (p, _), q in stock.items():
+        totals[p] = totals.get(p, 0) + q
+    unbalanced = sum(1 for q in totals.values() if q != opening * len(wids))
+    done = sum(outcomes.values())
+    print(f"{threads} threads, {done} transfers in {elapsed:.1f}s ({done / elapsed:,.0f}/s): "
+          f"{outcomes['ok']} committed, {outcomes['400']} short (400), {outcomes['409']} raced (409)")
+    print(f"lost updates: {lost}, negative rows: {negative}, unbalanced products: {unbalanced}")
+    if lost or negative or unbalanced:
+        raise SystemExit(1)
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description="Inventory API micro-benchmarks.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("search", help="LIKE scan vs. full-text index as the catalog grows.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 200_000])
+    p.add_argument("--repeat", type=int, default=5)
+    p = sub.add_parser("serialize", help="Model-per-row JSON vs. row tuples through pydantic-core.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    p.add_argument("--repeat", type=int, default=5)
+    p = sub.add_parser("as_of", help="Point-in-time stock: ledger scan vs. snapshot + delta.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    p.add_argument("--repeat", type=int, default=5)
+    p = sub.add_parser("summary", help="Weekly movement totals: ledger scan vs. daily rollups.")
+    p.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--products", type=int, default=100, help="products moving (rollup rows grow with products x days)")
+    p = sub.add_parser("transfers", help="Concurrent multi-line transfers; fails if any update is lost.")
+    p.add_argument("--threads", type=int, default=16)
+    p.add_argument("--transfers", type=int, default=4_000)
+    p.add_argument("--products", type=int, default=50)
+    p.add_argument("--warehouses", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "search":
+        bench_search(args.sizes, args.repeat)
+    elif args.command == "serialize":
+        bench_serialize(args.sizes, args.repeat)
+    elif args.command == "as_of":
+        bench_as_of(args.sizes, args.repeat)
+    elif args.command == "summary":
+        bench_summary(args.sizes, args.repeat, args.products)
+    elif args.command == "transfers":
+        bench_transfers(args.threads, args.transfers, args.products, args.warehouses)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
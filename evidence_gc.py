@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+from datetime import timedelta
+
+from main import SessionLocal, _adopt_legacy_evidence, _evidence_orphans
+
+
+def adopt_legacy(dry_run: bool) -> int:
+    """Move evidence orders still reference by path into the content-addressed store. Returns how many."""
+    with SessionLocal() as db:
+        adopted = _adopt_legacy_evidence(db, dry_run)
+        if not dry_run:
+            db.commit()
+    for code, old, new in adopted:
+        if new is None:
+            print(f"order {code}: {old} not found, left as is")
+        else:
+            print(f"order {code}: {old} {'would become' if dry_run else '->'} {new}")
+    return sum(1 for _, _, new in adopted if new)
+
+
+def sweep(hours: float, dry_run: bool) -> int:
+    """Delete evidence files nothing references and nobody touched in `hours`. Returns how many."""
+    with SessionLocal() as db:
+        orphans = _evidence_orphans(db, timedelta(hours=hours))
+    removed = 0
+    for path in orphans:
+        print(("would remove " if dry_run else "removing ") + path)
+        if not dry_run:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    print(f"{len(orphans) if dry_run else removed} orphan evidence file(s) {'found' if dry_run else 'removed'}")
+    return removed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move legacy order evidence into the content-addressed store, then remove "
+                                                 "evidence files left behind by failed order completions.")
+    parser.add_argument("--older-than", type=float, default=24.0,
+                        help="only files untouched for this many hours (default 24); keep it well above "
+                             "the longest upload so in-flight requests are never swept")
+    parser.add_argument("--dry-run", action="store_true", help="list what would be removed")
+    args = parser.parse_args()
+    # Legacy files are adopted first; their old copies are then unreferenced and swept like any other
+    adopt_legacy(args.dry_run)
+    sweep(args.older_than, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,51 @@
 import os
-import shutil
+import time
 import enum
-from datetime import datetime, timedelta
+import re
+import json
+import base64
+import hashlib
+import bisect
+import itertools
+import math
+import logging
+import mimetypes
+from array import array
+from statistics import NormalDist
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta, timezone
 from typing import Optional, List
 
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
-from fastapi.responses import StreamingResponse
-import io, csv as _csv
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Response, Request, BackgroundTasks, Query
+from fastapi.responses import StreamingResponse, FileResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+import io, csv as _csv, zlib
 
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
+from pydantic_core import to_json
 from sqlalchemy import (create_engine, Column, Integer, String, Float, Text, DateTime, ForeignKey, CheckConstraint,
-                        func, select, and_, or_, case, UniqueConstraint)
+                        func, select, and_, or_, case, UniqueConstraint, insert, update, delete, bindparam, tuple_, Index,
+                        text, inspect, table, column, literal_column, literal, union_all, event, Date, cast, type_coerce,
+                        true)
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship, Session
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 # ---------- pzybar support --------
-try:
-    from pyzbar.pyzbar import decode as zbar_decode
-    _HAS_PYZBAR = True
-    _PYZBAR_ERR = ""
-except Exception as _e:
-    _HAS_PYZBAR = False
-    _PYZBAR_ERR = str(_e)
-from PIL import Image
+from barcode_worker import HAS_PYZBAR as _HAS_PYZBAR, PYZBAR_ERR as _PYZBAR_ERR, BarcodeDecodeError, decode_barcode_image
+from PIL import Image, ImageOps
 
 # ---------- .env support ----------
 try:
@@ -41,9 +61,71 @@ ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./inventory.db")
 CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 APPROVAL_THRESHOLD = int(os.getenv("APPROVAL_THRESHOLD", "1000"))
-
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {})
+AUTH_CACHE_TTL_SECONDS = int(os.getenv("AUTH_CACHE_TTL_SECONDS", "60"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+# Reports and exports read from here (e.g. a Postgres replica); defaults to the primary
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL") or DATABASE_URL
+
+# ---------- Storage profiles ----------
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+BARCODE_WORKERS = int(os.getenv("BARCODE_WORKERS", str(min(4, os.cpu_count() or 1))))
+BARCODE_CACHE_SIZE = int(os.getenv("BARCODE_CACHE_SIZE", "512"))
+BARCODE_MAX_BYTES = int(os.getenv("BARCODE_MAX_BYTES", str(20 * 1024 * 1024)))
+BARCODE_BATCH_MAX_FILES = int(os.getenv("BARCODE_BATCH_MAX_FILES", "20"))
+# Longest side (px) tried in order; a label that decodes small never pays for the big passes
+BARCODE_SIDES = [int(x) for x in os.getenv("BARCODE_SIDES", "800,1600,2400").split(",")]
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(1024 * 1024)))  # per entry
+
+EVIDENCE_DIR = os.getenv("EVIDENCE_DIR", "uploads/evidence")
+EVIDENCE_THUMB_SIDE = int(os.getenv("EVIDENCE_THUMB_SIDE", "1024"))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Requests over either budget are logged with their route (N+1 / slow endpoint regressions)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+SLOW_REQUEST_QUERIES = int(os.getenv("SLOW_REQUEST_QUERIES", "50"))
+
+logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger("inventory")
+
+def _make_engine(url: str, read_only: bool = False):
+    """
+    SQLite: WAL (readers don't block the writer), busy_timeout instead of instant "database is
+    locked", synchronous=NORMAL (safe under WAL) and mmap reads. Postgres: bounded pool with
+    pre-ping. `read_only` engines refuse writes (query_only / read-only transactions).
+    """
+    if url.startswith("sqlite"):
+        eng = create_engine(url, connect_args={"check_same_thread": False,
+                                               "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000})
+
+        @event.listens_for(eng, "connect")
+        def _sqlite_pragmas(dbapi_conn, _record):
+            cur = dbapi_conn.cursor()
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            cur.execute("PRAGMA synchronous=NORMAL")
+            cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            if read_only:
+                cur.execute("PRAGMA query_only=ON")
+            cur.close()
+        return eng
+    eng = create_engine(url, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+                        pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=True)
+    if read_only and eng.dialect.name == "postgresql":
+        eng = eng.execution_options(postgresql_readonly=True)
+    return eng
+
+engine = _make_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+read_engine = _make_engine(READ_DATABASE_URL, read_only=True)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 Base = declarative_base()
 
 pwd_context = CryptContext(
@@ -60,6 +142,8 @@ class User(Base):
     email = Column(String, unique=True, nullable=False, index=True)
     password_hash = Column(String, nullable=False)
     role = Column(String, default="user")
+    # Bumped on every admin change; tokens carrying an older "ver" stop resolving
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class ProductType(Base):
@@ -72,7 +156,8 @@ class Product(Base):
     id = Column(Integer, primary_key=True)
     id_code = Column(String, unique=True, nullable=False, index=True)
     description = Column(Text, nullable=False)
-    stock = Column(Integer, default=0)
+    # Materialized balance of the movement ledger, maintained by _insert_movements()
+    stock = Column(Integer, default=0, server_default="0", nullable=False, index=True)
     unit_cost = Column(Float)
     product_type_id = Column(Integer, ForeignKey("product_types.id"), nullable=True)
     min_stock = Column(Integer, nullable=True)
@@ -92,12 +177,16 @@ class InventoryMovement(Base):
     quantity = Column(Integer, nullable=False)
     unit_cost = Column(Float, nullable=True)
     note = Column(Text, nullable=True)
-    moved_at = Column(DateTime, default=datetime.utcnow, index=True)
+    moved_at = Column(DateTime, default=datetime.utcnow)
     created_at = Column(DateTime, default=datetime.utcnow)
+    warehouse_id = Column(Integer, ForeignKey("warehouses.id"), nullable=True)  # almacén afectado, si se conoce
 
     product = relationship("Product", back_populates="movements")
     __table_args__ = (
         CheckConstraint("movement_type IN ('IN','OUT','ADJ')", name="movement_type_check"),
+        # Keyset pagination: (moved_at, id) for the ledger, (product_id, moved_at, id) for product history
+        Index("ix_inventory_movements_moved_at_id", "moved_at", "id"),
+        Index("ix_inventory_movements_product_moved_at_id", "product_id", "moved_at", "id"),
     )
 
 class DiscrepancyResolution(Base):
@@ -111,6 +200,28 @@ class DiscrepancyResolution(Base):
     resolved_by = Column(Integer, ForeignKey("users.id"), nullable=True)
     resolved_at = Column(DateTime, default=datetime.utcnow)
 
+class OpenDiscrepancy(Base):
+    """
+    One row per (product, discrepancy_type) currently detected, kept in sync by _sync_discrepancies()
+    whenever stock, unit_cost, min_stock or max_stock change. A RESOLVED row reopens when the
+    product's stock or unit_cost moves away from the values it was resolved at.
+    """
+    __tablename__ = "open_discrepancies"
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    discrepancy_type = Column(String, nullable=False)
+    detail = Column(Text, nullable=False)
+    stock_at = Column(Integer, nullable=False)
+    unit_cost_at = Column(Float, nullable=True)
+    status = Column(String, nullable=False, default="OPEN")  # OPEN, RESOLVED
+    detected_at = Column(DateTime, default=datetime.utcnow)
+    resolution_id = Column(Integer, ForeignKey("discrepancy_resolutions.id"), nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint("product_id", "discrepancy_type", name="_product_discrepancy_uc"),
+        Index("ix_open_discrepancies_status_type", "status", "discrepancy_type", "product_id"),
+    )
+
 class Sale(Base):
     __tablename__ = "sales"
     id = Column(Integer, primary_key=True, index=True)
@@ -119,14 +230,19 @@ class Sale(Base):
     note = Column(Text, nullable=True)
     total = Column(Float, nullable=True)
 
+    __table_args__ = (
+        Index("ix_sales_created_at_id", "created_at", "id"),
+    )
+
 class SaleItem(Base):
     __tablename__ = "sale_items"
     id = Column(Integer, primary_key=True, index=True)
-    sale_id = Column(Integer, ForeignKey("sales.id", ondelete="CASCADE"))
+    sale_id = Column(Integer, ForeignKey("sales.id", ondelete="CASCADE"), index=True)
     product_id = Column(Integer, ForeignKey("products.id"))
     quantity = Column(Integer, nullable=False)
     unit_price = Column(Float, nullable=True)
     subtotal = Column(Float, nullable=True)
+    movement_id = Column(Integer, ForeignKey("inventory_movements.id"), nullable=True)  # su salida (OUT)
 
 # --- NUEVOS MODELOS PARA ÓRDENES ---
 class OrderStatus(str, enum.Enum):
@@ -164,6 +280,77 @@ class OrderItem(Base):
     order = relationship("Order", back_populates="items")
     product = relationship("Product") # Para acceder al código y descripción
 
+class StockSnapshot(Base):
+    """Balance checkpoint: its lines hold the stock left by every movement with moved_at < taken_at."""
+    __tablename__ = "stock_snapshots"
+    id = Column(Integer, primary_key=True)
+    taken_at = Column(DateTime, unique=True, nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class StockSnapshotLine(Base):
+    __tablename__ = "stock_snapshot_lines"
+    snapshot_id = Column(Integer, ForeignKey("stock_snapshots.id", ondelete="CASCADE"), primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    warehouse_id = Column(Integer, primary_key=True, default=0)  # 0 = movimientos sin almacén
+    quantity = Column(Integer, nullable=False)
+
+class CostLayer(Base):
+    """
+    FIFO cost layer: stock received at `unit_cost` that has not been issued yet. A negative
+    `remaining` is stock issued before it was received (costed at the fallback unit cost).
+    """
+    __tablename__ = "cost_layers"
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    movement_id = Column(Integer, ForeignKey("inventory_movements.id"), nullable=True)
+    received_at = Column(DateTime, nullable=False)
+    unit_cost = Column(Float, nullable=False)
+    quantity = Column(Integer, nullable=False)
+    remaining = Column(Integer, nullable=False)
+    __table_args__ = (
+        Index("ix_cost_layers_product_received_id", "product_id", "received_at", "id"),
+    )
+
+class MovementCost(Base):
+    """Cost of goods issued by an OUT (or negative ADJ) movement, taken from the oldest layers."""
+    __tablename__ = "movement_costs"
+    movement_id = Column(Integer, ForeignKey("inventory_movements.id"), primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
+    quantity = Column(Integer, nullable=False)
+    cost = Column(Float, nullable=False)
+    estimated_quantity = Column(Integer, nullable=False, default=0)  # issued with no layer to draw from
+
+class MovementRollup(Base):
+    """Ledger totals per (day, product, movement_type, movement_reason), kept current by the movement hook."""
+    __tablename__ = "movement_rollups"
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    movement_type = Column(String, primary_key=True)
+    movement_reason = Column(String, primary_key=True, default="")  # "" = sin motivo
+    quantity = Column(Integer, nullable=False, default=0)  # as recorded (ADJ keeps its sign)
+    value = Column(Float, nullable=False, default=0)       # sum(quantity * unit_cost) as recorded
+    cost = Column(Float, nullable=False, default=0)        # FIFO cost of issues (movement_costs)
+    movements = Column(Integer, nullable=False, default=0)
+    __table_args__ = (
+        Index("ix_movement_rollups_product_day", "product_id", "day"),
+    )
+
+class DataVersion(Base):
+    """Change counter per dataset, bumped in the same transaction as every write (_bump_versions)."""
+    __tablename__ = "data_versions"
+    name = Column(String, primary_key=True)  # one of DATA_VERSION_NAMES
+    version = Column(Integer, nullable=False, default=0)
+
+class EvidenceFile(Base):
+    """Uploaded evidence stored once per content hash under uploads/evidence/<sha[:2]>/<sha>."""
+    __tablename__ = "evidence_files"
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), unique=True, nullable=False, index=True)
+    content_type = Column(String, nullable=True)
+    size_bytes = Column(Integer, nullable=False)
+    original_filename = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 class Warehouse(Base):
     __tablename__ = "warehouses"
     id = Column(Integer, primary_key=True, index=True)
@@ -177,6 +364,8 @@ class WarehouseStock(Base):
     product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
     warehouse_id = Column(Integer, ForeignKey("warehouses.id"), nullable=False) 
     quantity = Column(Integer, default=0)
+    # Apartado por órdenes de venta pendientes (stock_reservations ACTIVE); disponible = quantity - reserved
+    reserved = Column(Integer, nullable=False, default=0, server_default="0")
 
     # Relaciones
     product = relationship("Product")
@@ -186,11 +375,33 @@ class WarehouseStock(Base):
         UniqueConstraint('product_id', 'warehouse_id', name='_product_warehouse_uc'),
     )
 
+class StockReservation(Base):
+    """Units promised to a pending sales order; WarehouseStock.reserved is the sum of the ACTIVE rows."""
+    __tablename__ = "stock_reservations"
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    warehouse_id = Column(Integer, ForeignKey("warehouses.id"), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    status = Column(String, nullable=False, default="ACTIVE")  # ACTIVE | CONSUMED | RELEASED
+    created_at = Column(DateTime, default=datetime.utcnow)
+    closed_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_stock_reservations_order_status", "order_id", "status"),
+    )
+
 # ---------- Pydantic ----------
 class Token(BaseModel):
     access_token: str
     token_type: str
 
+class Principal(BaseModel):
+    """Authenticated caller as resolved by get_current_user (cached, no ORM state)."""
+    id: int
+    email: str
+    role: str
+
 class UserCreate(BaseModel):
     email: str
     password: str
@@ -255,6 +466,17 @@ class MovementOut(BaseModel):
     moved_at: datetime
     class Config: orm_mode = True
 
+class MovementBulkResult(BaseModel):
+    index: int
+    status: str  # "accepted" | "rejected"
+    id: Optional[int] = None
+    reason: Optional[str] = None
+
+class MovementBulkOut(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[MovementBulkResult]
+
 class ProductFull(BaseModel):
     id: int
     id_code: str
@@ -262,6 +484,7 @@ class ProductFull(BaseModel):
     unit_cost: Optional[float]
     stock: int
     valuation: float
+    fifo_value: float
     product_type: Optional[str]
     min_stock: Optional[int]
     max_stock: Optional[int]
@@ -286,25 +509,45 @@ class MinMaxRow(BaseModel):
     min_stock: Optional[int] = None
     max_stock: Optional[int] = None
 
-class SaleIn(BaseModel):
+class SaleLineIn(BaseModel):
     product_id: Optional[int] = None
     id_code: Optional[str] = None
     quantity: int
     unit_price: Optional[float] = None
+
+class SaleIn(BaseModel):
+    # Un solo producto (campos sueltos) o un carrito en `lines`
+    product_id: Optional[int] = None
+    id_code: Optional[str] = None
+    quantity: Optional[int] = None
+    unit_price: Optional[float] = None
+    lines: Optional[List[SaleLineIn]] = None
     customer: Optional[str] = None
     note: Optional[str] = None
 
-class SaleOut(BaseModel):
+class SaleItemOut(BaseModel):
     id: int
-    created_at: datetime
     product_id: int
     id_code: str
+    description: Optional[str]
     quantity: int
     unit_price: Optional[float]
     subtotal: float
+    movement_id: int
+
+class SaleOut(BaseModel):
+    id: int
+    created_at: datetime
+    # Single-line sales keep the flat fields; carts read `items`
+    product_id: Optional[int] = None
+    id_code: Optional[str] = None
+    quantity: Optional[int] = None
+    unit_price: Optional[float] = None
+    subtotal: Optional[float] = None
     total: float
     customer: Optional[str]
     note: Optional[str]
+    items: List[SaleItemOut] = []
 
 class UserUpdate(BaseModel):
     email: Optional[str] = None
@@ -343,6 +586,16 @@ class TransferRequest(BaseModel):
     quantity: int
     notes: Optional[str] = None
 
+class TransferLine(BaseModel):
+    product_id: int
+    quantity: int
+
+class TransferDocument(BaseModel):
+    from_warehouse_id: int
+    to_warehouse_id: int
+    lines: List[TransferLine]
+    notes: Optional[str] = None
+
 # ---------- Auth helpers ----------
 
 def _normalize_password(p: str) -> str:
@@ -376,7 +629,53 @@ def get_db():
     finally:
         db.close()
 
-def get_current_user(db=Depends(get_db), token: str = Depends(oauth2_scheme)) -> User:
+def get_read_db():
+    """Session on the read engine for reports; may lag the primary when READ_DATABASE_URL is a replica."""
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Resolved principals keyed by token: {token: (principal, expires_at_monotonic, users_version)}.
+# users_version is the shared "users" data version when the entry was cached: every user edit or delete
+# bumps it, so a hit is only trusted while it still matches (on every worker, not just the one that
+# handled the change).
+_principal_cache = OrderedDict()
+_principal_lock = threading.Lock()
+
+def _cached_principal(token: str, users_version: int) -> Optional[Principal]:
+    with _principal_lock:
+        hit = _principal_cache.get(token)
+        if hit is None:
+            return None
+        if hit[1] < time.monotonic() or hit[2] != users_version:
+            del _principal_cache[token]
+            return None
+        _principal_cache.move_to_end(token)
+        return hit[0]
+
+def _cache_principal(token: str, principal: Principal, users_version: int):
+    with _principal_lock:
+        _principal_cache[token] = (principal, time.monotonic() + AUTH_CACHE_TTL_SECONDS, users_version)
+        _principal_cache.move_to_end(token)
+        while len(_principal_cache) > AUTH_CACHE_SIZE:
+            _principal_cache.popitem(last=False)
+
+def _invalidate_principals(user_id: int):
+    """
+    Drop this worker's cached principals for a user right away. Other workers drop theirs on their next
+    hit: the caller bumped the "users" data version in the same transaction as the change.
+    """
+    with _principal_lock:
+        for token in [t for t, (p, _, _) in _principal_cache.items() if p.id == user_id]:
+            del _principal_cache[token]
+
+def get_current_user(db=Depends(get_db), token: str = Depends(oauth2_scheme)) -> Principal:
+    (users_version,) = _data_versions(db, ("users",))  # one primary-key read; shared by all workers
+    cached = _cached_principal(token, users_version)
+    if cached is not None:
+        return cached
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -389,12 +688,17 @@ def get_current_user(db=Depends(get_db), token: str = Depends(oauth2_scheme)) ->
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.email == email).first()
-    if user is None:
+    if payload.get("uid") is not None:
+        user = db.query(User).filter(User.id == payload["uid"]).first()
+    else:  # tokens issued before uid/ver were added
+        user = db.query(User).filter(User.email == email).first()
+    if user is None or user.email != email or (user.token_version or 0) != payload.get("ver", 0):
         raise credentials_exception
-    return user
+    principal = Principal(id=user.id, email=user.email, role=user.role)
+    _cache_principal(token, principal, users_version)
+    return principal
 
-def require_admin(user: User = Depends(get_current_user)):
+def require_admin(user: Principal = Depends(get_current_user)):
     if user.role != "admin":
         raise HTTPException(403, "Forbidden")
     return user
@@ -414,7 +718,807 @@ def _current_stock_subquery(db):
         ).group_by(InventoryMovement.product_id)
     ).subquery()
 
-def _require_sales_role(user: User):
+# ---------- Movement write path ----------
+_MOVEMENT_FIELDS = ("product_id", "movement_type", "movement_reason", "quantity", "unit_cost", "note",
+                    "moved_at", "created_at", "warehouse_id")
+_mv = InventoryMovement.__table__
+_MV_SIGNED = case((_mv.c.movement_type == "OUT", -_mv.c.quantity), else_=_mv.c.quantity)
+_MV_WAREHOUSE = func.coalesce(_mv.c.warehouse_id, 0)
+# Ids of the movements being written, per connection. The side effects below are a few statements over
+# this batch whatever its size, so one API movement and a million-row import share the same code.
+_BATCH_DDL = "CREATE TEMP TABLE IF NOT EXISTS movement_batch (id INTEGER PRIMARY KEY)"
+_batch = table("movement_batch", column("id"))
+_BATCH_MOVES = _batch.join(_mv, _mv.c.id == _batch.c.id)
+
+def _movement_delta(movement_type: str, quantity: int) -> int:
+    """Signed effect of a movement on stock (same rule as _current_stock_subquery)."""
+    if movement_type == "OUT":
+        return -quantity
+    return quantity
+
+# ---------- Data versions ----------
+DATA_VERSION_NAMES = ("products", "types", "warehouses", "movements", "users")
+
+def _ensure_data_versions():
+    with engine.begin() as conn:
+        existing = set(conn.execute(select(DataVersion.name)).scalars())
+        missing = [{"name": n, "version": 0} for n in DATA_VERSION_NAMES if n not in existing]
+        if missing:
+            conn.execute(insert(DataVersion.__table__), missing)
+
+def _bump_versions(db, *names):
+    """Invalidate ETags / cached responses that depend on `names`; commits with the caller's write."""
+    t = DataVersion.__table__
+    db.execute(update(t).where(t.c.name.in_(names)).values(version=t.c.version + 1))
+
+def _data_versions(db, names) -> tuple:
+    t = DataVersion.__table__
+    found = dict(db.execute(select(t.c.name, t.c.version).where(t.c.name.in_(names))).all())
+    return tuple(found.get(n, 0) for n in names)
+
+def _dialect_insert(db, table):
+    """INSERT construct with on_conflict_do_update/do_nothing for the session's backend (SQLite or Postgres)."""
+    if db.get_bind().dialect.name == "postgresql":
+        return pg_insert(table)
+    return sqlite_insert(table)
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Timestamps are stored as naive UTC (datetime.utcnow); convert aware client values."""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _insert_movements(db, rows: List[dict]) -> List[dict]:
+    """
+    Insert movement rows with one executemany and apply their side effects (stock balance, ...)
+    inside the caller's transaction. The caller commits. Returns the rows with their new `id`.
+    """
+    if not rows:
+        return []
+    now = datetime.utcnow()
+    params = []
+    for r in rows:
+        p = {f: r.get(f) for f in _MOVEMENT_FIELDS}
+        p["moved_at"] = _naive_utc(p["moved_at"]) or now
+        p["created_at"] = p["created_at"] or now
+        params.append(p)
+    _start_batch(db)
+    if db.get_bind().dialect.name == "sqlite":
+        # Rowids are handed out in VALUES order under SQLite's write lock, so sorted ids line up with
+        # params; asking for sort_by_parameter_order there makes SQLAlchemy fall back to one INSERT per row
+        ids = sorted(db.execute(insert(_mv).returning(_mv.c.id), params).scalars().all())
+    else:
+        ids = db.execute(insert(_mv).returning(_mv.c.id, sort_by_parameter_order=True), params).scalars().all()
+    for p, new_id in zip(params, ids):
+        p["id"] = new_id
+    db.execute(insert(_batch), [{"id": i} for i in ids])
+    _on_movements_written(db)
+    return params
+
+def _insert_movements_from(db, source, columns: List[str]) -> int:
+    """
+    Bulk form of _insert_movements: INSERT ... SELECT the movements `source` yields (in `columns`
+    order) and apply the same side effects. The caller commits. Returns how many were written.
+    """
+    _start_batch(db)
+    if db.get_bind().dialect.name == "sqlite":
+        # The INSERT needs the write lock, and SQLite refuses it if anyone wrote since this read,
+        # so every id above the current max is ours
+        last = db.execute(select(func.max(_mv.c.id))).scalar() or 0
+        db.execute(insert(_mv).from_select(columns, source))
+        written = db.execute(insert(_batch).from_select(["id"], select(_mv.c.id).where(_mv.c.id > last))).rowcount
+    else:
+        ids = db.execute(insert(_mv).from_select(columns, source).returning(_mv.c.id)).scalars().all()
+        if ids:
+            db.execute(insert(_batch), [{"id": i} for i in ids])
+        written = len(ids)
+    if written:
+        _on_movements_written(db)
+    return written
+
+def _start_batch(db):
+    db.execute(text(_BATCH_DDL))
+    db.execute(delete(_batch))
+
+def _on_movements_written(db):
+    """Side effects of the movements in movement_batch; the caller commits."""
+    product_ids = _apply_batch_stock(db)
+    _sync_discrepancies(db, product_ids)
+    _adjust_snapshots(db)
+    _apply_cost_layers(db)
+    _apply_rollups(db)
+    _bump_versions(db, "movements", "products")
+
+def _apply_batch_stock(db) -> List[int]:
+    """
+    Add each product's net batch movement to Product.stock with one UPDATE ... FROM. The rows are
+    locked in id order first (a no-op on SQLite), so writers to overlapping products can't deadlock.
+    Returns the batch's product ids.
+    """
+    t = Product.__table__
+    touched = select(_mv.c.product_id).select_from(_BATCH_MOVES)
+    ids = db.execute(select(t.c.id).where(t.c.id.in_(touched)).order_by(t.c.id).with_for_update()).scalars().all()
+    net = (select(_mv.c.product_id, func.sum(_MV_SIGNED).label("delta"))
+           .select_from(_BATCH_MOVES).group_by(_mv.c.product_id).subquery())
+    db.execute(update(t).where(t.c.id == net.c.product_id, net.c.delta != 0)
+               .values(stock=func.coalesce(t.c.stock, 0) + net.c.delta))
+    return ids
+
+def _apply_stock_deltas(db, deltas: dict):
+    """Bump Product.stock by {product_id: delta} in a single executemany UPDATE."""
+    params = [{"pid": pid, "delta": d} for pid, d in sorted(deltas.items()) if d]
+    if not params:
+        return
+    t = Product.__table__
+    db.execute(
+        update(t).where(t.c.id == bindparam("pid")).values(stock=func.coalesce(t.c.stock, 0) + bindparam("delta")),
+        params,
+    )
+
+# ---------- Discrepancy index ----------
+_SYNC_CHUNK = 2000
+
+def _detect_discrepancies(unit_cost, stock, min_stock, max_stock):
+    stock = stock or 0
+    found = []
+    if (unit_cost is None or unit_cost == 0) and stock > 0:
+        found.append(("UNIT_COST_MISSING", "Stock > 0 pero unit_cost nulo o 0"))
+    if min_stock is not None and stock < min_stock:
+        found.append(("BELOW_MIN_STOCK", f"Stock {stock} < Min {min_stock}"))
+    if max_stock is not None and stock > max_stock:
+        found.append(("ABOVE_MAX_STOCK", f"Stock {stock} > Max {max_stock}"))
+    return found
+
+def _same_cost(a, b) -> bool:
+    if a is None or b is None:
+        return a is b
+    return abs(a - b) <= 1e-9 * max(1.0, abs(a), abs(b))
+
+def _sync_discrepancies(db, product_ids=None):
+    """
+    Re-evaluate the discrepancy rules for `product_ids` (all products when None) and bring
+    open_discrepancies in line with a handful of set-based statements per chunk.
+    """
+    if product_ids is None:
+        ids = [r[0] for r in db.query(Product.id).order_by(Product.id)]
+    else:
+        ids = sorted(set(product_ids))
+    t = OpenDiscrepancy.__table__
+    now = datetime.utcnow()
+    # Only products some rule could flag (no cost, or a min/max set) or that already have rows are read
+    maybe = or_(Product.unit_cost.is_(None), Product.unit_cost == 0,
+                Product.min_stock.isnot(None), Product.max_stock.isnot(None))
+    for i in range(0, len(ids), _SYNC_CHUNK):
+        chunk = ids[i:i + _SYNC_CHUNK]
+        existing = {(r.product_id, r.discrepancy_type): r
+                    for r in db.execute(select(t.c.id, t.c.product_id, t.c.discrepancy_type, t.c.detail,
+                                               t.c.stock_at, t.c.unit_cost_at, t.c.status)
+                                        .where(t.c.product_id.in_(chunk)))}
+        listed = sorted({pid for pid, _ in existing})
+        products = db.query(Product.id, Product.unit_cost, Product.stock, Product.min_stock, Product.max_stock)\
+                     .filter(Product.id.in_(chunk), or_(maybe, Product.id.in_(listed)) if listed else maybe).all()
+        inserts, updates, keep = [], [], set()
+        for pid, unit_cost, stock, min_stock, max_stock in products:
+            for dtype, detail in _detect_discrepancies(unit_cost, stock, min_stock, max_stock):
+                keep.add((pid, dtype))
+                row = existing.get((pid, dtype))
+                if row is None:
+                    inserts.append(dict(product_id=pid, discrepancy_type=dtype, detail=detail, stock_at=stock or 0,
+                                        unit_cost_at=unit_cost, status="OPEN", detected_at=now, resolution_id=None))
+                elif row.stock_at != (stock or 0) or not _same_cost(row.unit_cost_at, unit_cost) or row.detail != detail:
+                    # Values moved: refresh the snapshot and reopen if it had been resolved
+                    updates.append(dict(did=row.id, detail=detail, stock_at=stock or 0, unit_cost_at=unit_cost,
+                                        status="OPEN", resolution_id=None))
+        stale = [r.id for key, r in existing.items() if key not in keep]
+        if stale:
+            db.execute(t.delete().where(t.c.id.in_(stale)))
+        if updates:
+            db.execute(t.update().where(t.c.id == bindparam("did"))
+                        .values(detail=bindparam("detail"), stock_at=bindparam("stock_at"),
+                                unit_cost_at=bindparam("unit_cost_at"), status=bindparam("status"),
+                                resolution_id=bindparam("resolution_id")), updates)
+        if inserts:
+            db.execute(insert(t), inserts)
+
+def _discrepancies_query(db, discrepancy_type: Optional[str], status: str = "OPEN"):
+    q = (db.query(OpenDiscrepancy.product_id, Product.id_code, Product.description, OpenDiscrepancy.discrepancy_type,
+                  OpenDiscrepancy.detail, OpenDiscrepancy.stock_at, OpenDiscrepancy.unit_cost_at)
+           .join(Product, Product.id == OpenDiscrepancy.product_id)
+           .filter(OpenDiscrepancy.status == status))
+    if discrepancy_type:
+        q = q.filter(OpenDiscrepancy.discrepancy_type == discrepancy_type)
+    return q.order_by(OpenDiscrepancy.discrepancy_type, OpenDiscrepancy.product_id)
+
+def _verify_stock_balances(db):
+    """Products whose materialized stock disagrees with the ledger: (id, id_code, stock, ledger_stock)."""
+    subq = _current_stock_subquery(db)
+    ledger = func.coalesce(subq.c.stock, 0)
+    return (db.query(Product.id, Product.id_code, Product.stock, ledger.label("ledger_stock"))
+              .outerjoin(subq, subq.c.product_id == Product.id)
+              .filter(func.coalesce(Product.stock, 0) != ledger)
+              .order_by(Product.id)
+              .all())
+
+def _rebuild_stock_balances(db) -> int:
+    """Reset drifted Product.stock values to the ledger sum. Returns how many rows were fixed."""
+    drift = _verify_stock_balances(db)
+    if drift:
+        t = Product.__table__
+        db.execute(update(t).where(t.c.id == bindparam("pid")).values(stock=bindparam("ledger")),
+                   [{"pid": r[0], "ledger": int(r[3] or 0)} for r in drift])
+        _sync_discrepancies(db, [r[0] for r in drift])
+        _bump_versions(db, "products")
+    db.commit()
+    return len(drift)
+
+# ---------- Stock snapshots / point-in-time balances ----------
+_snap_lines = StockSnapshotLine.__table__
+
+def _movement_delta_select(since: Optional[datetime], until: datetime):
+    """(product_id, warehouse_id, quantity) per key for movements with since <= moved_at < until."""
+    q = select(_mv.c.product_id, _MV_WAREHOUSE.label("warehouse_id"), func.sum(_MV_SIGNED).label("quantity"))\
+        .where(_mv.c.moved_at < until)
+    if since is not None:
+        q = q.where(_mv.c.moved_at >= since)
+    return q.group_by(_mv.c.product_id, _MV_WAREHOUSE)
+
+def _snapshot_before(db, at: datetime, inclusive: bool = True):
+    """Latest snapshot taken at or before `at` (strictly before when not inclusive), or None."""
+    q = db.query(StockSnapshot).filter(StockSnapshot.taken_at <= at if inclusive else StockSnapshot.taken_at < at)
+    return q.order_by(StockSnapshot.taken_at.desc()).first()
+
+def _take_snapshot(db, taken_at: datetime) -> StockSnapshot:
+    """
+    Checkpoint balances as of `taken_at` (idempotent). Starts from the previous snapshot and only
+    reads the movements in between, so a backfill walks the ledger once. The caller commits.
+    """
+    snap = db.query(StockSnapshot).filter(StockSnapshot.taken_at == taken_at).first()
+    if snap:
+        return snap
+    prev = _snapshot_before(db, taken_at, inclusive=False)
+    snap = StockSnapshot(taken_at=taken_at)
+    db.add(snap)
+    db.flush()
+    parts = _movement_delta_select(prev.taken_at if prev else None, taken_at)
+    if prev:
+        parts = parts.union_all(select(_snap_lines.c.product_id, _snap_lines.c.warehouse_id, _snap_lines.c.quantity)
+                                .where(_snap_lines.c.snapshot_id == prev.id)).subquery()
+    else:
+        parts = parts.subquery()
+    total = func.sum(parts.c.quantity)
+    db.execute(insert(_snap_lines).from_select(
+        ["snapshot_id", "product_id", "warehouse_id", "quantity"],
+        select(literal_column(str(snap.id)), parts.c.product_id, parts.c.warehouse_id, total)
+        .group_by(parts.c.product_id, parts.c.warehouse_id).having(total != 0)))
+    return snap
+
+def _adjust_snapshots(db):
+    """
+    Keep snapshots exact when movements are backdated: add the batch's net delta to every snapshot
+    taken after its moved_at. Movements dated now match no snapshot and cost one indexed lookup.
+    """
+    snaps = StockSnapshot.__table__
+    oldest = select(func.min(_mv.c.moved_at)).select_from(_BATCH_MOVES).scalar_subquery()
+    if db.execute(select(snaps.c.id).where(snaps.c.taken_at > oldest).limit(1)).first() is None:
+        return
+    lines = (select(snaps.c.id, _mv.c.product_id, _MV_WAREHOUSE, func.sum(_MV_SIGNED))
+             .select_from(_BATCH_MOVES.join(snaps, snaps.c.taken_at > _mv.c.moved_at))
+             .where(true())  # SQLite needs a WHERE before ON CONFLICT in INSERT ... SELECT
+             .group_by(snaps.c.id, _mv.c.product_id, _MV_WAREHOUSE)
+             .having(func.sum(_MV_SIGNED) != 0))
+    stmt = _dialect_insert(db, _snap_lines).from_select(["snapshot_id", "product_id", "warehouse_id", "quantity"],
+                                                        lines)
+    db.execute(stmt.on_conflict_do_update(index_elements=["snapshot_id", "product_id", "warehouse_id"],
+                                          set_={"quantity": _snap_lines.c.quantity + stmt.excluded.quantity}))
+
+def _ledger_balance_subquery(db, full: bool = False):
+    """
+    Ledger stock per product (product_id, quantity): the latest snapshot plus the movements since,
+    or a scan of the whole ledger when `full` or there is no snapshot. Returns (subquery, snapshot).
+    """
+    snap = None if full else db.query(StockSnapshot).order_by(StockSnapshot.taken_at.desc()).first()
+    moves = select(_mv.c.product_id, func.sum(_MV_SIGNED).label("quantity"))
+    if snap is None:
+        return moves.group_by(_mv.c.product_id).subquery(), None
+    moves = moves.where(_mv.c.moved_at >= snap.taken_at).group_by(_mv.c.product_id)
+    lines = select(_snap_lines.c.product_id, func.sum(_snap_lines.c.quantity).label("quantity"))\
+            .where(_snap_lines.c.snapshot_id == snap.id).group_by(_snap_lines.c.product_id)
+    parts = moves.union_all(lines).subquery()
+    return (select(parts.c.product_id, func.sum(parts.c.quantity).label("quantity"))
+            .group_by(parts.c.product_id).subquery()), snap
+
+_STOCK_AS_OF_FIELDS = ("product_id", "id_code", "description", "warehouse_id", "stock")
+
+def _stock_as_of(db, at: datetime, product_id: Optional[int] = None, warehouse_id: Optional[int] = None,
+                 by_warehouse: bool = False):
+    """
+    Balances left by movements with moved_at < `at`: nearest snapshot at or before `at` plus the
+    movements since it. Returns (rows in _STOCK_AS_OF_FIELDS order, snapshot or None).
+    """
+    snap = _snapshot_before(db, at)
+    parts = _movement_delta_select(snap.taken_at if snap else None, at)
+    if product_id is not None:
+        parts = parts.where(_mv.c.product_id == product_id)
+    if warehouse_id is not None:
+        parts = parts.where(_MV_WAREHOUSE == warehouse_id)
+    if snap:
+        lines = select(_snap_lines.c.product_id, _snap_lines.c.warehouse_id, _snap_lines.c.quantity)\
+                .where(_snap_lines.c.snapshot_id == snap.id)
+        if product_id is not None:
+            lines = lines.where(_snap_lines.c.product_id == product_id)
+        if warehouse_id is not None:
+            lines = lines.where(_snap_lines.c.warehouse_id == warehouse_id)
+        parts = parts.union_all(lines)
+    parts = parts.subquery()
+    total = func.sum(parts.c.quantity)
+    if by_warehouse:
+        wh = parts.c.warehouse_id
+    else:
+        wh = literal_column(str(int(warehouse_id)) if warehouse_id is not None else "NULL")
+    group = [Product.id, Product.id_code, Product.description] + ([parts.c.warehouse_id] if by_warehouse else [])
+    q = (db.query(Product.id, Product.id_code, Product.description, wh, total)
+           .join(parts, parts.c.product_id == Product.id)
+           .group_by(*group))
+    if product_id is None:
+        q = q.having(total != 0)
+    rows = q.order_by(Product.id_code, *([parts.c.warehouse_id] if by_warehouse else [])).all()
+    return rows, snap
+
+# ---------- FIFO cost layers ----------
+_layers_t = CostLayer.__table__
+_mcost_t = MovementCost.__table__
+_COST_CHUNK = 2000
+_COST_FLUSH_ROWS = 20_000
+
+def _cost_neutral_ids(moves) -> set:
+    """
+    Ids of transfer OUT/IN pairs (consecutive for the product, same quantity): the goods only change
+    warehouse, so they keep their layer and their age.
+    """
+    ids = set()
+    if not any(m["movement_reason"] == "transfer" for m in moves):
+        return ids
+    for a, b in zip(moves, moves[1:]):
+        if (a["movement_reason"] == b["movement_reason"] == "transfer" and a["id"] not in ids
+                and a["movement_type"] == "OUT" and b["movement_type"] == "IN" and a["quantity"] == b["quantity"]):
+            ids.update((a["id"], b["id"]))
+    return ids
+
+def _fifo_apply(layers: list, mv: dict, fallback_cost):
+    """
+    Apply one movement to a product's `layers`, in place. Layers are lists
+    [received_at, id, unit_cost, remaining, movement_id, quantity, loaded_remaining] kept oldest first.
+    Receipts first cover any negative layer, issues draw from the oldest positive ones. Returns the
+    movement_costs row for an issue, else None.
+    """
+    delta = _movement_delta(mv["movement_type"], mv["quantity"])
+    if delta > 0:
+        for layer in layers:
+            if delta == 0:
+                break
+            if layer[3] < 0:
+                take = min(delta, -layer[3])
+                layer[3] += take
+                delta -= take
+        if delta > 0:
+            cost = mv["unit_cost"] if mv.get("unit_cost") is not None else fallback_cost
+            bisect.insort(layers, [mv["moved_at"], None, float(cost or 0), delta, mv["id"], delta, None],
+                          key=lambda l: l[0])
+        return None
+    if delta == 0:
+        return None
+    need, total = -delta, 0.0
+    for layer in layers:
+        if need == 0:
+            break
+        if layer[3] > 0:
+            take = min(need, layer[3])
+            layer[3] -= take
+            need -= take
+            total += take * layer[2]
+    if need:
+        cost = float(fallback_cost or 0)
+        total += need * cost
+        bisect.insort(layers, [mv["moved_at"], None, cost, -need, mv["id"], -need, None], key=lambda l: l[0])
+    return {"movement_id": mv["id"], "product_id": mv["product_id"], "quantity": -delta, "cost": total,
+            "estimated_quantity": need}
+
+def _save_layers(db, layers_by_product: dict):
+    """Write back what _fifo_apply changed: new layers, new remaining values, exhausted layers removed."""
+    inserts, updates, deletes = [], [], []
+    for pid, layers in layers_by_product.items():
+        for received_at, lid, unit_cost, remaining, movement_id, quantity, loaded in layers:
+            if lid is None:
+                if remaining:
+                    inserts.append({"product_id": pid, "movement_id": movement_id, "received_at": received_at,
+                                    "unit_cost": unit_cost, "quantity": quantity, "remaining": remaining})
+            elif remaining == 0:
+                deletes.append(lid)
+            elif remaining != loaded:
+                updates.append({"lid": lid, "rem": remaining})
+    for i in range(0, len(deletes), _COST_CHUNK):
+        db.execute(delete(_layers_t).where(_layers_t.c.id.in_(deletes[i:i + _COST_CHUNK])))
+    if updates:
+        db.execute(update(_layers_t).where(_layers_t.c.id == bindparam("lid")).values(remaining=bindparam("rem")),
+                   updates)
+    if inserts:
+        db.execute(insert(_layers_t), inserts)
+
+def _apply_cost_layers(db):
+    """
+    Run the batch through its products' FIFO layers and record the cost of each issue. Receipts into
+    products with no issue in the batch and no negative layer (most of an import) just open a layer
+    each, written with one INSERT ... SELECT; the other products go through _fifo_apply. Product
+    rows were just locked by _apply_batch_stock, so writers to one product serialize here.
+    """
+    issuing = (select(_mv.c.product_id).select_from(_BATCH_MOVES)
+               .group_by(_mv.c.product_id).having(func.min(_MV_SIGNED) < 0))
+    owing = select(_layers_t.c.product_id).where(_layers_t.c.product_id == _mv.c.product_id,
+                                                 _layers_t.c.remaining < 0).exists()
+    needs_fifo = or_(_mv.c.product_id.in_(issuing), owing)
+    db.execute(insert(_layers_t).from_select(
+        ["product_id", "movement_id", "received_at", "unit_cost", "quantity", "remaining"],
+        select(_mv.c.product_id, _mv.c.id, _mv.c.moved_at, func.coalesce(_mv.c.unit_cost, Product.unit_cost, 0.0),
+               _mv.c.quantity, _mv.c.quantity)
+        .select_from(_BATCH_MOVES.join(Product.__table__, Product.id == _mv.c.product_id))
+        .where(_MV_SIGNED > 0, ~needs_fifo).order_by(_mv.c.id)))
+    by_product = {}
+    for r in db.execute(select(_mv.c.id, _mv.c.product_id, _mv.c.movement_type, _mv.c.movement_reason,
+                               _mv.c.quantity, _mv.c.unit_cost, _mv.c.moved_at)
+                        .select_from(_BATCH_MOVES).where(needs_fifo).order_by(_mv.c.id)).mappings():
+        by_product.setdefault(r["product_id"], []).append(dict(r))
+    work = {}
+    for pid, moves in by_product.items():
+        neutral = _cost_neutral_ids(moves)
+        moves = [m for m in moves if m["id"] not in neutral]
+        if moves:
+            work[pid] = moves
+    if not work:
+        return
+    pids = sorted(work)
+    layers, fallback = {pid: [] for pid in pids}, {}
+    for i in range(0, len(pids), _COST_CHUNK):
+        chunk = pids[i:i + _COST_CHUNK]
+        for r in db.execute(select(_layers_t.c.product_id, _layers_t.c.received_at, _layers_t.c.id,
+                                   _layers_t.c.unit_cost, _layers_t.c.remaining, _layers_t.c.movement_id,
+                                   _layers_t.c.quantity)
+                            .where(_layers_t.c.product_id.in_(chunk))
+                            .order_by(_layers_t.c.product_id, _layers_t.c.received_at, _layers_t.c.id)):
+            layers[r[0]].append([r[1], r[2], r[3], r[4], r[5], r[6], r[4]])
+        fallback.update(db.execute(select(Product.id, Product.unit_cost).where(Product.id.in_(chunk))).all())
+    costs = []
+    for pid in pids:
+        for m in work[pid]:
+            c = _fifo_apply(layers[pid], m, fallback.get(pid))
+            if c:
+                costs.append(c)
+    _save_layers(db, layers)
+    if costs:
+        db.execute(insert(_mcost_t), costs)
+
+def _rebuild_cost_layers(db) -> tuple:
+    """
+    Recompute every cost layer and movement cost from the ledger: one streaming pass, product by
+    product in id order (the order the incremental path sees). Returns (products, movements).
+    """
+    db.execute(delete(_mcost_t))
+    db.execute(delete(_layers_t))
+    fallback = dict(db.execute(select(Product.id, Product.unit_cost)).all())
+    mv = InventoryMovement
+    stream = db.execute(select(mv.id, mv.product_id, mv.movement_type, mv.movement_reason, mv.quantity,
+                               mv.unit_cost, mv.moved_at).order_by(mv.product_id, mv.id)
+                        .execution_options(yield_per=_COST_FLUSH_ROWS)).mappings()
+    products = movements = 0
+    pending, costs, pending_rows = {}, [], 0
+    for pid, group in itertools.groupby(stream, key=lambda r: r["product_id"]):
+        moves = [dict(r) for r in group]
+        neutral = _cost_neutral_ids(moves)
+        layers = []
+        for m in moves:
+            if m["id"] not in neutral:
+                c = _fifo_apply(layers, m, fallback.get(pid))
+                if c:
+                    costs.append(c)
+        pending[pid] = layers
+        products += 1
+        movements += len(moves)
+        pending_rows += len(moves)
+        if pending_rows >= _COST_FLUSH_ROWS:
+            _save_layers(db, pending)
+            if costs:
+                db.execute(insert(_mcost_t), costs)
+            pending, costs, pending_rows = {}, [], 0
+    _save_layers(db, pending)
+    if costs:
+        db.execute(insert(_mcost_t), costs)
+    _bump_versions(db, "movements")
+    db.commit()
+    return products, movements
+
+# ---------- Movement rollups ----------
+_rollup_t = MovementRollup.__table__
+_ROLLUP_KEY = ["day", "product_id", "movement_type", "movement_reason"]
+
+def _rollup_select(db, source, *criteria):
+    """Rollup rows (_ROLLUP_KEY + quantity, value, cost, movements) for the movements in `source`."""
+    day = cast(func.date(_mv.c.moved_at), Date) if db.get_bind().dialect.name == "postgresql" \
+        else func.date(_mv.c.moved_at)
+    reason = func.coalesce(_mv.c.movement_reason, "")
+    return select(
+        day, _mv.c.product_id, _mv.c.movement_type, reason, func.sum(_mv.c.quantity),
+        func.sum(_mv.c.quantity * func.coalesce(_mv.c.unit_cost, 0)), func.sum(func.coalesce(_mcost_t.c.cost, 0)),
+        func.count()
+    ).select_from(source.outerjoin(_mcost_t, _mcost_t.c.movement_id == _mv.c.id))\
+     .where(_mv.c.moved_at.isnot(None), *criteria).group_by(day, _mv.c.product_id, _mv.c.movement_type, reason)
+
+def _apply_rollups(db):
+    """Add the batch to its days' rollup rows with one INSERT ... SELECT upsert."""
+    stmt = _dialect_insert(db, _rollup_t).from_select(_ROLLUP_KEY + ["quantity", "value", "cost", "movements"],
+                                                      _rollup_select(db, _BATCH_MOVES))
+    db.execute(stmt.on_conflict_do_update(index_elements=_ROLLUP_KEY, set_={
+        "quantity": _rollup_t.c.quantity + stmt.excluded.quantity,
+        "value": _rollup_t.c.value + stmt.excluded.value,
+        "cost": _rollup_t.c.cost + stmt.excluded.cost,
+        "movements": _rollup_t.c.movements + stmt.excluded.movements,
+    }))
+
+def _rebuild_rollups(db, date_from: Optional[date] = None, date_to: Optional[date] = None) -> int:
+    """
+    Catch-up: recompute the rollup rows for [date_from, date_to] (whole ledger when open) from
+    inventory_movements and movement_costs. Returns the number of rollup rows written.
+    """
+    clear, criteria = delete(_rollup_t), []
+    if date_from:
+        clear = clear.where(_rollup_t.c.day >= date_from)
+        criteria.append(_mv.c.moved_at >= datetime.combine(date_from, datetime.min.time()))
+    if date_to:
+        clear = clear.where(_rollup_t.c.day <= date_to)
+        criteria.append(_mv.c.moved_at < datetime.combine(date_to, datetime.min.time()) + timedelta(days=1))
+    db.execute(clear)
+    written = db.execute(insert(_rollup_t).from_select(
+        _ROLLUP_KEY + ["quantity", "value", "cost", "movements"], _rollup_select(db, _mv, *criteria))).rowcount
+    _bump_versions(db, "movements")
+    db.commit()
+    return written
+
+def _period_start(db, bucket: str):
+    """First day of the day/week (Monday)/month bucket holding MovementRollup.day."""
+    col = _rollup_t.c.day
+    if bucket == "day":
+        return col
+    if db.get_bind().dialect.name == "postgresql":
+        return cast(func.date_trunc(bucket, col), Date)
+    if bucket == "week":
+        return func.date(col, "weekday 0", "-6 days")
+    return func.date(col, "start of month")
+
+# ---------- Keyset pagination ----------
+def _encode_cursor(*values) -> str:
+    """Opaque cursor for the last row of a page, e.g. (moved_at, id)."""
+    raw = json.dumps([v.isoformat() if isinstance(v, datetime) else v for v in values])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def _decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != size \
+                or not all(isinstance(v, int) and not isinstance(v, bool) for v in values[1:]):
+            raise ValueError
+        return [datetime.fromisoformat(values[0])] + values[1:]
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Invalid cursor")
+
+def _keyset(query, cols, cursor: Optional[str], order: str):
+    """Order `query` by `cols` and, when a cursor is given, seek past the row it points to."""
+    return _seek(query, cols, _decode_cursor(cursor, len(cols)) if cursor else None, order)
+
+def _seek(query, cols, values: Optional[list], order: str):
+    """_keyset with the cursor already decoded (streamed exports decode it before the response starts)."""
+    desc = order.lower() != "asc"
+    if values:
+        key, values = tuple_(*cols), tuple_(*[bindparam(None, v, type_=c.type) for c, v in zip(cols, values)])
+        query = query.filter(key < values if desc else key > values)
+    return query.order_by(*[c.desc() if desc else c.asc() for c in cols])
+
+def _date_range(query, col, date_from: Optional[datetime], date_to: Optional[datetime]):
+    if date_from:
+        query = query.filter(col >= date_from)
+    if date_to:
+        query = query.filter(col <= date_to)
+    return query
+
+# ---------- CSV streaming ----------
+CSV_CHUNK_ROWS = 1000
+
+def _stream_query(build, chunk_rows: int = CSV_CHUNK_ROWS):
+    """
+    Yield the rows of `build(db)` fetched `chunk_rows` at a time (server-side cursor on Postgres).
+    Uses its own read session: the generator outlives the request's get_db() session.
+    """
+    db = ReadSessionLocal()
+    try:
+        yield from build(db).yield_per(chunk_rows)
+    finally:
+        db.close()
+
+def _csv_chunks(header, rows, chunk_rows: int = CSV_CHUNK_ROWS):
+    buf = io.StringIO()
+    w = _csv.writer(buf)
+    w.writerow(header)
+    yield buf.getvalue().encode("utf-8")  # first bytes go out before the query runs
+    buf.seek(0); buf.truncate(0)
+    for n, row in enumerate(rows, 1):
+        w.writerow(row)
+        if n % chunk_rows == 0:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0); buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+def _gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        yield z.compress(chunk) + z.flush(zlib.Z_SYNC_FLUSH)
+    yield z.flush()
+
+def _accepts_gzip(request: Request) -> bool:
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding.strip().lower() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+def _csv_response(request: Request, filename: str, header, rows):
+    """StreamingResponse that encodes `rows` incrementally, gzip-compressed when the client accepts it."""
+    chunks = _csv_chunks(header, rows)
+    headers = {"Content-Disposition": f"attachment; filename={filename}", "Vary": "Accept-Encoding"}
+    if _accepts_gzip(request):
+        chunks = _gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, media_type="text/csv", headers=headers)
+
+# ---------- Product search ----------
+# SQLite: FTS5 external-content index (ranked, prefix) plus an FTS5 trigram table (substring), both kept in
+# sync by triggers on products.
+# Postgres: unaccented tsvector (ranked, prefix) and trigram (substring) expression indexes.
+_SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+           id_code, description, content='products', content_rowid='id',
+           tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+           INSERT INTO products_fts(rowid, id_code, description) VALUES (new.id, new.id_code, new.description);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+           INSERT INTO products_fts(products_fts, rowid, id_code, description)
+           VALUES ('delete', old.id, old.id_code, old.description);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF id_code, description ON products BEGIN
+           INSERT INTO products_fts(products_fts, rowid, id_code, description)
+           VALUES ('delete', old.id, old.id_code, old.description);
+           INSERT INTO products_fts(rowid, id_code, description) VALUES (new.id, new.id_code, new.description);
+       END""",
+]
+# Same document as _PG_SEARCH_DOC. The trigram tokenizer needs SQLite >= 3.34 and only drops accents from
+# 3.45 on; older builds match substrings case-insensitively but accent-sensitively.
+_SQLITE_TRGM_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS products_trgm USING fts5(doc, tokenize='{}')"
+_SQLITE_TRGM_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS products_trgm_ai AFTER INSERT ON products BEGIN
+           INSERT INTO products_trgm(rowid, doc) VALUES (new.id, new.id_code || ' ' || new.description);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_trgm_ad AFTER DELETE ON products BEGIN
+           DELETE FROM products_trgm WHERE rowid = old.id;
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS products_trgm_au AFTER UPDATE OF id_code, description ON products BEGIN
+           UPDATE products_trgm SET doc = new.id_code || ' ' || new.description WHERE rowid = new.id;
+       END""",
+]
+_PG_SEARCH_DOC = "f_unaccent(lower(id_code || ' ' || description))"
+_PG_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    # unaccent() is only STABLE; index expressions need an IMMUTABLE wrapper
+    """CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+       AS $$ SELECT public.unaccent('public.unaccent', $1) $$""",
+    f"CREATE INDEX IF NOT EXISTS ix_products_search_tsv ON products USING gin (to_tsvector('simple', {_PG_SEARCH_DOC}))",
+    f"CREATE INDEX IF NOT EXISTS ix_products_search_trgm ON products USING gin ({_PG_SEARCH_DOC} gin_trgm_ops)",
+]
+_FTS_HASHSIZE = 64 * 1024 * 1024  # bytes of pending FTS5 changes held in memory before a segment is written
+_products_fts = table("products_fts", column("rowid"), column("rank"))
+_products_trgm = table("products_trgm", column("rowid"))
+_search_backend = None  # "sqlite", "postgresql" or None (LIKE fallback); set by _ensure_search_index()
+_search_trigram = False  # SQLite only: products_trgm is available for substring matches
+_SEARCH_ERR = ""
+
+def _fts_hashsize(conn, name: str):
+    # Bulk fills and big imports write far fewer segments (and merges) with a large buffer.
+    try:
+        conn.execute(text(f"INSERT INTO {name}({name}, rank) VALUES ('hashsize', {_FTS_HASHSIZE})"))
+    except Exception:  # option unknown to this SQLite build; it is only a speed-up
+        pass
+
+def _ensure_sqlite_trigram() -> bool:
+    for tokenize in ("trigram remove_diacritics 1", "trigram"):
+        try:
+            with engine.begin() as conn:
+                created = not inspect(conn).has_table("products_trgm")
+                conn.execute(text(_SQLITE_TRGM_TABLE.format(tokenize)))
+                for stmt in _SQLITE_TRGM_DDL:
+                    conn.execute(text(stmt))
+                if created:
+                    _fts_hashsize(conn, "products_trgm")
+                    conn.execute(text("INSERT INTO products_trgm(rowid, doc) "
+                                      "SELECT id, id_code || ' ' || description FROM products"))
+            return True
+        except Exception:  # tokenizer option (or trigram itself) not supported by this SQLite build
+            continue
+    return False
+
+def _ensure_search_index():
+    global _search_backend, _search_trigram, _SEARCH_ERR
+    dialect = engine.dialect.name
+    ddl = {"sqlite": _SQLITE_SEARCH_DDL, "postgresql": _PG_SEARCH_DDL}.get(dialect)
+    if not ddl:
+        return
+    try:
+        with engine.begin() as conn:
+            created = dialect == "sqlite" and not inspect(conn).has_table("products_fts")
+            for stmt in ddl:
+                conn.execute(text(stmt))
+            if created:
+                _fts_hashsize(conn, "products_fts")
+                conn.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+        _search_backend = dialect
+    except Exception as e:  # e.g. SQLite built without FTS5, no rights to CREATE EXTENSION
+        _search_backend, _SEARCH_ERR = None, str(e)
+    if _search_backend == "sqlite":
+        _search_trigram = _ensure_sqlite_trigram()
+
+def _drop_search_index():
+    """
+    SQLite only: drop the search tables and their triggers so a bulk load inserts products unindexed.
+    _ensure_search_index() rebuilds them in one pass (also on the next start if the load dies half-way).
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        for name in ("products_fts", "products_trgm"):
+            for trigger in ("ai", "ad", "au"):
+                conn.execute(text(f"DROP TRIGGER IF EXISTS {name}_{trigger}"))
+            conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+
+def _product_search(query, q: str):
+    """
+    Restrict a Product query to rows matching `q`: every word as a prefix (accent-insensitive), or `q` as a
+    substring of "id_code description" (`2345` finds `CAL12345`). Both backends match the same rows.
+    Returns (query, relevance); ordering by `relevance` ascending puts the best matches first and
+    substring-only hits last. relevance is None when falling back to LIKE.
+    """
+    words = re.findall(r"\w+", q)
+    if words and _search_backend == "sqlite":
+        match = " ".join(f'"{w}"*' for w in words)
+        prefix = (select(_products_fts.c.rowid.label("product_id"), _products_fts.c.rank)
+                  .where(literal_column("products_fts").op("MATCH")(match)))
+        needle = q.strip()
+        if _search_trigram and len(needle) >= 3:  # trigram MATCH needs at least one trigram
+            substring = (select(_products_trgm.c.rowid, literal(0.0))
+                         .where(literal_column("products_trgm").op("MATCH")('"' + needle.replace('"', '""') + '"')))
+        else:
+            substring = (select(Product.id, literal(0.0))
+                         .where(Product.id_code.concat(" ").concat(Product.description).like(f"%{needle}%")))
+        both = union_all(prefix, substring).subquery()
+        hits = (select(both.c.product_id, func.min(both.c.rank).label("rank"))
+                .group_by(both.c.product_id).subquery())
+        return query.join(hits, hits.c.product_id == Product.id), hits.c.rank
+    if words and _search_backend == "postgresql":
+        doc = literal_column(_PG_SEARCH_DOC)
+        tsv = func.to_tsvector(literal_column("'simple'"), doc)
+        tsq = func.to_tsquery(literal_column("'simple'"), func.f_unaccent(" & ".join(f"{w}:*" for w in words)))
+        substring = doc.like(func.concat("%", func.f_unaccent(func.lower(q.strip())), "%"))
+        return query.filter(or_(tsv.op("@@")(tsq), substring)), -func.ts_rank(tsv, tsq)
+    like = f"%{q}%"
+    return query.filter(or_(Product.id_code.like(like), Product.description.like(like))), None
+
+def _require_sales_role(user: Principal):
     if user.role not in ("admin", "sales"):
         raise HTTPException(403, f"Role '{user.role}' no puede crear ventas")
     
@@ -426,18 +1530,140 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Count", "ETag", "X-Snapshot-At"],
 )
 
+# ---------- Metrics ----------
+# Per-request [statements, db seconds]; set by the middleware, filled by the engine hooks. Sync endpoints
+# run in the threadpool with a copy of the context, which still points at the same list.
+_request_db = ContextVar("request_db", default=None)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _db_timer_start(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _db_timer_stop(conn, cursor, statement, parameters, context, executemany):
+    stats = _request_db.get()
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += time.perf_counter() - context._metrics_started
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets):
+        self.buckets, self.counts, self.total, self.count = buckets, [0] * len(buckets), 0.0, 0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)  # upper bounds are inclusive (le)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+# Only touched from the event loop thread (middleware and the async /metrics route): no lock needed
+_metrics = {"in_flight": 0, "latency": {}, "statements": {}, "requests": {}, "db_seconds": {}, "slow": {}}
+
+class _MetricsMiddleware:
+    """
+    Pure ASGI middleware: per-route latency and SQL statement histograms, status counts, DB time and
+    in-flight requests. Routes are labelled by their path template (`/products/{id}`), so ids don't
+    blow up the series. Requests over SLOW_REQUEST_MS or SLOW_REQUEST_QUERIES are logged.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats, status_code = [0, 0.0], [500]
+        token = _request_db.set(stats)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status_code[0] = message["status"]
+            await send(message)
+
+        _metrics["in_flight"] += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            _metrics["in_flight"] -= 1
+            _request_db.reset(token)
+            route = scope.get("route")
+            key = (scope["method"], getattr(route, "path", None) or "<unmatched>")
+            _metrics["latency"].setdefault(key, _Histogram(_LATENCY_BUCKETS)).observe(elapsed)
+            _metrics["statements"].setdefault(key, _Histogram(_STATEMENT_BUCKETS)).observe(stats[0])
+            _metrics["db_seconds"][key] = _metrics["db_seconds"].get(key, 0.0) + stats[1]
+            status_key = key + (str(status_code[0]),)
+            _metrics["requests"][status_key] = _metrics["requests"].get(status_key, 0) + 1
+            if elapsed * 1000 > SLOW_REQUEST_MS or stats[0] > SLOW_REQUEST_QUERIES:
+                _metrics["slow"][key] = _metrics["slow"].get(key, 0) + 1
+                logger.warning("slow request %s %s (%s): %.0f ms, %d SQL statements, %.0f ms in DB, status %s",
+                               scope["method"], key[1], scope.get("path"), elapsed * 1000, stats[0],
+                               stats[1] * 1000, status_code[0])
+
+app.add_middleware(_MetricsMiddleware)
+
+def _prom_escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _prom_labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{_prom_escape(v)}"' for k, v in labels.items()) + "}"
+
+def _prom_histogram(lines: list, name: str, help_text: str, series: dict):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for (method, route), h in sorted(series.items()):
+        cumulative = 0
+        for le, n in zip(h.buckets, h.counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_prom_labels(method=method, route=route, le=le)} {cumulative}")
+        lines.append(f"{name}_bucket{_prom_labels(method=method, route=route, le='+Inf')} {h.count}")
+        lines.append(f"{name}_sum{_prom_labels(method=method, route=route)} {h.total}")
+        lines.append(f"{name}_count{_prom_labels(method=method, route=route)} {h.count}")
+
 # ---------- Startup: create tables (dev) ----------
 Base.metadata.create_all(bind=engine)
+_ensure_search_index()
+_ensure_data_versions()
 
 # ---------- Folders ----------
-os.makedirs("uploads/evidence", exist_ok=True)
+os.makedirs(EVIDENCE_DIR, exist_ok=True)
 
 # ---------- Routes ----------
 @app.get("/health")
 def health():
-    return {"status":"ok","time": datetime.utcnow().isoformat()}
+    return {"status":"ok","time": datetime.utcnow().isoformat(), "search": _search_backend or "like"}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus text exposition of this worker's request metrics (see _MetricsMiddleware)."""
+    lines = ["# HELP inventory_http_requests_in_flight Requests being served right now.",
+             "# TYPE inventory_http_requests_in_flight gauge",
+             f"inventory_http_requests_in_flight {_metrics['in_flight']}",
+             "# HELP inventory_http_requests_total Requests by route and status code.",
+             "# TYPE inventory_http_requests_total counter"]
+    lines += [f"inventory_http_requests_total{_prom_labels(method=m, route=r, status=st)} {n}"
+              for (m, r, st), n in sorted(_metrics["requests"].items())]
+    _prom_histogram(lines, "inventory_http_request_duration_seconds", "Request latency by route.",
+                    _metrics["latency"])
+    _prom_histogram(lines, "inventory_http_request_db_statements", "SQL statements per request by route.",
+                    _metrics["statements"])
+    lines += ["# HELP inventory_db_seconds_total Time spent in SQL statements by route.",
+              "# TYPE inventory_db_seconds_total counter"]
+    lines += [f"inventory_db_seconds_total{_prom_labels(method=m, route=r)} {v}"
+              for (m, r), v in sorted(_metrics["db_seconds"].items())]
+    lines += ["# HELP inventory_slow_requests_total Requests over SLOW_REQUEST_MS or SLOW_REQUEST_QUERIES.",
+              "# TYPE inventory_slow_requests_total counter"]
+    lines += [f"inventory_slow_requests_total{_prom_labels(method=m, route=r)} {n}"
+              for (m, r), n in sorted(_metrics["slow"].items())]
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 # Auth
 @app.post("/auth/register", response_model=UserOut)
@@ -453,35 +1679,95 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db=Depends(get_db)):
     user = db.query(User).filter(User.email == form_data.username).first()
     if not user or not verify_password(form_data.password, user.password_hash):
         raise HTTPException(400, "Incorrect username or password")
-    access_token = create_access_token(data={"sub": user.email})
+    access_token = create_access_token(data={"sub": user.email, "uid": user.id, "role": user.role,
+                                              "ver": user.token_version or 0})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/auth/me")
-def auth_me(user: User = Depends(get_current_user)):
+def auth_me(user: Principal = Depends(get_current_user)):
     return {"email": user.email, "role": user.role}
 
 # Product Types
+# ---------- Conditional GET / response cache ----------
+_response_cache = OrderedDict()  # etag -> (body, extra_headers)
+_response_cache_lock = threading.Lock()
+
+def _json_bytes(content) -> bytes:
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                      separators=(",", ":")).encode("utf-8")
+
+def _cached_json(request: Request, db, names, build, dump=_json_bytes) -> Response:
+    """
+    Serve `build()` -> (data, extra_headers) under a strong ETag derived from the route, its query
+    string and the data versions of `names`. A matching If-None-Match costs one version lookup
+    and gets a 304; otherwise the body comes from a small in-process LRU before running `build`.
+    """
+    versions = _data_versions(db, names)
+    key = hashlib.blake2b(repr((request.url.path, sorted(request.query_params.multi_items()), names, versions))
+                          .encode(), digest_size=16).hexdigest()
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    with _response_cache_lock:
+        hit = _response_cache.get(etag)
+        if hit is not None:
+            _response_cache.move_to_end(etag)
+    if hit is None:
+        data, extra = build()
+        hit = (dump(data), extra)
+        if len(hit[0]) <= RESPONSE_CACHE_MAX_BYTES:
+            with _response_cache_lock:
+                _response_cache[etag] = hit
+                while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                    _response_cache.popitem(last=False)
+    return Response(content=hit[0], media_type="application/json", headers={**headers, **hit[1]})
+
+def _model_dump(model):
+    adapter = TypeAdapter(List[model])
+    return lambda rows: adapter.dump_json(adapter.validate_python(rows, from_attributes=True))
+
+def _check_list_format(fmt: str):
+    if fmt not in ("rows", "columns"):
+        raise HTTPException(400, "format must be rows or columns")
+
+def _rows_json(fields, rows, fmt: str = "rows") -> bytes:
+    """
+    Row tuples (in `fields` order) straight to JSON bytes with pydantic-core's serializer, skipping
+    model validation. `columns` gives one array per field: {"id": [...], "id_code": [...], ...}.
+    """
+    if fmt == "columns":
+        return to_json(dict(zip(fields, zip(*rows) if rows else [()] * len(fields))))
+    return to_json([dict(zip(fields, r)) for r in rows])
+
 @app.get("/types", response_model=List[ProductTypeOut])
-def list_types(db=Depends(get_db)):
-    return db.query(ProductType).order_by(ProductType.name).all()
+def list_types(request: Request, db=Depends(get_db)):
+    return _cached_json(request, db, ("types",),
+                        lambda: (db.query(ProductType).order_by(ProductType.name).all(), {}),
+                        _model_dump(ProductTypeOut))
 
 @app.post("/types", response_model=ProductTypeOut, dependencies=[Depends(require_admin)])
 def create_type(pt: ProductTypeIn, db=Depends(get_db)):
     existing = db.query(ProductType).filter(ProductType.name == pt.name).first()
     if existing: raise HTTPException(400, "Type already exists")
-    obj = ProductType(name=pt.name); db.add(obj); db.commit(); db.refresh(obj); return obj
+    obj = ProductType(name=pt.name); db.add(obj)
+    _bump_versions(db, "types")
+    db.commit(); db.refresh(obj); return obj
 
 # Products
 @app.get("/products", response_model=List[ProductOut])
-def list_products(q: Optional[str] = None, type_id: Optional[int] = None, limit: int = 200, offset: int = 0, db=Depends(get_db)):
-    stmt = db.query(Product)
-    if q:
-        like = f"%{q}%"
-        stmt = stmt.filter((Product.id_code.like(like)) | (Product.description.like(like)))
-    if type_id:
-        stmt = stmt.filter(Product.product_type_id == type_id)
-    stmt = stmt.order_by(Product.id_code).limit(limit).offset(offset)
-    return stmt.all()
+def list_products(request: Request, q: Optional[str] = None, type_id: Optional[int] = None, limit: int = 200,
+                  offset: int = 0, db=Depends(get_db)):
+    def build():
+        stmt = db.query(Product)
+        relevance = None
+        if q:
+            stmt, relevance = _product_search(stmt, q)
+        if type_id:
+            stmt = stmt.filter(Product.product_type_id == type_id)
+        order = [Product.id_code] if relevance is None else [relevance, Product.id_code]
+        return stmt.order_by(*order).limit(limit).offset(offset).all(), {}
+    return _cached_json(request, db, ("products",), build, _model_dump(ProductOut))
 
 @app.post("/products", response_model=ProductOut, dependencies=[Depends(require_admin)])
 def create_product(p: ProductIn, db=Depends(get_db)):
@@ -489,19 +1775,26 @@ def create_product(p: ProductIn, db=Depends(get_db)):
         raise HTTPException(400, "Product id_code already exists")
     obj = Product(id_code=p.id_code, description=p.description, unit_cost=p.unit_cost, product_type_id=p.product_type_id,
                   min_stock=p.min_stock, max_stock=p.max_stock)
-    db.add(obj); db.commit(); db.refresh(obj); return obj
+    db.add(obj); db.flush()
+    _sync_discrepancies(db, [obj.id])
+    _bump_versions(db, "products")
+    db.commit(); db.refresh(obj); return obj
 
 @app.patch("/products/{id}", response_model=ProductOut, dependencies=[Depends(require_admin)])
 def update_product(id: int, p: ProductUpdate, db=Depends(get_db)):
     prod = db.query(Product).filter(Product.id == id).first()
     if not prod: raise HTTPException(404, "Product not found")
-    for field, value in p.dict(exclude_unset=True).items():
+    changes = p.dict(exclude_unset=True)
+    for field, value in changes.items():
         setattr(prod, field, value)
+    if changes.keys() & {"unit_cost", "min_stock", "max_stock"}:
+        db.flush()
+        _sync_discrepancies(db, [prod.id])
+    _bump_versions(db, "products")
     db.commit(); db.refresh(prod); return prod
 
-@app.get("/movements")
-def list_movements(limit: int = 50, offset: int = 0, order: str = "desc", db=Depends(get_db)):
-    q = db.query(
+def _movements_query(db):
+    return db.query(
         InventoryMovement.id,
         InventoryMovement.product_id,
         Product.id_code,
@@ -513,84 +1806,141 @@ def list_movements(limit: int = 50, offset: int = 0, order: str = "desc", db=Dep
         InventoryMovement.movement_reason,
         InventoryMovement.note,
     ).join(Product, Product.id == InventoryMovement.product_id)
-    if order.lower() == "asc":
-        q = q.order_by(InventoryMovement.moved_at.asc())
-    else:
-        q = q.order_by(InventoryMovement.moved_at.desc())
-    rows = q.limit(limit).offset(offset).all()
-    return [dict(
-        id=r[0], product_id=r[1], id_code=r[2], description=r[3],
-        movement_type=r[4], quantity=r[5], unit_cost=r[6], moved_at=r[7],
-        movement_reason=r[8], note=r[9]
-    ) for r in rows]
-
-@app.post("/movements", response_model=MovementOut)
-def create_movement(m: MovementIn, user: User = Depends(get_current_user), db=Depends(get_db)):
-    # Role-based policy
-    allowed_by_role = {
-        "admin": {"IN", "OUT", "ADJ"},
-        "user": {"IN", "OUT", "ADJ"},
-    }
-    allowed = allowed_by_role.get(user.role, set())
 
-    if m.movement_type not in {"IN", "OUT", "ADJ"}:
-        raise HTTPException(400, "movement_type must be IN, OUT, or ADJ")
-    if m.movement_type not in allowed:
-        raise HTTPException(403, f"Role '{user.role}' cannot create {m.movement_type} movements")
+_MOVEMENT_LIST_FIELDS = ("id", "product_id", "id_code", "description", "movement_type", "quantity", "unit_cost",
+                         "moved_at", "movement_reason", "note")
 
-    prod = db.query(Product).filter(Product.id == m.product_id).first()
-    if not prod:
-        raise HTTPException(404, "Product not found")
+def _movements_page(db, limit: int, offset: int, order: str, cursor: Optional[str]):
+    q = _keyset(_movements_query(db), (InventoryMovement.moved_at, InventoryMovement.id), cursor, order)
+    rows = q.limit(limit).offset(0 if cursor else offset).all()
+    next_cursor = _encode_cursor(rows[-1][7], rows[-1][0]) if len(rows) == limit else None
+    return rows, next_cursor  # tuples in _MOVEMENT_LIST_FIELDS order
 
+@app.get("/movements")
+def list_movements(request: Request, limit: int = 50, offset: int = 0, order: str = "desc",
+                   cursor: Optional[str] = None, fmt: str = Query("rows", alias="format"), db=Depends(get_db)):
+    """
+    Ledger page ordered by (moved_at, id). Pass the `X-Next-Cursor` response header back as
+    `cursor` to fetch the next page; `offset` is kept only for older clients.
+    """
+    _check_list_format(fmt)
+    def build():
+        rows, next_cursor = _movements_page(db, limit, offset, order, cursor)
+        return rows, ({"X-Next-Cursor": next_cursor} if next_cursor else {})
+    return _cached_json(request, db, ("movements", "products"), build,
+                        lambda rows: _rows_json(_MOVEMENT_LIST_FIELDS, rows, fmt))
+
+# Role-based policy
+_MOVEMENT_TYPES_BY_ROLE = {
+    "admin": {"IN", "OUT", "ADJ"},
+    "user": {"IN", "OUT", "ADJ"},
+}
+
+def _movement_policy_error(m: MovementIn, user: Principal):
+    """Returns (status_code, detail) if `user` may not post `m`, else None. Does not touch the DB."""
+    if m.movement_type not in {"IN", "OUT", "ADJ"}:
+        return 400, "movement_type must be IN, OUT, or ADJ"
+    if m.movement_type not in _MOVEMENT_TYPES_BY_ROLE.get(user.role, set()):
+        return 403, f"Role '{user.role}' cannot create {m.movement_type} movements"
     # large OUT/ADJ require admin
     if (m.movement_type in ("OUT", "ADJ")) and abs(m.quantity) >= APPROVAL_THRESHOLD and user.role != "admin":
-        raise HTTPException(403, f"Movements of |qty|>={APPROVAL_THRESHOLD} require admin")
+        return 403, f"Movements of |qty|>={APPROVAL_THRESHOLD} require admin"
+    return None
 
-    moved_at = m.moved_at or datetime.utcnow()
-    obj = InventoryMovement(
+def _movement_row(m: MovementIn) -> dict:
+    return dict(
         product_id=m.product_id,
         movement_type=m.movement_type,
         quantity=m.quantity,
         unit_cost=m.unit_cost,
         note=m.note,
-        moved_at=m.moved_at or datetime.utcnow(),
+        moved_at=m.moved_at,
         movement_reason=m.movement_reason,
     )
-    db.add(obj)
+
+def _existing_product_ids(db, product_ids) -> set:
+    found = set()
+    ids = list(set(product_ids))
+    for i in range(0, len(ids), 500):
+        found.update(db.execute(select(Product.id).where(Product.id.in_(ids[i:i + 500]))).scalars())
+    return found
+
+@app.post("/movements", response_model=MovementOut)
+def create_movement(m: MovementIn, user: Principal = Depends(get_current_user), db=Depends(get_db)):
+    err = _movement_policy_error(m, user)
+    if err:
+        raise HTTPException(*err)
+
+    prod = db.query(Product).filter(Product.id == m.product_id).first()
+    if not prod:
+        raise HTTPException(404, "Product not found")
+
+    obj = _insert_movements(db, [_movement_row(m)])[0]
     db.commit()
-    db.refresh(obj)
     return obj
 
+@app.post("/movements/bulk", response_model=MovementBulkOut)
+def create_movements_bulk(movements: List[MovementIn], user: Principal = Depends(get_current_user),
+                          db=Depends(get_db)):
+    """
+    Post many movements in one transaction. Every row is checked against the same rules as
+    `POST /movements`; rejected rows are reported by index and do not block the others.
+    """
+    known = _existing_product_ids(db, (m.product_id for m in movements))
+    results, rows, accepted_idx = [], [], []
+    for i, m in enumerate(movements):
+        err = _movement_policy_error(m, user)
+        reason = err[1] if err else (None if m.product_id in known else "Product not found")
+        if reason:
+            results.append({"index": i, "status": "rejected", "reason": reason})
+            continue
+        results.append({"index": i, "status": "accepted"})
+        rows.append(_movement_row(m))
+        accepted_idx.append(i)
+
+    for i, row in zip(accepted_idx, _insert_movements(db, rows)):
+        results[i]["id"] = row["id"]
+    db.commit()
+    return {"accepted": len(rows), "rejected": len(movements) - len(rows), "results": results}
+
 # Derived stock/valuation
 @app.get("/products_full", response_model=List[ProductFull])
-def products_full(q: Optional[str] = None, type_id: Optional[int] = None,
+def products_full(request: Request, q: Optional[str] = None, type_id: Optional[int] = None,
                   limit: int = 50, offset: int = 0,
-                  sort: str = "id_code", order: str = "asc",
+                  sort: Optional[str] = None, order: str = "asc", fmt: str = Query("rows", alias="format"),
                   db=Depends(get_db)):
-    stock_expr = func.sum(
-        case(
-            (InventoryMovement.movement_type == "IN",  InventoryMovement.quantity),
-            (InventoryMovement.movement_type == "OUT", -InventoryMovement.quantity),
-            else_=InventoryMovement.quantity)
-        )
-    subq = (
-    db.query(
-        InventoryMovement.product_id,
-        stock_expr.label("stock")
-        ).group_by(InventoryMovement.product_id)).subquery()
-
-
+    """
+    `sort` defaults to `relevance` when searching with `q`, otherwise to `id_code`.
+    `format=columns` returns one array per field instead of one object per product.
+    """
+    _check_list_format(fmt)
+    return _cached_json(request, db, ("products", "types", "movements"),
+                        lambda: (_products_full_rows(db, q, type_id, limit, offset, sort, order), {}),
+                        lambda rows: _rows_json(_PRODUCT_FULL_FIELDS, rows, fmt))
+
+_PRODUCT_FULL_FIELDS = ("id", "id_code", "description", "unit_cost", "stock", "valuation", "fifo_value",
+                        "product_type", "min_stock", "max_stock")
+
+def _fifo_value():
+    """What the product's stock on hand cost, from its FIFO layers (0 without layers)."""
+    return func.coalesce(select(func.sum(CostLayer.remaining * CostLayer.unit_cost))
+                         .where(CostLayer.product_id == Product.id).scalar_subquery(), 0.0)
+
+def _products_full_rows(db, q, type_id, limit, offset, sort, order):
+    """Row tuples in _PRODUCT_FULL_FIELDS order."""
+    valuation = Product.stock * func.coalesce(Product.unit_cost, 0.0)
+    fifo_value = _fifo_value()
     selectable = (db.query(Product.id, Product.id_code, Product.description, Product.unit_cost,
-                      func.coalesce(subq.c.stock, 0).label("stock"),
-                      (func.coalesce(subq.c.stock, 0) * func.coalesce(Product.unit_cost, 0.0)).label("valuation"),
+                      Product.stock,
+                      valuation.label("valuation"),
+                      fifo_value.label("fifo_value"),
                       ProductType.name.label("product_type"),
                       Product.min_stock, Product.max_stock)
-             .outerjoin(subq, subq.c.product_id == Product.id)
              .outerjoin(ProductType, ProductType.id == Product.product_type_id))
 
+    relevance = None
     if q:
-        like = f"%{q}%"
-        selectable = selectable.filter(or_(Product.id_code.like(like), Product.description.like(like)))
+        selectable, relevance = _product_search(selectable, q)
     if type_id:
         selectable = selectable.filter(Product.product_type_id == type_id)
 
@@ -598,83 +1948,62 @@ def products_full(q: Optional[str] = None, type_id: Optional[int] = None,
         "id_code": Product.id_code,
         "description": Product.description,
         "unit_cost": Product.unit_cost,
-        "stock": func.coalesce(subq.c.stock, 0),
-        "valuation": (func.coalesce(subq.c.stock, 0) * func.coalesce(Product.unit_cost, 0.0)),
-        "product_type": ProductType.name
+        "stock": Product.stock,
+        "valuation": valuation,
+        "fifo_value": fifo_value,
+        "product_type": ProductType.name,
+        "relevance": relevance if relevance is not None else Product.id_code,
     }
-    sort_col = sort_map.get(sort, Product.id_code)
-    selectable = selectable.order_by(sort_col.desc() if order.lower() == "desc" else sort_col.asc())
+    sort_col = sort_map.get(sort or ("relevance" if q else "id_code"), Product.id_code)
+    selectable = selectable.order_by(sort_col.desc() if order.lower() == "desc" else sort_col.asc(), Product.id_code)
 
-    rows = selectable.limit(limit).offset(offset).all()
-    return [ProductFull(
-        id=r[0], id_code=r[1], description=r[2], unit_cost=r[3], stock=int(r[4] or 0), valuation=float(r[5] or 0.0),
-        product_type=r[6], min_stock=r[7], max_stock=r[8]
-    ) for r in rows]
+    return selectable.limit(limit).offset(offset).all()
 
 # Discrepancies
 @app.get("/discrepancies", response_model=List[Discrepancy])
-def list_discrepancies(db=Depends(get_db)):
-    stock_expr = func.sum(
-        case(
-            (InventoryMovement.movement_type == "IN",  InventoryMovement.quantity),
-            (InventoryMovement.movement_type == "OUT", -InventoryMovement.quantity),
-            else_=InventoryMovement.quantity
-        )
-    )
-    subq = (
-        db.query(
-            InventoryMovement.product_id,
-            stock_expr.label("stock")
-        )
-        .group_by(InventoryMovement.product_id)).subquery()
-
-    rows = (db.query(Product.id, Product.id_code, Product.description, Product.unit_cost,
-                     func.coalesce(subq.c.stock, 0).label("stock"),
-                     Product.min_stock, Product.max_stock)
-            .outerjoin(subq, subq.c.product_id == Product.id)
-            ).all()
-
-    discrepancies = []
-    for pid, code, desc, unit_cost, stock, min_stock, max_stock in rows:
-        candidates = []
-        if (unit_cost is None or unit_cost == 0) and (stock or 0) > 0:
-            candidates.append(("UNIT_COST_MISSING", "Stock > 0 pero unit_cost nulo o 0"))
-        if min_stock is not None and stock is not None and stock < min_stock:
-            candidates.append(("BELOW_MIN_STOCK", f"Stock {stock} < Min {min_stock}"))
-        if max_stock is not None and stock is not None and stock > max_stock:
-            candidates.append(("ABOVE_MAX_STOCK", f"Stock {stock} > Max {max_stock}"))
-        for dtype, detail in candidates:
-            res = (db.query(DiscrepancyResolution)
-                     .filter(DiscrepancyResolution.product_id == pid,
-                             DiscrepancyResolution.discrepancy_type == dtype,
-                             DiscrepancyResolution.stock_at == stock,
-                             DiscrepancyResolution.unit_cost_at == unit_cost)
-                     ).first()
-            if res:
-                continue
-            discrepancies.append(Discrepancy(product_id=pid, id_code=code, description=desc,
-                                             discrepancy_type=dtype, detail=detail, stock=int(stock or 0),
-                                             unit_cost=unit_cost))
-    return discrepancies
+def list_discrepancies(response: Response, discrepancy_type: Optional[str] = None, status: str = "OPEN",
+                       limit: Optional[int] = None, offset: int = 0, db=Depends(get_db)):
+    """Reads the maintained discrepancy index; `limit` is optional, `X-Total-Count` carries the unpaginated count."""
+    q = _discrepancies_query(db, discrepancy_type, status.upper())
+    response.headers["X-Total-Count"] = str(q.order_by(None).count())
+    if limit:
+        q = q.limit(limit)
+    return [Discrepancy(product_id=r[0], id_code=r[1], description=r[2], discrepancy_type=r[3], detail=r[4],
+                        stock=r[5], unit_cost=r[6])
+            for r in q.offset(offset).all()]
 
 @app.post("/discrepancies/resolve")
-def resolve_discrepancy(body: ResolveIn, user: User = Depends(get_current_user), db=Depends(get_db)):
-    stock = (db.query(func.coalesce(func.sum(func.case([(InventoryMovement.movement_type == "IN", InventoryMovement.quantity),
-                                                        (InventoryMovement.movement_type == "OUT", -InventoryMovement.quantity)],
-                                                       else_=InventoryMovement.quantity)), 0))
-               .filter(InventoryMovement.product_id == body.product_id).scalar())
-    unit_cost = db.query(Product.unit_cost).filter(Product.id == body.product_id).scalar()
+def resolve_discrepancy(body: ResolveIn, user: Principal = Depends(get_current_user), db=Depends(get_db)):
+    d = (db.query(OpenDiscrepancy)
+           .filter(OpenDiscrepancy.product_id == body.product_id,
+                   OpenDiscrepancy.discrepancy_type == body.discrepancy_type,
+                   OpenDiscrepancy.status == "OPEN")
+           .first())
+    if not d:
+        raise HTTPException(404, "Discrepancy not found")
     rec = DiscrepancyResolution(product_id=body.product_id, discrepancy_type=body.discrepancy_type,
-                                note=body.note, stock_at=int(stock or 0), unit_cost_at=unit_cost,
+                                note=body.note, stock_at=d.stock_at, unit_cost_at=d.unit_cost_at,
                                 resolved_by=user.id, resolved_at=datetime.utcnow())
-    db.add(rec); db.commit()
+    db.add(rec); db.flush()
+    d.status = "RESOLVED"
+    d.resolution_id = rec.id
+    db.commit()
     return {"status": "resolved", "product_id": body.product_id, "type": body.discrepancy_type}
 
 @app.get("/products/{product_id}/movements")
-def product_history(product_id: int, limit: int = 50, offset: int = 0, order: str = "desc", db=Depends(get_db)):
-    prod = db.query(Product).filter(Product.id == product_id).first()
+def product_history(product_id: int, request: Request, limit: int = 50, offset: int = 0, order: str = "desc",
+                    cursor: Optional[str] = None, fmt: str = Query("rows", alias="format"), db=Depends(get_db)):
+    _check_list_format(fmt)
+    prod = db.query(Product.id).filter(Product.id == product_id).first()
     if not prod:
         raise HTTPException(404, "Product not found")
+    return _cached_json(request, db, ("movements",),
+                        lambda: _product_history_page(db, product_id, limit, offset, order, cursor),
+                        lambda rows: _rows_json(_HISTORY_FIELDS, rows, fmt))
+
+_HISTORY_FIELDS = ("id", "movement_type", "quantity", "unit_cost", "moved_at", "movement_reason", "note")
+
+def _product_history_page(db, product_id: int, limit: int, offset: int, order: str, cursor: Optional[str]):
     q = db.query(
         InventoryMovement.id,
         InventoryMovement.movement_type,
@@ -684,142 +2013,82 @@ def product_history(product_id: int, limit: int = 50, offset: int = 0, order: st
         InventoryMovement.movement_reason,
         InventoryMovement.note,
     ).filter(InventoryMovement.product_id == product_id)
-    if order.lower() == "asc":
-        q = q.order_by(InventoryMovement.moved_at.asc())
-    else:
-        q = q.order_by(InventoryMovement.moved_at.desc())
-    rows = q.limit(limit).offset(offset).all()
-    return [dict(
-        id=r[0], movement_type=r[1], quantity=r[2], unit_cost=r[3],
-        moved_at=r[4], movement_reason=r[5], note=r[6]
-    ) for r in rows]
+    q = _keyset(q, (InventoryMovement.moved_at, InventoryMovement.id), cursor, order)
+    rows = q.limit(limit).offset(0 if cursor else offset).all()
+    return rows, ({"X-Next-Cursor": _encode_cursor(rows[-1][4], rows[-1][0])} if len(rows) == limit else {})
 
 @app.get("/export/movements.csv")
-def export_movements(limit: int = 1000, offset: int = 0, order: str = "desc", db=Depends(get_db)):
-    data = list_movements(limit=limit, offset=offset, order=order, db=db)
-    out = io.StringIO()
-    w = _csv.writer(out)
-    w.writerow(["id","id_code","description","movement_type","quantity","unit_cost","moved_at","movement_reason","note"])
-    for r in data:
-        w.writerow([r["id"], r["id_code"], r["description"], r["movement_type"], r["quantity"], r["unit_cost"], r["moved_at"], r["movement_reason"] or "", r["note"] or ""])
-    out.seek(0)
-    return StreamingResponse(iter([out.getvalue()]), media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=movements.csv"})
-
-@app.get("/export/products.csv")
-def export_products(q: Optional[str] = None, type_id: Optional[int] = None, db=Depends(get_db)):
-    # Reuse the same products_full query (without pagination) for export
-    subq = (db.query(
-                InventoryMovement.product_id,
-                func.sum(func.case([(InventoryMovement.movement_type == "IN", InventoryMovement.quantity),
-                                    (InventoryMovement.movement_type == "OUT", -InventoryMovement.quantity)],
-                                   else_=InventoryMovement.quantity)).label("stock")
-            ).group_by(InventoryMovement.product_id)).subquery()
-
+def export_movements(request: Request, limit: Optional[int] = Query(None, ge=0), offset: int = Query(0, ge=0),
+                     order: str = "desc", cursor: Optional[str] = None, date_from: Optional[datetime] = None,
+                     date_to: Optional[datetime] = None):
+    """Streams the whole ledger (or `date_from`..`date_to`); `limit` is optional."""
+    # Bad input must fail here with a 400, not inside the stream after the header has gone out
+    after = _decode_cursor(cursor, 2) if cursor else None
+
+    def build(db):
+        q = _date_range(_movements_query(db), InventoryMovement.moved_at, date_from, date_to)
+        q = _seek(q, (InventoryMovement.moved_at, InventoryMovement.id), after, order)
+        if not after and offset:
+            q = q.offset(offset)
+        return q.limit(limit) if limit else q
+
+    rows = ([r[0], r[2], r[3], r[4], r[5], r[6], r[7], r[8] or "", r[9] or ""] for r in _stream_query(build))
+    return _csv_response(request, "movements.csv",
+                         ["id","id_code","description","movement_type","quantity","unit_cost","moved_at","movement_reason","note"],
+                         rows)
+
+def _products_export_query(db, q: Optional[str], type_id: Optional[int]):
+    # Same columns as products_full, without pagination (fifo_value last, after the original CSV columns)
     query = (db.query(Product.id_code, Product.description, Product.unit_cost,
-                      func.coalesce(subq.c.stock, 0).label("stock"),
-                      (func.coalesce(subq.c.stock, 0) * func.coalesce(Product.unit_cost, 0.0)).label("valuation"),
+                      Product.stock,
+                      (Product.stock * func.coalesce(Product.unit_cost, 0.0)).label("valuation"),
                       ProductType.name.label("product_type"),
-                      Product.min_stock, Product.max_stock)
-             .outerjoin(subq, subq.c.product_id == Product.id)
+                      Product.min_stock, Product.max_stock,
+                      _fifo_value().label("fifo_value"))
              .outerjoin(ProductType, ProductType.id == Product.product_type_id))
 
     if q:
-        like = f"%{q}%"
-        query = query.filter((Product.id_code.like(like)) | (Product.description.like(like)))
+        query, _ = _product_search(query, q)
     if type_id:
         query = query.filter(Product.product_type_id == type_id)
+    return query.order_by(Product.id_code)
 
-    rows = query.order_by(Product.id_code).all()
-
-    output = io.StringIO()
-    writer = _csv.writer(output)
-    writer.writerow(["codigo","descripcion","costo_unitario","stock","valuacion","tipo","min_stock","max_stock"])
-    for r in rows:
-        writer.writerow([r[0], r[1], r[2] if r[2] is not None else "", int(r[3] or 0), float(r[4] or 0.0), r[5] or "", r[6] or "", r[7] or ""])
-    output.seek(0)
-    return StreamingResponse(iter([output.getvalue()]), media_type="text/csv", headers={"Content-Disposition":"attachment; filename=productos.csv"})
+@app.get("/export/products.csv")
+def export_products(request: Request, q: Optional[str] = None, type_id: Optional[int] = None):
+    rows = ([r[0], r[1], r[2] if r[2] is not None else "", int(r[3] or 0), float(r[4] or 0.0), r[5] or "", r[6] or "", r[7] or "",
+             round(float(r[8] or 0.0), 2)]
+            for r in _stream_query(lambda db: _products_export_query(db, q, type_id)))
+    return _csv_response(request, "productos.csv",
+                         ["codigo","descripcion","costo_unitario","stock","valuacion","tipo","min_stock","max_stock",
+                          "valuacion_fifo"], rows)
 
 @app.get("/export/discrepancies.csv")
-def export_discrepancies(db=Depends(get_db)):
-    # Build the discrepancies list as in /discrepancies
-    subq = (db.query(
-                InventoryMovement.product_id,
-                func.sum(func.case([(InventoryMovement.movement_type == "IN", InventoryMovement.quantity),
-                                    (InventoryMovement.movement_type == "OUT", -InventoryMovement.quantity)],
-                                   else_=InventoryMovement.quantity)).label("stock")
-            ).group_by(InventoryMovement.product_id)).subquery()
-
-    rows = (db.query(Product.id, Product.id_code, Product.description, Product.unit_cost,
-                     func.coalesce(subq.c.stock, 0).label("stock"),
-                     Product.min_stock, Product.max_stock)
-            .outerjoin(subq, subq.c.product_id == Product.id)
-            ).all()
-
-    discrepancies = []
-    for pid, code, desc, unit_cost, stock, min_stock, max_stock in rows:
-        candidates = []
-        if (unit_cost is None or unit_cost == 0) and (stock or 0) > 0:
-            candidates.append(("UNIT_COST_MISSING", "Stock > 0 pero unit_cost nulo o 0"))
-        if min_stock is not None and stock is not None and stock < min_stock:
-            candidates.append(("BELOW_MIN_STOCK", f"Stock {stock} < Min {min_stock}"))
-        if max_stock is not None and stock is not None and stock > max_stock:
-            candidates.append(("ABOVE_MAX_STOCK", f"Stock {stock} > Max {max_stock}"))
-        for dtype, detail in candidates:
-            res = (db.query(DiscrepancyResolution)
-                     .filter(DiscrepancyResolution.product_id == pid,
-                             DiscrepancyResolution.discrepancy_type == dtype,
-                             DiscrepancyResolution.stock_at == stock,
-                             DiscrepancyResolution.unit_cost_at == unit_cost)
-                     ).first()
-            if res:
-                continue
-            discrepancies.append((code, desc, dtype, detail, int(stock or 0), unit_cost))
-
-    output = io.StringIO()
-    writer = _csv.writer(output)
-    writer.writerow(["codigo","descripcion","discrepancia","detalle","stock","costo_unitario"])
-    for row in discrepancies:
-        writer.writerow(row)
-    output.seek(0)
-    return StreamingResponse(iter([output.getvalue()]), media_type="text/csv", headers={"Content-Disposition":"attachment; filename=discrepancias.csv"})
+def export_discrepancies(request: Request, discrepancy_type: Optional[str] = None, status: str = "OPEN"):
+    rows = ([r[1], r[2], r[3], r[4], r[5], r[6]]
+            for r in _stream_query(lambda db: _discrepancies_query(db, discrepancy_type, status.upper())))
+    return _csv_response(request, "discrepancias.csv",
+                         ["codigo","descripcion","discrepancia","detalle","stock","costo_unitario"], rows)
 
-def _current_stock_subquery(db):
-    from sqlalchemy import case
-    stock_expr = func.sum(
-        case(
-            (InventoryMovement.movement_type == "IN",  InventoryMovement.quantity),
-            (InventoryMovement.movement_type == "OUT", -InventoryMovement.quantity),
-            else_=InventoryMovement.quantity,
-        )
-    )
+def _low_stock_query(db):
     return (
-        db.query(
-            InventoryMovement.product_id,
-            stock_expr.label("stock")
-        ).group_by(InventoryMovement.product_id)
-    ).subquery()
-
-@app.get("/reports/low_stock")
-def report_low_stock(db=Depends(get_db)):
-    subq = _current_stock_subquery(db)
-    rows = (
         db.query(
             Product.id_code,
             Product.description,
             Product.unit_cost,
-            func.coalesce(subq.c.stock, 0).label("stock"),
+            Product.stock,
             Product.min_stock,
             Product.max_stock,
             ProductType.name.label("product_type"),
         )
-        .outerjoin(subq, subq.c.product_id == Product.id)
         .outerjoin(ProductType, ProductType.id == Product.product_type_id)
         .filter(Product.min_stock.isnot(None))
-        .filter(func.coalesce(subq.c.stock, 0) < Product.min_stock)
+        .filter(Product.stock < Product.min_stock)
         .order_by(Product.id_code)
-        .all()
     )
+
+@app.get("/reports/low_stock")
+def report_low_stock(db=Depends(get_read_db)):
+    rows = _low_stock_query(db).all()
     return [
         {
             "codigo": r[0],
@@ -835,151 +2104,699 @@ def report_low_stock(db=Depends(get_db)):
     ]
 
 @app.get("/export/low_stock.csv")
-def export_low_stock(db=Depends(get_db)):
-    data = report_low_stock(db)
-    output = io.StringIO()
-    writer = _csv.writer(output)
-    writer.writerow(["codigo","descripcion","tipo","stock","min_stock","faltante","costo_unitario"])
-    for r in data:
-        writer.writerow([
-            r["codigo"], r["descripcion"], r["tipo"] or "",
-            r["stock"], r["min_stock"] or "", r["faltante"], r["costo_unitario"] or ""
-        ])
-    output.seek(0)
-    return StreamingResponse(
-        iter([output.getvalue()]),
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=low_stock.csv"},
-    )
+def export_low_stock(request: Request):
+    rows = ([r[0], r[1], r[6] or "", int(r[3] or 0), r[4] or "", int((r[4] or 0) - int(r[3] or 0)), r[2] or ""]
+            for r in _stream_query(_low_stock_query))
+    return _csv_response(request, "low_stock.csv",
+                         ["codigo","descripcion","tipo","stock","min_stock","faltante","costo_unitario"], rows)
+
+@app.get("/reports/valuation")
+def report_valuation(request: Request, product_type_id: Optional[int] = None, db=Depends(get_read_db)):
+    """What the stock on hand cost, from the FIFO cost layers; products without layers are left out."""
+    def build():
+        value = func.sum(CostLayer.remaining * CostLayer.unit_cost)
+        q = (db.query(Product.id, Product.id_code, Product.description, Product.stock, value)
+               .join(CostLayer, CostLayer.product_id == Product.id))
+        if product_type_id is not None:
+            q = q.filter(Product.product_type_id == product_type_id)
+        rows = q.group_by(Product.id, Product.id_code, Product.description, Product.stock)\
+                .order_by(Product.id_code).all()
+        items = [{"product_id": pid, "id_code": code, "description": desc, "stock": stock,
+                  "value": round(v or 0, 2), "unit_cost": round(v / stock, 4) if stock else None}
+                 for pid, code, desc, stock, v in rows]
+        return {"total_stock": sum(i["stock"] for i in items),
+                "total_value": round(sum(i["value"] for i in items), 2), "items": items}, {}
+    return _cached_json(request, db, ("movements", "products"), build, to_json)
+
+@app.get("/reports/cogs")
+def report_cogs(request: Request, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None,
+                product_id: Optional[int] = None, db=Depends(get_read_db)):
+    """
+    Revenue vs. FIFO cost of goods sold per sale line. `estimated_quantity` was sold with no stock
+    received yet and is costed at the product's unit_cost; `cogs` is null for lines with no linked movement.
+    """
+    def build():
+        q = (db.query(Sale.id, Sale.created_at, SaleItem.product_id, Product.id_code, Product.description,
+                      SaleItem.quantity, SaleItem.subtotal, MovementCost.cost, MovementCost.estimated_quantity)
+               .join(SaleItem, SaleItem.sale_id == Sale.id)
+               .join(Product, Product.id == SaleItem.product_id)
+               .outerjoin(MovementCost, MovementCost.movement_id == SaleItem.movement_id))
+        if product_id is not None:
+            q = q.filter(SaleItem.product_id == product_id)
+        rows = _date_range(q, Sale.created_at, date_from, date_to).order_by(Sale.created_at, Sale.id, SaleItem.id).all()
+        items = []
+        for sale_id, created_at, pid, code, desc, qty, revenue, cogs, estimated in rows:
+            revenue = round(revenue or 0, 2)
+            cogs = round(cogs, 2) if cogs is not None else None
+            items.append({"sale_id": sale_id, "created_at": created_at, "product_id": pid, "id_code": code,
+                          "description": desc, "quantity": qty, "revenue": revenue, "cogs": cogs,
+                          "margin": round(revenue - cogs, 2) if cogs is not None else None,
+                          "estimated_quantity": estimated or 0})
+        revenue = round(sum(i["revenue"] for i in items), 2)
+        cogs = round(sum(i["cogs"] or 0 for i in items), 2)
+        return {"revenue": revenue, "cogs": cogs, "margin": round(revenue - cogs, 2), "items": items}, {}
+    return _cached_json(request, db, ("movements", "products"), build, to_json)
+
+@app.get("/reports/inventory_aging")
+def report_inventory_aging(buckets: str = "30,60,90,180", product_type_id: Optional[int] = None,
+                           db=Depends(get_read_db)):
+    """
+    Stock on hand by days since its FIFO layer was received. `buckets` are the upper bounds in days;
+    `quantities` / `values` in each item line up with the returned bucket labels.
+    """
+    try:
+        limits = sorted({int(b) for b in buckets.split(",") if b.strip()})
+    except ValueError:
+        raise HTTPException(400, "buckets must be comma-separated day counts, e.g. 30,60,90")
+    if not limits or limits[0] <= 0:
+        raise HTTPException(400, "buckets must be positive day counts")
+    labels = [f"{lo + 1 if lo else 0}-{hi}" for lo, hi in zip([0] + limits, limits)] + [f"{limits[-1] + 1}+"]
+    now = datetime.utcnow()
+    bucket = case(*[(CostLayer.received_at >= now - timedelta(days=d), i) for i, d in enumerate(limits)],
+                  else_=len(limits))
+    q = (db.query(Product.id, Product.id_code, Product.description, bucket, func.sum(CostLayer.remaining),
+                  func.sum(CostLayer.remaining * CostLayer.unit_cost), func.min(CostLayer.received_at))
+           .join(CostLayer, CostLayer.product_id == Product.id)
+           .filter(CostLayer.remaining > 0))
+    if product_type_id is not None:
+        q = q.filter(Product.product_type_id == product_type_id)
+    rows = q.group_by(Product.id, Product.id_code, Product.description, bucket).order_by(Product.id_code).all()
+    items, totals_qty, totals_value = [], [0] * len(labels), [0.0] * len(labels)
+    for (pid, code, desc), group in itertools.groupby(rows, key=lambda r: r[:3]):
+        item = {"product_id": pid, "id_code": code, "description": desc, "oldest_received_at": None,
+                "quantities": [0] * len(labels), "values": [0.0] * len(labels)}
+        for _, _, _, b, qty, value, oldest in group:
+            item["quantities"][b], item["values"][b] = int(qty), round(value or 0, 2)
+            totals_qty[b] += int(qty)
+            totals_value[b] += value or 0
+            if item["oldest_received_at"] is None or oldest < item["oldest_received_at"]:
+                item["oldest_received_at"] = oldest
+        items.append(item)
+    return Response(to_json({"as_of": now, "buckets": labels, "quantities": totals_qty,
+                             "values": [round(v, 2) for v in totals_value], "items": items}),
+                    media_type="application/json")
+
+_SUMMARY_BUCKETS = ("day", "week", "month")
+
+def _rollup_summary_query(db, bucket: str, group_by: str, groups: dict, date_from, date_to,
+                          product_id, product_type_id):
+    """Rollup rows summed per (period, group) plus the key field names for `group_by`."""
+    if bucket not in _SUMMARY_BUCKETS:
+        raise HTTPException(400, "bucket must be day, week or month")
+    if group_by not in groups:
+        raise HTTPException(400, f"group_by must be one of: {', '.join(groups)}")
+    period = _period_start(db, bucket).label("period")
+    keys = groups[group_by]
+    r = _rollup_t.c
+    q = db.query(period, *[col for _, col in keys], func.sum(r.quantity), func.sum(r.value), func.sum(r.cost),
+                 func.sum(r.movements)).select_from(_rollup_t)
+    if group_by in ("product", "product_type") or product_type_id is not None:
+        q = q.join(Product, Product.id == r.product_id)
+    if group_by == "product_type":
+        q = q.outerjoin(ProductType, ProductType.id == Product.product_type_id)
+    if date_from:
+        q = q.filter(r.day >= date_from)
+    if date_to:
+        q = q.filter(r.day <= date_to)
+    if product_id is not None:
+        q = q.filter(r.product_id == product_id)
+    if product_type_id is not None:
+        q = q.filter(Product.product_type_id == product_type_id)
+    group = [period] + [col for _, col in keys]
+    return q.group_by(*group).order_by(*group), [name for name, _ in keys]
+
+_PRODUCT_GROUP = [("product_id", Product.id), ("id_code", Product.id_code), ("description", Product.description)]
+
+@app.get("/reports/movements_summary")
+def report_movements_summary(request: Request, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                             bucket: str = "day", group_by: str = "movement_type", product_id: Optional[int] = None,
+                             product_type_id: Optional[int] = None, movement_type: Optional[str] = None,
+                             fmt: str = Query("rows", alias="format"), db=Depends(get_read_db)):
+    """
+    Quantity, recorded value, FIFO cost and movement count per day/week/month, from the daily
+    rollups (movement_rollups) instead of the raw ledger.
+    """
+    _check_list_format(fmt)
+    groups = {"movement_type": [("movement_type", _rollup_t.c.movement_type)],
+              "movement_reason": [("movement_reason", _rollup_t.c.movement_reason)],
+              "product": _PRODUCT_GROUP, "product_type": [("product_type", ProductType.name)], "none": []}
+    def build():
+        q, keys = _rollup_summary_query(db, bucket, group_by, groups, date_from, date_to, product_id, product_type_id)
+        if movement_type:
+            q = q.filter(_rollup_t.c.movement_type == movement_type)
+        rows = [(*r[:-4], int(r[-4] or 0), round(r[-3] or 0, 2), round(r[-2] or 0, 2), int(r[-1] or 0)) for r in q]
+        return (("period", *keys, "quantity", "value", "cost", "movements"), rows), {}
+    return _cached_json(request, db, ("movements", "products", "types"), build,
+                        lambda data: _rows_json(data[0], data[1], fmt))
+
+def _period_days(period, bucket: str, date_from: Optional[date], date_to: Optional[date]) -> int:
+    """Days of the bucket starting at `period` that fall inside [date_from, date_to]."""
+    start = period if isinstance(period, date) else date.fromisoformat(period)
+    if bucket == "day":
+        end = start + timedelta(days=1)
+    elif bucket == "week":
+        end = start + timedelta(days=7)
+    else:
+        end = (start + timedelta(days=32)).replace(day=1)
+    if date_from and date_from > start:
+        start = date_from
+    if date_to and date_to + timedelta(days=1) < end:
+        end = date_to + timedelta(days=1)
+    return max((end - start).days, 1)
+
+@app.get("/reports/sales_summary")
+def report_sales_summary(request: Request, date_from: Optional[date] = None, date_to: Optional[date] = None,
+                         bucket: str = "day", group_by: str = "none", product_id: Optional[int] = None,
+                         product_type_id: Optional[int] = None, fmt: str = Query("rows", alias="format"),
+                         db=Depends(get_read_db)):
+    """
+    Units sold, revenue (sale price recorded on the OUT movement), FIFO cost, margin and units/day
+    per day/week/month, from the daily rollups of sale movements (POST /sales and SALE orders).
+    """
+    _check_list_format(fmt)
+    groups = {"none": [], "product": _PRODUCT_GROUP, "product_type": [("product_type", ProductType.name)]}
+    def build():
+        q, keys = _rollup_summary_query(db, bucket, group_by, groups, date_from, date_to, product_id, product_type_id)
+        q = q.filter(_rollup_t.c.movement_type == "OUT", func.lower(_rollup_t.c.movement_reason) == "sale")
+        rows = []
+        for r in q:
+            units, revenue, cost = int(r[-4] or 0), round(r[-3] or 0, 2), round(r[-2] or 0, 2)
+            rows.append((*r[:-4], units, revenue, cost, round(revenue - cost, 2), int(r[-1] or 0),
+                         round(units / _period_days(r[0], bucket, date_from, date_to), 3)))
+        return (("period", *keys, "units", "revenue", "cost", "margin", "lines", "units_per_day"), rows), {}
+    return _cached_json(request, db, ("movements", "products", "types"), build,
+                        lambda data: _rows_json(data[0], data[1], fmt))
+
+_REORDER_CHUNK = 2000
+_REORDER_FIELDS = ("product_id", "id_code", "description", "stock", "min_stock", "max_stock", "daily_demand",
+                   "demand_sd", "demand_days", "suggested_min", "suggested_max")
+
+def _reorder_suggestions(db, window_days: int, lead_time_days: int, review_days: int, service_level: float,
+                         product_type_id: Optional[int] = None, include_idle: bool = False,
+                         only_changed: bool = False) -> list:
+    """
+    Demand per product from one streaming pass over the daily OUT rollups of the last `window_days`
+    (transfers excluded) into arrays indexed by product id, then one pass over the catalog.
+    suggested_min = lead-time demand + z * sd * sqrt(lead time); suggested_max adds `review_days` of demand.
+    Returns tuples in _REORDER_FIELDS order.
+    """
+    if window_days < 1 or lead_time_days < 0 or review_days < 0:
+        raise HTTPException(400, "window_days must be >= 1; lead_time_days and review_days >= 0")
+    if not 0 < service_level < 1:
+        raise HTTPException(400, "service_level must be between 0 and 1, e.g. 0.95")
+    z = NormalDist().inv_cdf(service_level)
+    size = (db.query(func.max(Product.id)).scalar() or 0) + 1
+    total, total_sq, days = array("d", bytes(8 * size)), array("d", bytes(8 * size)), array("i", bytes(4 * size))
+    r = _rollup_t.c
+    since = (datetime.utcnow() - timedelta(days=window_days)).date()
+    # Primary-key order (day, product_id, ...) keeps one product's rows for a day together: no sort needed
+    stream = (select(type_coerce(r.day, String), r.product_id, r.quantity)  # day is only a break key: skip parsing
+              .where(r.day >= since, r.movement_type == "OUT", r.movement_reason != "transfer")
+              .order_by(r.day, r.product_id).execution_options(yield_per=10_000))
+    key, qty = None, 0
+    for day, pid, q in itertools.chain(db.execute(stream), [(None, None, 0)]):
+        if (day, pid) != key:
+            if key is not None:
+                total[key[1]] += qty
+                total_sq[key[1]] += qty * qty
+                days[key[1]] += 1
+            key, qty = (day, pid), 0
+        qty += q
+
+    cols = (Product.id, Product.id_code, Product.description, Product.stock, Product.min_stock, Product.max_stock)
+    if include_idle:
+        chunks = [select(*cols).order_by(Product.id).execution_options(yield_per=10_000)]
+    else:
+        active = [pid for pid in range(size) if total[pid] > 0]
+        chunks = [select(*cols).where(Product.id.in_(active[i:i + _REORDER_CHUNK]))
+                  for i in range(0, len(active), _REORDER_CHUNK)]
+    out = []
+    for query in chunks:
+        if product_type_id is not None:
+            query = query.where(Product.product_type_id == product_type_id)
+        for pid, code, desc, stock, cur_min, cur_max in db.execute(query):
+            mean = total[pid] / window_days
+            sd = math.sqrt(max(total_sq[pid] / window_days - mean * mean, 0.0))
+            s_min = max(math.ceil(mean * lead_time_days + z * sd * math.sqrt(lead_time_days) - 1e-9), 0)
+            s_max = max(math.ceil(s_min + mean * review_days - 1e-9), s_min)
+            if only_changed and (s_min, s_max) == (cur_min, cur_max):
+                continue
+            out.append((pid, code, desc, stock, cur_min, cur_max, round(mean, 4), round(sd, 4), days[pid],
+                        s_min, s_max))
+    out.sort(key=lambda row: row[1])
+    return out
+
+@app.get("/reports/reorder_suggestions")
+def report_reorder_suggestions(window_days: int = 90, lead_time_days: int = 7, review_days: int = 30,
+                               service_level: float = 0.95, product_type_id: Optional[int] = None,
+                               include_idle: bool = False, only_changed: bool = False,
+                               fmt: str = Query("rows", alias="format"), db=Depends(get_read_db)):
+    """
+    Suggested min (reorder point) and max per SKU from its daily OUT demand over `window_days`:
+    mean, standard deviation and days with demand. Products with no demand are left out unless
+    `include_idle`. Apply them with POST /policies/reorder_suggestions.
+    """
+    _check_list_format(fmt)
+    rows = _reorder_suggestions(db, window_days, lead_time_days, review_days, service_level, product_type_id,
+                                include_idle, only_changed)
+    return Response(_rows_json(_REORDER_FIELDS, rows, fmt), media_type="application/json")
 
-@app.post("/policies/bulk_minmax", dependencies=[Depends(require_admin)])
-def bulk_minmax(rows: List[MinMaxRow], db=Depends(get_db)):
+def _parse_as_of(value: str) -> datetime:
+    """`YYYY-MM-DD` means end of that day (cutoff at next midnight); a full timestamp is used as is."""
+    try:
+        if len(value) == 10:
+            return datetime.combine(date.fromisoformat(value), datetime.min.time()) + timedelta(days=1)
+        return _naive_utc(datetime.fromisoformat(value))
+    except ValueError:
+        raise HTTPException(400, "date must be YYYY-MM-DD or an ISO timestamp")
+
+@app.get("/stock/as_of")
+def stock_as_of(request: Request, as_of: str = Query(..., alias="date"), product_id: Optional[int] = None,
+                warehouse_id: Optional[int] = None, by_warehouse: bool = False,
+                fmt: str = Query("rows", alias="format"), db=Depends(get_read_db)):
+    """
+    Stock per product after every movement dated before the cutoff (`date` = end of that day).
+    Products at zero are left out unless `product_id` is given. `warehouse_id=0` selects movements
+    without a warehouse. `X-Snapshot-At` names the checkpoint the answer started from.
+    """
+    _check_list_format(fmt)
+    at = _parse_as_of(as_of)
+    def build():
+        rows, snap = _stock_as_of(db, at, product_id, warehouse_id, by_warehouse)
+        return rows, ({"X-Snapshot-At": snap.taken_at.isoformat()} if snap else {})
+    return _cached_json(request, db, ("movements", "products"), build,
+                        lambda rows: _rows_json(_STOCK_AS_OF_FIELDS, rows, fmt))
+
+_STOCK_DRIFT_FIELDS = ("product_id", "id_code", "description", "ledger", "stock", "warehouses", "stock_drift",
+                       "warehouse_drift")
+
+def _stock_drift(db, full: bool = False, include_all: bool = False):
+    """
+    Ledger balance, Product.stock and the WarehouseStock total per product in one query. `warehouses`
+    is None for products with no warehouse rows (they are not compared). Returns (rows, snapshot).
+    """
+    ledger, snap = _ledger_balance_subquery(db, full)
+    wh = (select(WarehouseStock.product_id, func.sum(func.coalesce(WarehouseStock.quantity, 0)).label("quantity"))
+          .group_by(WarehouseStock.product_id).subquery())
+    led, stock = func.coalesce(ledger.c.quantity, 0), func.coalesce(Product.stock, 0)
+    q = (db.query(Product.id, Product.id_code, Product.description, led, stock, wh.c.quantity)
+           .outerjoin(ledger, ledger.c.product_id == Product.id)
+           .outerjoin(wh, wh.c.product_id == Product.id))
+    if not include_all:
+        q = q.filter(or_(led != stock, and_(wh.c.quantity.isnot(None), wh.c.quantity != stock)))
+    rows = [(pid, code, desc, int(l), int(s), None if w is None else int(w), int(s) - int(l),
+             None if w is None else int(w) - int(s))
+            for pid, code, desc, l, s, w in q.order_by(Product.id_code)]
+    return rows, snap
+
+@app.get("/reports/stock_drift")
+def report_stock_drift(full: bool = False, include_all: bool = False, fmt: str = Query("rows", alias="format"),
+                       db=Depends(get_read_db)):
+    """
+    Products whose ledger balance, Product.stock and warehouse total disagree. The ledger side starts
+    from the latest stock snapshot (`X-Snapshot-At`); `full=true` sums the whole ledger instead.
+    `stock_drift` = stock - ledger, `warehouse_drift` = warehouses - stock.
+    """
+    _check_list_format(fmt)
+    rows, snap = _stock_drift(db, full, include_all)
+    return Response(_rows_json(_STOCK_DRIFT_FIELDS, rows, fmt), media_type="application/json",
+                    headers={"X-Snapshot-At": snap.taken_at.isoformat()} if snap else None)
+
+@app.post("/stock/drift/repair")
+def repair_stock_drift(target: str = "ledger", full: bool = False, dry_run: bool = False,
+                       user: Principal = Depends(require_admin), db=Depends(get_db)):
+    """
+    `target=ledger` resets drifted Product.stock values to the ledger. `target=warehouses` also writes one
+    corrective ADJ movement per product whose warehouse total differs, in one bulk insert, so ledger and
+    stock end at the warehouse count. `dry_run` reports the plan and rolls back.
+    """
+    if target not in ("ledger", "warehouses"):
+        raise HTTPException(400, "target must be ledger or warehouses")
+    rows, _ = _stock_drift(db, full)
+    # Deltas, not absolute values: a movement committed meanwhile keeps its own effect
+    reset = {r[0]: -r[6] for r in rows if r[6]}
+    if reset:
+        _apply_stock_deltas(db, reset)
+        _sync_discrepancies(db, reset.keys())
+        _bump_versions(db, "products")
+    adjustments = []
+    if target == "warehouses":
+        now = datetime.utcnow()
+        adjustments = [dict(product_id=r[0], movement_type="ADJ", movement_reason="drift_repair", quantity=r[5] - r[3],
+                            note=f"Conciliación con almacenes ({r[3]} -> {r[5]}) | Por: {user.email}", moved_at=now)
+                       for r in rows if r[5] is not None and r[5] != r[3]]
+        _insert_movements(db, adjustments)
+    if dry_run:
+        db.rollback()
+    else:
+        db.commit()
+    return {"dry_run": dry_run, "stock_reset": len(reset), "adjustments": len(adjustments),
+            "products": [{"id_code": r[1], "ledger": r[3], "stock": r[4], "warehouses": r[5]} for r in rows]}
+
+_MINMAX_CHUNK = 1000
+_minmax_rows_adapter = TypeAdapter(List[MinMaxRow])
+# COALESCE keeps the current value where the row leaves min/max empty
+_minmax_update = (update(Product.__table__)
+                  .where(Product.__table__.c.id == bindparam("b_id"))
+                  .values(min_stock=func.coalesce(bindparam("b_min", type_=Integer), Product.__table__.c.min_stock),
+                          max_stock=func.coalesce(bindparam("b_max", type_=Integer), Product.__table__.c.max_stock)))
+
+def _apply_minmax_rows(db, rows: List[MinMaxRow]):
+    """
+    Resolve id_codes with chunked IN lookups and apply min/max with one executemany UPDATE per
+    chunk. The caller commits. Returns (updated, missing_id_codes).
+    """
     updated, missing = 0, []
-    for r in rows:
-        p = db.query(Product).filter(Product.id_code == r.id_code).first()
-        if not p:
-            missing.append(r.id_code)
+    for i in range(0, len(rows), _MINMAX_CHUNK):
+        chunk = rows[i:i + _MINMAX_CHUNK]
+        ids = dict(db.execute(select(Product.id_code, Product.id)
+                              .where(Product.id_code.in_({r.id_code for r in chunk}))).all())
+        params = []
+        for r in chunk:
+            pid = ids.get(r.id_code)
+            if pid is None:
+                missing.append(r.id_code)
+                continue
+            params.append({"b_id": pid, "b_min": r.min_stock, "b_max": r.max_stock})
+        if params:
+            db.execute(_minmax_update, params)
+            _sync_discrepancies(db, {p["b_id"] for p in params})
+            _bump_versions(db, "products")
+        updated += len(params)
+    return updated, missing
+
+def _read_minmax_csv(db, f):
+    """Stream a `id_code,min_stock,max_stock` CSV (other columns ignored) through _apply_minmax_rows."""
+    try:
+        return _read_minmax_rows(db, _csv.DictReader(io.TextIOWrapper(f, encoding="utf-8-sig", newline="")))
+    except UnicodeDecodeError:  # raised by the reader at whatever line the bad bytes are
+        raise HTTPException(400, "CSV must be UTF-8 encoded")
+    except _csv.Error as e:
+        raise HTTPException(400, f"Malformed CSV: {e}")
+
+def _read_minmax_rows(db, reader):
+    updated, missing, invalid = 0, [], []
+    if not reader.fieldnames or "id_code" not in reader.fieldnames:
+        raise HTTPException(400, "CSV must have a header with an id_code column")
+    chunk = []
+    for line, rec in enumerate(reader, start=2):
+        code = (rec.get("id_code") or "").strip()
+        try:
+            if not code:
+                raise ValueError("empty id_code")
+            chunk.append(MinMaxRow(id_code=code,
+                                   min_stock=int(rec["min_stock"]) if (rec.get("min_stock") or "").strip() else None,
+                                   max_stock=int(rec["max_stock"]) if (rec.get("max_stock") or "").strip() else None))
+        except ValueError:
+            invalid.append(line)
             continue
-        if r.min_stock is not None:
-            p.min_stock = r.min_stock
-        if r.max_stock is not None:
-            p.max_stock = r.max_stock
-        updated += 1
-    db.commit()
+        if len(chunk) == _MINMAX_CHUNK:
+            u, m = _apply_minmax_rows(db, chunk)
+            updated += u; missing.extend(m); chunk = []
+    u, m = _apply_minmax_rows(db, chunk)
+    return updated + u, missing + m, invalid
+
+# The body is read by hand (JSON or multipart), so both content types are declared for OpenAPI here
+_BULK_MINMAX_BODY = {"requestBody": {"required": True, "content": {
+    "application/json": {"schema": {"type": "array", "items": MinMaxRow.model_json_schema()}},
+    "multipart/form-data": {"schema": {"type": "object", "required": ["file"],
+                                       "properties": {"file": {"type": "string", "format": "binary"}}}},
+}}}
+
+@app.post("/policies/bulk_minmax", dependencies=[Depends(require_admin)], openapi_extra=_BULK_MINMAX_BODY)
+async def bulk_minmax(request: Request, db=Depends(get_db)):
+    """
+    Either a JSON list of `{id_code, min_stock, max_stock}` or a multipart upload with a `file`
+    CSV of the same columns (e.g. an edited `/export/low_stock.csv`). Empty min/max cells keep
+    the current value. The CSV is parsed as a stream; everything commits in one transaction.
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(400, "Missing CSV 'file' field")
+        updated, missing, invalid = await run_in_threadpool(_read_minmax_csv, db, upload.file)
+        await run_in_threadpool(db.commit)
+        return {"updated": updated, "missing_id_codes": missing, "invalid_lines": invalid}
+
+    try:
+        rows = _minmax_rows_adapter.validate_json(await request.body())
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    updated, missing = await run_in_threadpool(_apply_minmax_rows, db, rows)
+    await run_in_threadpool(db.commit)
     return {"updated": updated, "missing_id_codes": missing}
 
-@app.post("/barcode/decode")
-def barcode_decode(file: UploadFile = File(...), db=Depends(get_db)):
+@app.post("/policies/reorder_suggestions", dependencies=[Depends(require_admin)])
+def apply_reorder_suggestions(window_days: int = 90, lead_time_days: int = 7, review_days: int = 30,
+                              service_level: float = 0.95, product_type_id: Optional[int] = None,
+                              include_idle: bool = False, dry_run: bool = False, db=Depends(get_db)):
+    """
+    Write the changed /reports/reorder_suggestions into min_stock/max_stock through the bulk
+    min/max path. `dry_run` runs the same updates and rolls them back.
+    """
+    rows = _reorder_suggestions(db, window_days, lead_time_days, review_days, service_level, product_type_id,
+                                include_idle, only_changed=True)
+    updated, missing = _apply_minmax_rows(db, [MinMaxRow(id_code=r[1], min_stock=r[9], max_stock=r[10])
+                                               for r in rows])
+    if dry_run:
+        db.rollback()
+    else:
+        db.commit()
+    return {"dry_run": dry_run, "updated": updated, "missing_id_codes": missing,
+            "changes": [{"id_code": r[1], "min_stock": r[4], "max_stock": r[5], "suggested_min": r[9],
+                         "suggested_max": r[10]} for r in rows]}
+
+# ---------- Barcode pipeline ----------
+_barcode_pool = None
+_barcode_slots = asyncio.Semaphore(BARCODE_WORKERS * 2)  # bounds images queued/held in memory
+_barcode_cache = OrderedDict()  # sha256 -> [(code, symbology)]
+_barcode_lock = threading.Lock()
+
+def _get_barcode_pool():
+    global _barcode_pool
+    if _barcode_pool is None:
+        _barcode_pool = ProcessPoolExecutor(max_workers=BARCODE_WORKERS)
+    return _barcode_pool
+
+def _reset_barcode_pool(broken):
+    global _barcode_pool
+    if _barcode_pool is broken:
+        _barcode_pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+@app.on_event("shutdown")
+def _shutdown_barcode_pool():
+    if _barcode_pool is not None:
+        _barcode_pool.shutdown(cancel_futures=True)
+
+async def _decode_upload(file: UploadFile):
+    """
+    [(code, symbology)] for one upload; cached by content hash so rescans skip the decoder. The slot
+    is taken before the upload is read, so at most that many images are held in memory at once.
+    """
+    if file.size is not None and file.size > BARCODE_MAX_BYTES:
+        raise HTTPException(413, f"Imagen mayor a {BARCODE_MAX_BYTES} bytes")
+    async with _barcode_slots:
+        data = await file.read(BARCODE_MAX_BYTES + 1)
+        if len(data) > BARCODE_MAX_BYTES:
+            raise HTTPException(413, f"Imagen mayor a {BARCODE_MAX_BYTES} bytes")
+        key = hashlib.sha256(data).hexdigest()
+        with _barcode_lock:
+            if key in _barcode_cache:
+                _barcode_cache.move_to_end(key)
+                return _barcode_cache[key]
+        pool = _get_barcode_pool()
+        try:
+            codes = await asyncio.wrap_future(pool.submit(decode_barcode_image, data, BARCODE_SIDES))
+        except BarcodeDecodeError as e:
+            raise HTTPException(400, f"Imagen inválida: {e}")
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory): start a fresh pool on the next request
+            _reset_barcode_pool(pool)
+            raise HTTPException(503, "Decodificador de códigos no disponible; reintente")
+    with _barcode_lock:
+        _barcode_cache[key] = codes
+        while len(_barcode_cache) > BARCODE_CACHE_SIZE:
+            _barcode_cache.popitem(last=False)
+    return codes
+
+def _products_by_code(db, codes) -> dict:
+    codes = list(set(codes))
+    if not codes:
+        return {}
+    rows = db.query(Product.id, Product.id_code, Product.description).filter(Product.id_code.in_(codes)).all()
+    return {r.id_code: {"id": r.id, "id_code": r.id_code, "description": r.description} for r in rows}
+
+def _require_pyzbar():
     if not _HAS_PYZBAR:
         raise HTTPException(
             status_code=501,
             detail=f"pyzbar/zbar no disponible: install zbar + pip install pyzbar Pillow. Loader error: {_PYZBAR_ERR}"
         )
-    try:
-        img_bytes = file.file.read()
-        img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    except Exception as e:
-        raise HTTPException(400, f"Imagen inválida: {e}")
-
-    results = zbar_decode(img)
-    payload = []
-    for r in results:
-        code = r.data.decode("utf-8", errors="ignore").strip()
-        sym = r.type
-        prod = db.query(Product).filter(Product.id_code == code).first()
-        payload.append({
-            "data": code,
-            "symbology": sym,
-            "product": None if not prod else {
-                "id": prod.id,
-                "id_code": prod.id_code,
-                "description": prod.description
-            }
-        })
+
+def _barcode_payload(codes, products: dict):
+    return [{"data": code, "symbology": sym, "product": products.get(code)} for code, sym in codes]
+
+@app.post("/barcode/decode")
+async def barcode_decode(file: UploadFile = File(...), db=Depends(get_db)):
+    _require_pyzbar()
+    codes = await _decode_upload(file)
+    products = await run_in_threadpool(_products_by_code, db, [c for c, _ in codes])
+    payload = _barcode_payload(codes, products)
     return {"count": len(payload), "barcodes": payload}
 
+@app.post("/barcode/decode_batch")
+async def barcode_decode_batch(files: List[UploadFile] = File(...), db=Depends(get_db)):
+    """
+    Decode several images concurrently (at most BARCODE_BATCH_MAX_FILES); one product lookup covers
+    every code found. Unreadable or oversized images get a per-image `error`; a decoder failure fails
+    the request.
+    """
+    _require_pyzbar()
+    if len(files) > BARCODE_BATCH_MAX_FILES:
+        raise HTTPException(413, f"Máximo {BARCODE_BATCH_MAX_FILES} imágenes por lote")
+    results = await asyncio.gather(*(_decode_upload(f) for f in files), return_exceptions=True)
+    products = await run_in_threadpool(
+        _products_by_code, db, [c for r in results if not isinstance(r, Exception) for c, _ in r])
+    images = []
+    for f, r in zip(files, results):
+        if isinstance(r, HTTPException) and r.status_code < 500:
+            images.append({"filename": f.filename, "count": 0, "barcodes": [], "error": r.detail})
+        elif isinstance(r, Exception):
+            raise r
+        else:
+            payload = _barcode_payload(r, products)
+            images.append({"filename": f.filename, "count": len(payload), "barcodes": payload})
+    return {"count": sum(i["count"] for i in images), "images": images}
+
+def _resolve_sale_products(db, lines: List[SaleLineIn]) -> dict:
+    """Products for every line in one query; keys are ("id", product_id) and ("code", id_code)."""
+    ids = {l.product_id for l in lines if l.product_id}
+    codes = {l.id_code for l in lines if not l.product_id}
+    found = {}
+    for prod in db.query(Product).filter(or_(Product.id.in_(ids), Product.id_code.in_(codes))):
+        found[("id", prod.id)] = prod
+        found[("code", prod.id_code)] = prod
+    return found
+
 @app.post("/sales", response_model=SaleOut)
-def create_sale(s: SaleIn, user: User = Depends(get_current_user), db=Depends(get_db)):
+def create_sale(s: SaleIn, user: Principal = Depends(get_current_user), db=Depends(get_db)):
+    """
+    One product (`product_id` or `id_code`, `quantity`, `unit_price`) or a cart in `lines`. The sale,
+    its items and their OUT movements go in with a single commit; ids come from the flush.
+    """
     _require_sales_role(user)
-    if not s.product_id and not s.id_code:
-        raise HTTPException(400, "Provide product_id or id_code")
-
-    if s.product_id:
-        prod = db.query(Product).filter(Product.id == s.product_id).first()
+    if s.lines is not None:
+        lines = s.lines
     else:
-        prod = db.query(Product).filter(Product.id_code == s.id_code).first()
-
-    if not prod:
-        raise HTTPException(404, "Product not found")
-
-    qty = int(s.quantity)
-    if qty <= 0:
-        raise HTTPException(400, "quantity must be > 0")
-
-    unit_price = s.unit_price if s.unit_price is not None else prod.unit_cost
-    unit_price = float(unit_price) if unit_price is not None else 0.0
-    subtotal = unit_price * qty
-
-    sale = Sale(customer=s.customer, note=s.note, total=subtotal)
-    db.add(sale); db.commit(); db.refresh(sale)
-
-    item = SaleItem(sale_id=sale.id, product_id=prod.id, quantity=qty, unit_price=unit_price, subtotal=subtotal)
-    db.add(item)
-
-    # Register OUT movement linked logically via note/reason
-    mv = InventoryMovement(
+        lines = [SaleLineIn(product_id=s.product_id, id_code=s.id_code, quantity=s.quantity or 0,
+                            unit_price=s.unit_price)]
+    if not lines:
+        raise HTTPException(400, "lines must not be empty")
+    for line in lines:
+        if not line.product_id and not line.id_code:
+            raise HTTPException(400, "Provide product_id or id_code")
+        if line.quantity <= 0:
+            raise HTTPException(400, "quantity must be > 0")
+
+    products = _resolve_sale_products(db, lines)
+    missing = [str(l.product_id or l.id_code) for l in lines
+               if (("id", l.product_id) if l.product_id else ("code", l.id_code)) not in products]
+    if missing:
+        raise HTTPException(404, f"Product not found: {', '.join(missing)}")
+
+    priced = []
+    for line in lines:
+        prod = products[("id", line.product_id) if line.product_id else ("code", line.id_code)]
+        unit_price = line.unit_price if line.unit_price is not None else prod.unit_cost
+        unit_price = float(unit_price) if unit_price is not None else 0.0
+        priced.append((prod, int(line.quantity), unit_price, unit_price * int(line.quantity)))
+
+    sale = Sale(customer=s.customer, note=s.note, total=sum(p[3] for p in priced))
+    db.add(sale)
+    db.flush()  # sale.id / created_at, no commit yet
+
+    # Register OUT movements linked logically via note/reason
+    moved = _insert_movements(db, [dict(
         product_id=prod.id,
         movement_type="OUT",
         quantity=qty,
         unit_cost=unit_price,
         movement_reason="SALE",
-        note=f"SALE #{sale.id}" + (f" · {s.note}" if s.note else "")
-    )
-    db.add(mv)
-    db.commit()
-
-    return SaleOut(
+        note=f"SALE #{sale.id}" + (f" · {s.note}" if s.note else ""),
+        moved_at=sale.created_at,
+    ) for prod, qty, unit_price, _ in priced])
+    # COGS for each line: movement_costs
+    items = [SaleItem(sale_id=sale.id, product_id=prod.id, quantity=qty, unit_price=unit_price, subtotal=subtotal,
+                      movement_id=m["id"])
+             for (prod, qty, unit_price, subtotal), m in zip(priced, moved)]
+    db.add_all(items)
+    db.flush()
+
+    out = SaleOut(
         id=sale.id,
         created_at=sale.created_at,
-        product_id=prod.id,
-        id_code=prod.id_code,
-        quantity=qty,
-        unit_price=unit_price,
-        subtotal=subtotal,
-        total=subtotal,
+        total=sale.total,
         customer=sale.customer,
-        note=sale.note
+        note=sale.note,
+        items=[SaleItemOut(id=item.id, product_id=prod.id, id_code=prod.id_code, description=prod.description,
+                           quantity=qty, unit_price=unit_price, subtotal=subtotal, movement_id=item.movement_id)
+               for item, (prod, qty, unit_price, subtotal) in zip(items, priced)],
     )
+    if len(priced) == 1:
+        prod, qty, unit_price, subtotal = priced[0]
+        out.product_id, out.id_code, out.quantity, out.unit_price, out.subtotal = (prod.id, prod.id_code, qty,
+                                                                                    unit_price, subtotal)
+    db.commit()
+    return out
 
-@app.get("/sales")
-def list_sales(limit: int = 50, offset: int = 0, order: str = "desc", db=Depends(get_db)):
-    q = (
+def _sales_query(db):
+    return (
         db.query(
             Sale.id, Sale.created_at, Sale.customer, Sale.note, Sale.total,
             SaleItem.product_id, Product.id_code, Product.description,
-            SaleItem.quantity, SaleItem.unit_price, SaleItem.subtotal
+            SaleItem.quantity, SaleItem.unit_price, SaleItem.subtotal, SaleItem.id
         )
         .join(SaleItem, SaleItem.sale_id == Sale.id)
         .join(Product, Product.id == SaleItem.product_id)
     )
-    q = q.order_by(Sale.created_at.asc() if order.lower()=="asc" else Sale.created_at.desc())
-    rows = q.limit(limit).offset(offset).all()
-    return [dict(
-        id=r[0], created_at=r[1], customer=r[2], note=r[3], total=r[4],
-        product_id=r[5], id_code=r[6], description=r[7],
-        quantity=r[8], unit_price=r[9], subtotal=r[10],
-    ) for r in rows]
+
+_SALE_LIST_FIELDS = ("id", "created_at", "customer", "note", "total", "product_id", "id_code", "description",
+                     "quantity", "unit_price", "subtotal")
+
+def _sales_page(db, limit: int, offset: int, order: str, cursor: Optional[str]):
+    # One row per sale line: SaleItem.id breaks ties so a page can end mid-sale
+    q = _keyset(_sales_query(db), (Sale.created_at, Sale.id, SaleItem.id), cursor, order)
+    rows = q.limit(limit).offset(0 if cursor else offset).all()
+    next_cursor = _encode_cursor(rows[-1][1], rows[-1][0], rows[-1][11]) if len(rows) == limit else None
+    return [r[:11] for r in rows], next_cursor  # tuples in _SALE_LIST_FIELDS order
+
+@app.get("/sales")
+def list_sales(limit: int = 50, offset: int = 0, order: str = "desc", cursor: Optional[str] = None,
+               fmt: str = Query("rows", alias="format"), db=Depends(get_db)):
+    _check_list_format(fmt)
+    rows, next_cursor = _sales_page(db, limit, offset, order, cursor)
+    return Response(content=_rows_json(_SALE_LIST_FIELDS, rows, fmt), media_type="application/json",
+                    headers={"X-Next-Cursor": next_cursor} if next_cursor else None)
 
 @app.get("/export/sales.csv")
-def export_sales(limit: int = 1000, offset: int = 0, order: str = "desc", db=Depends(get_db)):
-    data = list_sales(limit=limit, offset=offset, order=order, db=db)
-    out = io.StringIO(); w = _csv.writer(out)
-    w.writerow(["sale_id","created_at","customer","id_code","description","quantity","unit_price","subtotal","total","note"])
-    for r in data:
-        w.writerow([r["id"], r["created_at"], r["customer"] or "", r["id_code"], r["description"], r["quantity"], r["unit_price"] or "", r["subtotal"], r["total"], r["note"] or ""])
-    out.seek(0)
-    return StreamingResponse(iter([out.getvalue()]), media_type="text/csv",
-                             headers={"Content-Disposition":"attachment; filename=sales.csv"})
+def export_sales(request: Request, limit: Optional[int] = Query(None, ge=0), offset: int = Query(0, ge=0),
+                 order: str = "desc", cursor: Optional[str] = None, date_from: Optional[datetime] = None,
+                 date_to: Optional[datetime] = None):
+    after = _decode_cursor(cursor, 3) if cursor else None  # validated before the stream starts
+
+    def build(db):
+        q = _date_range(_sales_query(db), Sale.created_at, date_from, date_to)
+        q = _seek(q, (Sale.created_at, Sale.id, SaleItem.id), after, order)
+        if not after and offset:
+            q = q.offset(offset)
+        return q.limit(limit) if limit else q
+
+    rows = ([r[0], r[1], r[2] or "", r[6], r[7], r[8], r[9] or "", r[10], r[4], r[3] or ""] for r in _stream_query(build))
+    return _csv_response(request, "sales.csv",
+                         ["sale_id","created_at","customer","id_code","description","quantity","unit_price","subtotal","total","note"],
+                         rows)
 
 @app.get("/users", response_model=List[UserOut], dependencies=[Depends(require_admin)])
 def list_users(limit: int = 50, offset: int = 0, db=Depends(get_db)):
@@ -1027,9 +2844,12 @@ def update_user_admin(user_id: int, payload: UserUpdate, db=Depends(get_db)):
     if payload.password:
         u.password_hash = get_password_hash(payload.password)
 
+    u.token_version = (u.token_version or 0) + 1
     db.add(u)
+    _bump_versions(db, "users")
     db.commit()
     db.refresh(u)
+    _invalidate_principals(user_id)
     return u
 
 @app.delete("/users/{user_id}", dependencies=[Depends(require_admin)])
@@ -1038,7 +2858,9 @@ def delete_user_admin(user_id: int, db=Depends(get_db)):
     if not u:
         raise HTTPException(404, "User not found")
     db.delete(u)
+    _bump_versions(db, "users")
     db.commit()
+    _invalidate_principals(user_id)
     return {"detail": "deleted"}
 
 @app.get("/orders/search", response_model=OrderOut)
@@ -1047,14 +2869,18 @@ def search_order(code: str, db: Session = Depends(get_db)):
     if not order:
         raise HTTPException(status_code=404, detail="Orden no encontrada")
     
-    # Construimos la respuesta plana para facilitar a Flutter
+    # Construimos la respuesta plana para facilitar a Flutter (renglones + producto en una sola consulta)
     response_items = []
-    for item in order.items:
+    for product_id, product_code, description, quantity in (
+            db.query(Product.id, Product.id_code, Product.description, OrderItem.quantity)
+              .join(Product, Product.id == OrderItem.product_id)
+              .filter(OrderItem.order_id == order.id)
+              .order_by(OrderItem.id)):
         response_items.append({
-            "product_id": item.product.id,
-            "product_code": item.product.id_code,
-            "description": item.product.description,
-            "quantity": item.quantity
+            "product_id": product_id,
+            "product_code": product_code,
+            "description": description,
+            "quantity": quantity
         })
         
     return {
@@ -1066,73 +2892,319 @@ def search_order(code: str, db: Session = Depends(get_db)):
         "items": response_items
     }
 
+DEFAULT_WAREHOUSE_ID = 1
+
+_wh = WarehouseStock.__table__
+_wh_qty = func.coalesce(_wh.c.quantity, 0)
+# Conditional so a concurrent writer can never push a warehouse below zero, nor below what is reserved
+# unless the units leaving are covered by the reservation released in the same statement
+_warehouse_delta_update = (update(_wh)
+                           .where(_wh.c.product_id == bindparam("b_pid"), _wh.c.warehouse_id == bindparam("b_wid"),
+                                  _wh_qty + bindparam("b_delta") >= 0,
+                                  or_(_wh_qty + bindparam("b_delta") >= _wh.c.reserved - bindparam("b_release"),
+                                      -bindparam("b_delta") <= bindparam("b_release")))
+                           .values(quantity=_wh_qty + bindparam("b_delta"),
+                                   reserved=_wh.c.reserved - bindparam("b_release")))
+_warehouse_reserve_update = (update(_wh)
+                             .where(_wh.c.product_id == bindparam("b_pid"), _wh.c.warehouse_id == bindparam("b_wid"),
+                                    _wh_qty - _wh.c.reserved >= bindparam("b_qty"))
+                             .values(reserved=_wh.c.reserved + bindparam("b_qty")))
+
+def _ensure_warehouse_rows(db, keys):
+    """Create missing (product_id, warehouse_id) rows with quantity 0 in one statement."""
+    params = [{"product_id": pid, "warehouse_id": wid, "quantity": 0} for pid, wid in sorted(set(keys))]
+    if params:
+        db.execute(_dialect_insert(db, _wh).on_conflict_do_nothing(index_elements=["product_id", "warehouse_id"]),
+                   params)
+
+def _execute_all_rows(db, stmt, params: list) -> bool:
+    """executemany `stmt`; True only if every parameter set matched exactly one row."""
+    if not params:
+        return True
+    if db.get_bind().dialect.supports_sane_multi_rowcount:
+        return db.execute(stmt, params).rowcount == len(params)
+    # e.g. psycopg2 batches executemany and reports no per-row counts
+    return all(db.execute(stmt, p).rowcount == 1 for p in params)
+
+def _apply_warehouse_deltas(db, deltas: dict, releases: Optional[dict] = None) -> bool:
+    """
+    Apply {(product_id, warehouse_id): delta} as one executemany conditional UPDATE, releasing
+    `releases` {(product_id, warehouse_id): units} of reservation in the same statement. Returns False
+    if any row was missing, would have gone negative or would have taken units reserved for someone
+    else; the caller must then roll back.
+    """
+    releases = releases or {}
+    params = [{"b_pid": pid, "b_wid": wid, "b_delta": deltas.get((pid, wid), 0), "b_release": releases.get((pid, wid), 0)}
+              for pid, wid in sorted(set(deltas) | set(releases))]
+    return _execute_all_rows(db, _warehouse_delta_update, [p for p in params if p["b_delta"] or p["b_release"]])
+
+def _available_stock(db, warehouse_id: int, product_ids) -> dict:
+    """{product_id: quantity - reserved} in one warehouse (missing rows are simply absent)."""
+    return dict(db.query(WarehouseStock.product_id, func.coalesce(WarehouseStock.quantity, 0) - WarehouseStock.reserved)
+                  .filter(WarehouseStock.warehouse_id == warehouse_id, WarehouseStock.product_id.in_(product_ids))
+                  .all())
+
+def _require_default_warehouse(db):
+    """Orders are filled from DEFAULT_WAREHOUSE_ID; without it their warehouse stock rows can't exist."""
+    if db.query(Warehouse.id).filter(Warehouse.id == DEFAULT_WAREHOUSE_ID).first() is None:
+        raise HTTPException(409, f"El almacén predeterminado (id {DEFAULT_WAREHOUSE_ID}) no existe; "
+                                 "créelo en /warehouses antes de registrar órdenes")
+
+def _reserve_stock(db, order_id: int, needed: dict, warehouse_id: int = DEFAULT_WAREHOUSE_ID):
+    """
+    Promise {product_id: units} of `warehouse_id` to an order: one conditional UPDATE per row raises
+    `reserved` only while quantity - reserved covers it, then the reservation lines are inserted.
+    """
+    names = dict(db.query(Product.id, Product.description).filter(Product.id.in_(needed)).all())
+    available = _available_stock(db, warehouse_id, needed)
+    short = [f"{names[pid]} (disponible {available.get(pid, 0)})" for pid in sorted(needed)
+             if available.get(pid, 0) < needed[pid]]
+    if short:
+        raise HTTPException(400, f"Stock insuficiente para apartar: {', '.join(short)}")
+    params = [{"b_pid": pid, "b_wid": warehouse_id, "b_qty": qty} for pid, qty in sorted(needed.items())]
+    if not _execute_all_rows(db, _warehouse_reserve_update, params):
+        raise HTTPException(409, "El stock del almacén cambió durante el proceso; reintente")
+    db.execute(insert(StockReservation), [{"order_id": order_id, "product_id": pid, "warehouse_id": warehouse_id,
+                                           "quantity": qty, "status": "ACTIVE", "created_at": datetime.utcnow()}
+                                          for pid, qty in sorted(needed.items())])
+
+def _close_reservations(db, order_id: int, status: str) -> dict:
+    """
+    Mark the order's ACTIVE reservations CONSUMED or RELEASED and return {(product_id, warehouse_id): units}
+    for the caller to take off WarehouseStock.reserved (through _apply_warehouse_deltas).
+    """
+    rows = (db.query(StockReservation.product_id, StockReservation.warehouse_id, func.sum(StockReservation.quantity))
+              .filter(StockReservation.order_id == order_id, StockReservation.status == "ACTIVE")
+              .group_by(StockReservation.product_id, StockReservation.warehouse_id).all())
+    db.execute(update(StockReservation.__table__)
+               .where(StockReservation.__table__.c.order_id == order_id, StockReservation.__table__.c.status == "ACTIVE")
+               .values(status=status, closed_at=datetime.utcnow()))
+    return {(pid, wid): int(qty) for pid, wid, qty in rows}
+
+# ---------- Evidence store ----------
+def _evidence_path(sha: str, thumb: bool = False) -> str:
+    return os.path.join(EVIDENCE_DIR, sha[:2], sha + (".thumb.jpg" if thumb else ""))
+
+def _store_evidence(db, upload: UploadFile):
+    """
+    Stream the upload to disk while hashing it, then keep one file per content hash. Adds the
+    EvidenceFile row in `db`'s transaction if new (caller commits). Returns the sha256.
+    Files are never deleted here, even if the caller rolls back: another request may already share
+    (and commit) the same file. Unreferenced files are swept offline by evidence_gc.py.
+    """
+    os.makedirs(os.path.join(EVIDENCE_DIR, "tmp"), exist_ok=True)
+    h, size = hashlib.sha256(), 0
+    tmp_path = os.path.join(EVIDENCE_DIR, "tmp", f"{os.getpid()}-{threading.get_ident()}-{time.monotonic_ns()}")
+    with open(tmp_path, "wb") as out:
+        while chunk := upload.file.read(1024 * 1024):
+            h.update(chunk)
+            size += len(chunk)
+            out.write(chunk)
+    sha = h.hexdigest()
+    path = _evidence_path(sha)
+    try:
+        os.utime(path)  # dedup hit; the fresh mtime keeps the sweep off a file a request is about to reference
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+    db.execute(_dialect_insert(db, EvidenceFile.__table__).on_conflict_do_nothing(index_elements=["sha256"]),
+               {"sha256": sha, "content_type": upload.content_type, "size_bytes": size,
+                "original_filename": upload.filename, "created_at": datetime.utcnow()})
+    return sha
+
+def _legacy_evidence_paths(url: str) -> tuple:
+    """
+    Where evidence stored before content addressing may live: orders kept the relative path they were
+    written to (uploads/evidence/{order_code}_{filename}), or its file moved along with EVIDENCE_DIR.
+    """
+    return os.path.abspath(url), os.path.abspath(os.path.join(EVIDENCE_DIR, os.path.basename(url)))
+
+def _adopt_legacy_evidence(db, dry_run: bool = False) -> List[tuple]:
+    """
+    Hash evidence files that orders still point to by path into the content-addressed store and
+    rewrite those orders to /evidence/{sha} (caller commits). The old files stay where they are;
+    once the orders are committed nothing references them and the sweep removes them. Returns
+    (order_code, old url, new url or None when the file is gone) per legacy order; `dry_run` only
+    hashes.
+    """
+    done = []
+    for oid, code, url in db.execute(select(Order.id, Order.order_code, Order.evidence_photo_url)
+                                     .where(Order.evidence_photo_url.isnot(None),
+                                            ~Order.evidence_photo_url.like("/evidence/%"))
+                                     .order_by(Order.id)).all():
+        path = next((p for p in _legacy_evidence_paths(url) if os.path.isfile(p)), None)
+        if path is None:
+            done.append((code, url, None))
+            continue
+        name = os.path.basename(path)
+        if name.startswith(f"{code}_"):
+            name = name[len(code) + 1:]
+        with open(path, "rb") as f:
+            if dry_run:
+                h = hashlib.sha256()
+                while chunk := f.read(1024 * 1024):
+                    h.update(chunk)
+                done.append((code, url, f"/evidence/{h.hexdigest()}"))
+                continue
+            sha = _store_evidence(db, UploadFile(f, filename=name, headers=Headers(
+                {"content-type": mimetypes.guess_type(name)[0] or "application/octet-stream"})))
+        db.execute(update(Order.__table__).where(Order.__table__.c.id == oid)
+                   .values(evidence_photo_url=f"/evidence/{sha}"))
+        done.append((code, url, f"/evidence/{sha}"))
+    return done
+
+def _evidence_orphans(db, older_than: timedelta) -> List[str]:
+    """
+    Paths under EVIDENCE_DIR that no committed EvidenceFile row or order references (originals,
+    thumbnails, abandoned tmp uploads), untouched for at least `older_than`. A file an order
+    points to by path (legacy evidence) is always kept.
+    """
+    cutoff = time.time() - older_than.total_seconds()
+    stale = []
+    for root, _, files in os.walk(EVIDENCE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    stale.append(path)
+            except FileNotFoundError:
+                continue
+    # Listed before reading the references: a file committed in between is referenced by then
+    referenced = set(db.execute(select(EvidenceFile.sha256)).scalars().all())
+    kept = set()
+    for url in db.execute(select(Order.evidence_photo_url).where(Order.evidence_photo_url.isnot(None))).scalars():
+        if url.startswith("/evidence/"):
+            referenced.add(url.rsplit("/", 1)[-1])
+        else:
+            kept.update(_legacy_evidence_paths(url))
+    tmp_dir = os.path.join(EVIDENCE_DIR, "tmp")
+    return [p for p in stale if os.path.abspath(p) not in kept
+            and (os.path.dirname(p) == tmp_dir or os.path.basename(p).split(".", 1)[0] not in referenced)]
+
+def _make_evidence_thumbnail(sha: str) -> bool:
+    """Write a web-sized JPEG next to the original. False if the evidence is not an image."""
+    target = _evidence_path(sha, thumb=True)
+    if os.path.exists(target):
+        return True
+    try:
+        with Image.open(_evidence_path(sha)) as img:
+            img.draft("RGB", (EVIDENCE_THUMB_SIDE, EVIDENCE_THUMB_SIDE))
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            img.thumbnail((EVIDENCE_THUMB_SIDE, EVIDENCE_THUMB_SIDE))
+            tmp = f"{target}.{os.getpid()}.tmp"
+            img.save(tmp, "JPEG", quality=80, optimize=True)
+            os.replace(tmp, target)
+        return True
+    except Exception:
+        return False
+
+@app.get("/evidence/{sha}")
+def get_evidence(sha: str, request: Request, size: str = "original", db=Depends(get_db)):
+    """
+    `size=thumb` serves the web-sized JPEG (built on demand if the background job hasn't run yet).
+    Content-addressed, so the ETag never changes: If-None-Match gets a 304, Range is honoured.
+    """
+    ev = db.query(EvidenceFile).filter(EvidenceFile.sha256 == sha.lower()).first()
+    if not ev or not os.path.exists(_evidence_path(ev.sha256)):
+        raise HTTPException(404, "Evidencia no encontrada")
+    thumb = size == "thumb" and _make_evidence_thumbnail(ev.sha256)
+    etag = f'"{ev.sha256}{"-thumb" if thumb else ""}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=31536000, immutable"}
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+    if thumb:
+        return FileResponse(_evidence_path(ev.sha256, thumb=True), media_type="image/jpeg", headers=headers)
+    return FileResponse(_evidence_path(ev.sha256), media_type=ev.content_type or "application/octet-stream",
+                        headers=headers, filename=ev.original_filename, content_disposition_type="inline")
+
 @app.post("/orders/{order_id}/complete")
 def complete_order(
     order_id: int, 
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...), 
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_user)
 ):
     order = db.query(Order).filter(Order.id == order_id).first()
     if not order: raise HTTPException(404, "Orden no encontrada")
     if order.status == "COMPLETED": raise HTTPException(400, "Orden ya completada")
+    if order.status == "CANCELLED": raise HTTPException(400, "Orden cancelada")
+
+    # Guardar evidencia (antes de tomar locks; un archivo por contenido). Si algo falla el archivo
+    # se queda: otra orden puede compartirlo. evidence_gc.py barre los que nadie referencia.
+    sha = _store_evidence(db, file)
+    try:
+        _complete_order_stock(db, order, current_user)
+        order.evidence_photo_url = f"/evidence/{sha}"
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    background_tasks.add_task(_make_evidence_thumbnail, sha)
+    return {"message": "Orden procesada y stocks actualizados", "evidence_url": f"/evidence/{sha}"}
+
+def _complete_order_stock(db, order: Order, current_user: Principal):
+    _require_default_warehouse(db)
+    # Reclamar la orden: dos completados simultáneos no pueden pasar ambos (toma el lock de escritura en SQLite)
+    claimed = db.execute(update(Order.__table__)
+                         .where(Order.__table__.c.id == order.id,
+                                Order.__table__.c.status.in_([OrderStatus.PENDING.value, OrderStatus.IN_PROGRESS.value]))
+                         .values(status=OrderStatus.COMPLETED.value)).rowcount
+    if claimed != 1:
+        raise HTTPException(400, "Orden ya completada o cancelada")
 
-    # Guardar evidencia
-    file_location = f"uploads/evidence/{order.order_code}_{file.filename}"
-    with open(file_location, "wb+") as file_object:
-        shutil.copyfileobj(file.file, file_object)
-    
     # Configurar tipo
     is_purchase = order.type == "PURCHASE"
     mov_type = "IN" if is_purchase else "OUT"
     mov_reason = "purchase" if is_purchase else "sale"
-    
-    DEFAULT_WAREHOUSE_ID = 1
-
-    for item in order.items:
-        # A. Actualizar Stock por Almacén
-        wh_stock = db.query(WarehouseStock).filter(
-            WarehouseStock.product_id == item.product_id,
-            WarehouseStock.warehouse_id == DEFAULT_WAREHOUSE_ID
-        ).first()
-        
-        if not wh_stock:
-            wh_stock = WarehouseStock(product_id=item.product_id, warehouse_id=DEFAULT_WAREHOUSE_ID, quantity=0)
-            db.add(wh_stock)
-
-        # B. Actualizar Stock Global (Product.stock)
-        product = db.query(Product).filter(Product.id == item.product_id).first()
-
-        if product:
-            # --- CORRECCIÓN AQUÍ: Si es None, usar 0 ---
-            current_global_stock = product.stock if product.stock is not None else 0
-            
-            if is_purchase:
-                wh_stock.quantity += item.quantity
-                product.stock = current_global_stock + item.quantity # Ahora sumamos sobre 0, no sobre None
-            else:
-                # Validar stock suficiente en el ALMACÉN (Lo real)
-                if wh_stock.quantity < item.quantity:
-                    raise HTTPException(400, f"Stock insuficiente en almacén para el producto {product.description}")
-                
-                wh_stock.quantity -= item.quantity
-                product.stock = current_global_stock - item.quantity 
-
-        # C. Registrar Movimiento Histórico
-        new_mov = InventoryMovement(
-            product_id=item.product_id,
-            movement_type=mov_type,
-            movement_reason=mov_reason,
-            quantity=item.quantity,
-            note=f"Orden {order.order_code} | Por: {current_user.email}",
-            moved_at=datetime.utcnow()
-        )
-        db.add(new_mov)
-
-    order.status = "COMPLETED"
-    order.evidence_photo_url = file_location
-    db.commit()
-    return {"message": "Orden procesada y stocks actualizados"}
+    sign = 1 if is_purchase else -1
+
+    product_ids = [pid for (pid,) in db.query(OrderItem.product_id).filter(OrderItem.order_id == order.id)]
+    _ensure_warehouse_rows(db, [(pid, DEFAULT_WAREHOUSE_ID) for pid in product_ids])
+
+    # Una sola ida: renglones + producto + stock del almacén, bloqueados (FOR UPDATE en Postgres)
+    lines = (db.query(OrderItem.product_id, OrderItem.quantity, Product.description,
+                      func.coalesce(WarehouseStock.quantity, 0), WarehouseStock.reserved)
+               .join(Product, Product.id == OrderItem.product_id)
+               .join(WarehouseStock, and_(WarehouseStock.product_id == OrderItem.product_id,
+                                          WarehouseStock.warehouse_id == DEFAULT_WAREHOUSE_ID))
+               .filter(OrderItem.order_id == order.id)
+               .order_by(OrderItem.product_id, OrderItem.id)
+               .with_for_update(of=[WarehouseStock, Product])
+               .all())
+    if len(lines) != len(product_ids):
+        raise HTTPException(400, "La orden tiene productos que no existen")
+
+    needed, on_hand, reserved, names = {}, {}, {}, {}
+    for pid, qty, description, wh_qty, wh_reserved in lines:
+        needed[pid] = needed.get(pid, 0) + qty
+        on_hand[pid], reserved[pid], names[pid] = wh_qty, wh_reserved, description
+    # Lo apartado por esta orden se consume junto con el stock
+    released = _close_reservations(db, order.id, "CONSUMED")
+    if not is_purchase:
+        # Validar stock suficiente en el ALMACÉN (Lo real); lo no apartado no puede tomar lo de otras órdenes
+        own = {pid: released.get((pid, DEFAULT_WAREHOUSE_ID), 0) for pid in needed}
+        short = [names[pid] for pid in needed
+                 if on_hand[pid] < needed[pid]
+                 or (needed[pid] > own[pid] and on_hand[pid] - needed[pid] < reserved[pid] - own[pid])]
+        if short:
+            raise HTTPException(400, f"Stock insuficiente en almacén para: {', '.join(short)}")
+
+    if not _apply_warehouse_deltas(db, {(pid, DEFAULT_WAREHOUSE_ID): sign * q for pid, q in needed.items()}, released):
+        raise HTTPException(409, "El stock del almacén cambió durante el proceso; reintente")
+
+    # Registrar Movimientos Históricos; Product.stock lo actualiza _insert_movements
+    now = datetime.utcnow()
+    _insert_movements(db, [dict(
+        product_id=pid,
+        movement_type=mov_type,
+        movement_reason=mov_reason,
+        quantity=qty,
+        note=f"Orden {order.order_code} | Por: {current_user.email}",
+        moved_at=now,
+        warehouse_id=DEFAULT_WAREHOUSE_ID,
+    ) for pid, qty, _, _, _ in lines])
 
 # 3. CREAR ORDEN (Seed/Prueba para que tengas datos que escanear)
 class OrderCreateItem(BaseModel):
@@ -1151,6 +3223,18 @@ def create_order(order_data: OrderCreate, db: Session = Depends(get_db)):
     if db.query(Order).filter(Order.order_code == order_data.order_code).first():
         raise HTTPException(status_code=400, detail="Código de orden ya existe")
 
+    needed = {}
+    for item in order_data.items:
+        if item.quantity <= 0:
+            raise HTTPException(400, "quantity must be > 0")
+        needed[item.product_id] = needed.get(item.product_id, 0) + item.quantity
+    missing = sorted(set(needed) - _existing_product_ids(db, needed))
+    if missing:
+        raise HTTPException(404, f"Productos no encontrados: {', '.join(map(str, missing))}")
+    if order_data.type != "PURCHASE" and needed:
+        _require_default_warehouse(db)
+
+    # Orden, renglones y apartado en una sola transacción
     new_order = Order(
         order_code=order_data.order_code,
         customer_name=order_data.customer_name,
@@ -1158,88 +3242,261 @@ def create_order(order_data: OrderCreate, db: Session = Depends(get_db)):
         status=OrderStatus.PENDING
     )
     db.add(new_order)
-    db.commit() # Commit para obtener ID
-    db.refresh(new_order)
+    db.flush() # Para obtener ID
+
+    if order_data.items:
+        db.execute(insert(OrderItem), [{"order_id": new_order.id, "product_id": item.product_id,
+                                        "quantity": item.quantity} for item in order_data.items])
+    # Las ventas apartan stock del almacén que las surte; nadie más puede prometer esas unidades
+    if order_data.type != "PURCHASE" and needed:
+        _ensure_warehouse_rows(db, [(pid, DEFAULT_WAREHOUSE_ID) for pid in needed])
+        _reserve_stock(db, new_order.id, needed)
 
-    for item in order_data.items:
-        new_item = OrderItem(
-            order_id=new_order.id,
-            product_id=item.product_id,
-            quantity=item.quantity
-        )
-        db.add(new_item)
-    
     db.commit()
-    return {"message": "Orden creada exitosamente"}
+    return {"message": "Orden creada exitosamente", "id": new_order.id}
+
+@app.post("/orders/{order_id}/cancel")
+def cancel_order(order_id: int, db: Session = Depends(get_db), current_user: Principal = Depends(get_current_user)):
+    """Cancel a pending order and give its reserved units back (available again for other orders)."""
+    t = Order.__table__
+    claimed = db.execute(update(t)
+                         .where(t.c.id == order_id,
+                                t.c.status.in_([OrderStatus.PENDING.value, OrderStatus.IN_PROGRESS.value]))
+                         .values(status=OrderStatus.CANCELLED.value)).rowcount
+    if claimed != 1:
+        status_now = db.query(Order.status).filter(Order.id == order_id).scalar()
+        if status_now is None:
+            raise HTTPException(404, "Orden no encontrada")
+        raise HTTPException(400, f"La orden no se puede cancelar (estado {status_now})")
+    released = _close_reservations(db, order_id, "RELEASED")
+    if not _apply_warehouse_deltas(db, {}, released):
+        raise HTTPException(409, "El stock del almacén cambió durante el proceso; reintente")
+    db.commit()
+    return {"message": "Orden cancelada", "released": sum(released.values())}
+
+_ATP_CHUNK = 1000
+
+@app.get("/stock/atp")
+def stock_atp(skus: str, warehouse_id: Optional[int] = None, db=Depends(get_read_db)):
+    """
+    Available-to-promise for comma-separated `skus` (id_code) in one round trip: `on_hand`, `reserved`
+    and `available` = on_hand - reserved, summed over every warehouse or just `warehouse_id`.
+    Each answer is a unique-index lookup per (product, warehouse) row, never a scan of pending orders.
+    """
+    codes = list(dict.fromkeys(c.strip() for c in skus.split(",") if c.strip()))
+    if not codes:
+        raise HTTPException(400, "skus must be comma-separated product codes")
+    on_hand = func.coalesce(func.sum(func.coalesce(WarehouseStock.quantity, 0)), 0)
+    reserved = func.coalesce(func.sum(WarehouseStock.reserved), 0)
+    join_on = WarehouseStock.product_id == Product.id
+    if warehouse_id is not None:
+        join_on = and_(join_on, WarehouseStock.warehouse_id == warehouse_id)
+    found = {}
+    for i in range(0, len(codes), _ATP_CHUNK):
+        chunk = codes[i:i + _ATP_CHUNK]
+        for pid, code, qty, res in (db.query(Product.id, Product.id_code, on_hand, reserved)
+                                      .outerjoin(WarehouseStock, join_on)
+                                      .filter(Product.id_code.in_(chunk))
+                                      .group_by(Product.id, Product.id_code)):
+            found[code] = {"product_id": pid, "id_code": code, "on_hand": int(qty), "reserved": int(res),
+                           "available": int(qty) - int(res)}
+    return {"warehouse_id": warehouse_id, "items": [found[c] for c in codes if c in found],
+            "missing": [c for c in codes if c not in found]}
 
 @app.post("/warehouses")
 def create_warehouse(wh: WarehouseCreate, db: Session = Depends(get_db)):
     new_wh = Warehouse(name=wh.name, location=wh.location)
     db.add(new_wh)
+    _bump_versions(db, "warehouses")
     db.commit()
     return {"message": "Almacén creado"}
 
 @app.get("/warehouses")
-def get_warehouses(db: Session = Depends(get_db)):
-    return db.query(Warehouse).all()
+def get_warehouses(request: Request, db: Session = Depends(get_db)):
+    return _cached_json(request, db, ("warehouses",), lambda: (db.query(Warehouse).all(), {}))
+
+def _pivot_warehouses(db, warehouse_ids: Optional[str]) -> list:
+    """(id, name) of the warehouses to pivot on: the comma-separated `warehouse_ids`, or all of them."""
+    q = db.query(Warehouse.id, Warehouse.name)
+    if warehouse_ids:
+        try:
+            wanted = {int(w) for w in warehouse_ids.split(",") if w.strip()}
+        except ValueError:
+            raise HTTPException(400, "warehouse_ids must be comma-separated ids, e.g. 1,2,5")
+        q = q.filter(Warehouse.id.in_(wanted))
+        rows = q.order_by(Warehouse.id).all()
+        missing = sorted(wanted - {r[0] for r in rows})
+        if missing:
+            raise HTTPException(404, f"Almacenes no encontrados: {', '.join(map(str, missing))}")
+        return rows
+    return q.order_by(Warehouse.id).all()
+
+def _pivot_products(db, warehouse_ids: list, q: Optional[str], type_id: Optional[int], include_empty: bool):
+    """Products matching the filters; unless `include_empty`, only those with a row in one of `warehouse_ids`."""
+    query = db.query(Product.id, Product.id_code, Product.description, Product.stock)
+    if not include_empty:
+        query = query.filter(select(WarehouseStock.id)
+                             .where(WarehouseStock.product_id == Product.id,
+                                    WarehouseStock.warehouse_id.in_(warehouse_ids)).exists())
+    if q:
+        query, _ = _product_search(query, q)
+    if type_id:
+        query = query.filter(Product.product_type_id == type_id)
+    return query
+
+def _stock_by_warehouse_query(db, warehouse_ids: list, q: Optional[str], type_id: Optional[int],
+                              include_empty: bool, limit: Optional[int] = None, offset: int = 0):
+    """
+    One row per product: (id, id_code, description, qty in each of `warehouse_ids`..., total, stock).
+    The page of products is picked first; only its WarehouseStock rows are then pivoted, one CASE
+    column per warehouse in a single GROUP BY.
+    """
+    products = _pivot_products(db, warehouse_ids, q, type_id, include_empty).order_by(Product.id_code, Product.id)
+    if limit:
+        products = products.limit(limit).offset(offset)
+    page = products.subquery()
+    qty = func.coalesce(WarehouseStock.quantity, 0)
+    pivot = (select(WarehouseStock.product_id,
+                    *[func.sum(case((WarehouseStock.warehouse_id == wid, qty), else_=0)).label(f"w{i}")
+                      for i, wid in enumerate(warehouse_ids)],
+                    func.sum(qty).label("total"))
+             .where(WarehouseStock.warehouse_id.in_(warehouse_ids))
+             .group_by(WarehouseStock.product_id))
+    if limit:
+        pivot = pivot.where(WarehouseStock.product_id.in_(select(page.c.id)))
+    pivot = pivot.subquery()
+    cols = [func.coalesce(pivot.c[f"w{i}"], 0) for i in range(len(warehouse_ids))]
+    return (db.query(page.c.id, page.c.id_code, page.c.description, *cols, func.coalesce(pivot.c.total, 0),
+                     func.coalesce(page.c.stock, 0))
+              .outerjoin(pivot, pivot.c.product_id == page.c.id)
+              .order_by(page.c.id_code, page.c.id))
+
+@app.get("/stock/by_warehouse")
+def stock_by_warehouse(request: Request, warehouse_ids: Optional[str] = None, q: Optional[str] = None,
+                       type_id: Optional[int] = None, include_empty: bool = False, limit: int = 200,
+                       offset: int = 0, fmt: str = Query("rows", alias="format"), db=Depends(get_read_db)):
+    """
+    Product x warehouse stock matrix. `quantities` line up with `warehouses` (all of them, or `warehouse_ids`);
+    the top-level `quantities` / `total` / `stock` / `count` cover every matching product, not just the page.
+    `format=columns` gives one array per field and one array per warehouse in `quantities`.
+    """
+    _check_list_format(fmt)
+    def build():
+        warehouses = _pivot_warehouses(db, warehouse_ids)
+        wids, n = [w[0] for w in warehouses], len(warehouses)
+        matched = _pivot_products(db, wids, q, type_id, include_empty).subquery()
+        count, stock = db.query(func.count(), func.sum(func.coalesce(matched.c.stock, 0))).one()
+        per_warehouse = (db.query(WarehouseStock.warehouse_id, func.sum(func.coalesce(WarehouseStock.quantity, 0)))
+                           .filter(WarehouseStock.warehouse_id.in_(wids)))
+        if q or type_id:
+            per_warehouse = per_warehouse.filter(WarehouseStock.product_id.in_(select(matched.c.id)))
+        per_warehouse = dict(per_warehouse.group_by(WarehouseStock.warehouse_id).all())
+        totals = [int(per_warehouse.get(wid) or 0) for wid in wids]
+        rows = _stock_by_warehouse_query(db, wids, q, type_id, include_empty, limit, offset).all()
+        if fmt == "columns":
+            items = {"product_id": [r[0] for r in rows], "id_code": [r[1] for r in rows],
+                     "description": [r[2] for r in rows],
+                     "quantities": [[int(r[3 + i]) for r in rows] for i in range(n)],
+                     "total": [int(r[n + 3]) for r in rows], "stock": [int(r[n + 4]) for r in rows]}
+        else:
+            items = [{"product_id": r[0], "id_code": r[1], "description": r[2],
+                      "quantities": [int(v) for v in r[3:n + 3]], "total": int(r[n + 3]), "stock": int(r[n + 4])}
+                     for r in rows]
+        return {"warehouses": [{"id": wid, "name": name} for wid, name in warehouses],
+                "count": count, "quantities": totals, "total": sum(totals), "stock": int(stock or 0),
+                "items": items}, {}
+    return _cached_json(request, db, ("movements", "products", "types", "warehouses"), build, to_json)
+
+@app.get("/export/stock_by_warehouse.csv")
+def export_stock_by_warehouse(request: Request, warehouse_ids: Optional[str] = None, q: Optional[str] = None,
+                              type_id: Optional[int] = None, include_empty: bool = False,
+                              db=Depends(get_read_db)):
+    """Same matrix as /stock/by_warehouse, every matching product, one column per warehouse and a TOTAL row."""
+    warehouses = _pivot_warehouses(db, warehouse_ids)
+    wids = [w[0] for w in warehouses]
+
+    def rows():
+        totals = [0] * (len(wids) + 2)
+        for r in _stream_query(lambda s: _stock_by_warehouse_query(s, wids, q, type_id, include_empty)):
+            values = [int(v) for v in r[3:]]
+            totals = [t + v for t, v in zip(totals, values)]
+            yield [r[1], r[2], *values]
+        yield ["TOTAL", "", *totals]
+
+    return _csv_response(request, "stock_por_almacen.csv",
+                         ["codigo", "descripcion", *[name for _, name in warehouses], "total", "stock"], rows())
+
+def _transfer_stock(db, from_wid: int, to_wid: int, lines, notes: Optional[str], user: Principal) -> List[dict]:
+    """
+    Move every (product_id, quantity) line from one warehouse to another in the caller's transaction:
+    destination rows upserted in one statement, both sides changed by one conditional UPDATE each
+    (never below zero or into reserved units, so concurrent transfers cannot both spend the same stock), and the OUT/IN
+    movement pairs inserted in one batch. Product.stock does not change.
+    """
+    if from_wid == to_wid:
+        raise HTTPException(400, "El almacén origen y destino deben ser distintos")
+    needed = {}
+    for product_id, quantity in lines:
+        if quantity <= 0:
+            raise HTTPException(400, "quantity must be > 0")
+        needed[product_id] = needed.get(product_id, 0) + quantity
+    if not needed:
+        raise HTTPException(400, "La transferencia no tiene renglones")
+    found = {wid for (wid,) in db.query(Warehouse.id).filter(Warehouse.id.in_([from_wid, to_wid]))}
+    if found != {from_wid, to_wid}:
+        raise HTTPException(404, "Almacén no encontrado")
+    names = dict(db.query(Product.id, Product.description).filter(Product.id.in_(needed)).all())
+    missing = sorted(set(needed) - set(names))
+    if missing:
+        raise HTTPException(404, f"Productos no encontrados: {', '.join(map(str, missing))}")
+
+    # 1. Validar stock libre en origen (mensaje claro); la garantía real es el UPDATE condicional
+    available = _available_stock(db, from_wid, needed)
+    short = [f"{names[pid]} (disponible {available.get(pid, 0)})" for pid in sorted(needed)
+             if available.get(pid, 0) < needed[pid]]
+    if short:
+        raise HTTPException(400, f"Stock insuficiente en origen: {', '.join(short)}")
+
+    # 2. Mover físicamente: destino creado si falta, resta y suma en una sola ida cada una
+    _ensure_warehouse_rows(db, [(pid, to_wid) for pid in needed])
+    deltas = {}
+    for pid, qty in needed.items():
+        deltas[(pid, from_wid)], deltas[(pid, to_wid)] = -qty, qty
+    if not _apply_warehouse_deltas(db, deltas):
+        raise HTTPException(409, "El stock del almacén cambió durante el proceso; reintente")
+
+    # 3. Registrar historia: OUT + IN consecutivos por producto, se compensan en Product.stock
+    now, rows = datetime.utcnow(), []
+    for pid in sorted(needed):
+        rows.append(dict(product_id=pid, movement_type="OUT", movement_reason="transfer", quantity=needed[pid],
+                         note=f"Transferencia SALIDA a Alm. {to_wid} | {notes or ''} | Por: {user.email}",
+                         moved_at=now, warehouse_id=from_wid))
+        rows.append(dict(product_id=pid, movement_type="IN", movement_reason="transfer", quantity=needed[pid],
+                         note=f"Transferencia ENTRADA de Alm. {from_wid} | {notes or ''} | Por: {user.email}",
+                         moved_at=now, warehouse_id=to_wid))
+    return _insert_movements(db, rows)
 
 @app.post("/movements/transfer")
 def create_transfer(
     transfer: TransferRequest, 
     db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user)
+    current_user: Principal = Depends(get_current_user)
 ):
-    # 1. Validar Stock en Origen (Tabla Pivote)
-    stock_origin = db.query(WarehouseStock).filter(
-        WarehouseStock.product_id == transfer.product_id,
-        WarehouseStock.warehouse_id == transfer.from_warehouse_id
-    ).first()
-
-    current_qty = stock_origin.quantity if stock_origin else 0
-    if current_qty < transfer.quantity:
-        raise HTTPException(status_code=400, detail=f"Stock insuficiente en origen. Disponible: {current_qty}")
-
-    # 2. Buscar/Crear Stock en Destino
-    stock_dest = db.query(WarehouseStock).filter(
-        WarehouseStock.product_id == transfer.product_id,
-        WarehouseStock.warehouse_id == transfer.to_warehouse_id
-    ).first()
-
-    if not stock_dest:
-        stock_dest = WarehouseStock(
-            product_id=transfer.product_id, 
-            warehouse_id=transfer.to_warehouse_id, 
-            quantity=0
-        )
-        db.add(stock_dest)
-    
-    # 3. MOVER FÍSICAMENTE (Resta y Suma en almacenes)
-    stock_origin.quantity -= transfer.quantity
-    stock_dest.quantity += transfer.quantity
+    # Un solo producto; mismo camino que /transfers
+    _transfer_stock(db, transfer.from_warehouse_id, transfer.to_warehouse_id,
+                    [(transfer.product_id, transfer.quantity)], transfer.notes, current_user)
+    db.commit()
     
-    # Nota: En una transferencia interna, el 'Product.stock' (Global) NO cambia, 
-    # porque la mercancía sigue dentro de la empresa.
+    return {"message": "Transferencia exitosa"}
 
-    # 4. Registrar Historia (Bitácora)
-    mov_out = InventoryMovement(
-        product_id=transfer.product_id,
-        movement_type="OUT",
-        movement_reason="transfer",
-        quantity=transfer.quantity,
-        note=f"Transferencia SALIDA a Alm. {transfer.to_warehouse_id} | {transfer.notes or ''} | Por: {current_user.email}",
-        moved_at=datetime.utcnow()
-    )
-    mov_in = InventoryMovement(
-        product_id=transfer.product_id,
-        movement_type="IN",
-        movement_reason="transfer",
-        quantity=transfer.quantity,
-        note=f"Transferencia ENTRADA de Alm. {transfer.from_warehouse_id} | {transfer.notes or ''} | Por: {current_user.email}",
-        moved_at=datetime.utcnow()
-    )
-
-    db.add(mov_out)
-    db.add(mov_in)
+@app.post("/transfers")
+def create_transfer_document(doc: TransferDocument, db: Session = Depends(get_db),
+                             current_user: Principal = Depends(get_current_user)):
+    """
+    Transfer document: every line moves from `from_warehouse_id` to `to_warehouse_id` in one transaction,
+    all or nothing. Lines repeating a product are added together.
+    """
+    rows = _transfer_stock(db, doc.from_warehouse_id, doc.to_warehouse_id,
+                           [(line.product_id, line.quantity) for line in doc.lines], doc.notes, current_user)
     db.commit()
-    
-    return {"message": "Transferencia exitosa"}
\ No newline at end of file
+    return {"message": "Transferencia exitosa", "products": len(rows) // 2, "movement_ids": [r["id"] for r in rows]}
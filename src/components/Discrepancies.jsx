@@ -3,12 +3,20 @@ import { authedFetch, getApiBase } from '../api'
 
 export default function Discrepancies({ token }){
   const [rows, setRows] = React.useState([])
+  const [limit] = React.useState(200)
+  const [offset, setOffset] = React.useState(0)
+  const [total, setTotal] = React.useState(0)
 
-  React.useEffect(()=>{ load() }, [])
+  React.useEffect(()=>{ load() }, [offset])
 
   async function load(){
-    const r = await fetch(getApiBase() + '/discrepancies')
-    if(r.ok){ setRows(await r.json()) } else { setRows([]) }
+    const u = new URL(getApiBase() + '/discrepancies')
+    u.searchParams.set('limit', limit); u.searchParams.set('offset', offset)
+    const r = await fetch(u)
+    if(r.ok){
+      setRows(await r.json())
+      setTotal(Number(r.headers.get('X-Total-Count') || 0))
+    } else { setRows([]); setTotal(0) }
   }
 
   async function resolve(row){
@@ -52,6 +60,13 @@ export default function Discrepancies({ token }){
           ))}
         </tbody>
       </table>
+      <div className="row" style={{justifyContent:'space-between', marginTop:10}}>
+        <div className="row">
+          <button onClick={()=> setOffset(Math.max(0, offset - limit))} disabled={offset === 0}>Anterior</button>
+          <button onClick={()=> setOffset(offset + limit)} disabled={offset + rows.length >= total}>Siguiente</button>
+        </div>
+        <div className="muted small">Mostrando {rows.length ? offset + 1 : 0}–{offset + rows.length} de {total}</div>
+      </div>
     </div>
   )
 }
@@ -13,7 +13,10 @@ export default function Movements({ token, role }){
 
   const [rows, setRows] = React.useState([]);
   const [limit, setLimit] = React.useState(50);
-  const [offset, setOffset] = React.useState(0);
+  // Keyset paging: stack of cursors of the visited pages ('' = first page)
+  const [cursors, setCursors] = React.useState(['']);
+  const [nextCursor, setNextCursor] = React.useState(null);
+  const cursor = cursors[cursors.length - 1];
 
   // Product search + selection with pagination/sorting
   const [q, setQ] = React.useState('');
@@ -75,10 +78,16 @@ export default function Movements({ token, role }){
   }, [role, allowedTypes.join(',')]);
 
   // Load movements list (bottom table)
-  React.useEffect(()=>{ loadMovements() }, [limit, offset]);
-  async function loadMovements(){
-    const r = await fetch(`${getApiBase()}/movements?limit=${limit}&offset=${offset}`);
-    if(r.ok) setRows(await r.json());
+  React.useEffect(()=>{ loadMovements(cursor) }, [limit, cursor]);
+  async function loadMovements(c){
+    const u = new URL(getApiBase() + '/movements');
+    u.searchParams.set('limit', limit);
+    if (c) u.searchParams.set('cursor', c);
+    const r = await fetch(u.toString());
+    if(r.ok) {
+      setRows(await r.json());
+      setNextCursor(r.headers.get('X-Next-Cursor'));
+    }
   }
 
   // Load product types (for filter)
@@ -147,7 +156,7 @@ export default function Movements({ token, role }){
     };
     try{
       await authedFetch('/movements', { method:'POST', body: JSON.stringify(body) });
-      setOffset(0); loadMovements();
+      setCursors(['']); loadMovements('');
       alert('Movimiento creado');
     }catch(e){ alert(e.message); }
   }
@@ -324,10 +333,10 @@ export default function Movements({ token, role }){
       </table>
       <div className="row mt-8" style={{justifyContent:'space-between'}}>
         <div>
-          <button onClick={()=> setOffset(Math.max(0, offset - limit))}>Anterior</button>
-          <button onClick={()=> setOffset(offset + limit)}>Siguiente</button>
+          <button onClick={()=> setCursors(cs => cs.slice(0, -1))} disabled={cursors.length <= 1}>Anterior</button>
+          <button onClick={()=> setCursors(cs => [...cs, nextCursor])} disabled={!nextCursor}>Siguiente</button>
         </div>
-        <div className="muted">Mostrando {rows.length} (offset {offset})</div>
+        <div className="muted">Mostrando {rows.length} (página {cursors.length})</div>
       </div>
     </div>
   )
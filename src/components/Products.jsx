@@ -81,6 +81,7 @@ export default function Products({ token }){
               <th className="right sort" onClick={()=>toggleSort('stock')}>Stock</th>
               <th className="right sort" onClick={()=>toggleSort('unit_cost')}>Costo</th>
               <th className="right sort" onClick={()=>toggleSort('valuation')}>Valuación</th>
+              <th className="right sort" onClick={()=>toggleSort('fifo_value')}>Valuación FIFO</th>
               <th className="sort" onClick={()=>toggleSort('product_type')}>Tipo</th>
               <th>Política</th>
               <th>Acciones</th>
@@ -94,6 +95,7 @@ export default function Products({ token }){
                 <td className="right">{r.stock}</td>
                 <td className="right">{r.unit_cost ?? ''}</td>
                 <td className="right">{r.valuation ?? ''}</td>
+                <td className="right">{r.fifo_value ?? ''}</td>
                 <td>{r.product_type ?? ''}</td>
                 <td className="muted">Min {r.min_stock ?? '-'} · Max {r.max_stock ?? '-'}</td>
                 <td>
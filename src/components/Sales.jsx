@@ -93,20 +93,35 @@ export default function Sales({ token, role }){
   const [customer, setCustomer] = React.useState('')
   const [note, setNote] = React.useState('')
 
+  const [cart, setCart] = React.useState([]) // [{id, id_code, description, quantity, unit_price}]
+
+  function addToCart(){
+    if(!selected) return alert('Selecciona un producto')
+    setCart(c => [...c, {
+      id: selected.id, id_code: selected.id_code, description: selected.description,
+      quantity: Number(saleQty || 1),
+      unit_price: salePrice === '' ? null : Number(salePrice)
+    }])
+  }
+
   async function makeSale(){
     if(!token) return alert('Requiere sesión')
     if(!canMakeSale) return alert(`Tu rol (${role}) no puede crear ventas`)
-    if(!selected) return alert('Selecciona un producto')
+    // Carrito completo en una sola venta; sin carrito, el producto seleccionado
+    const lines = cart.length ? cart : (selected ? [{
+      id: selected.id, quantity: Number(saleQty || 1),
+      unit_price: salePrice === '' ? null : Number(salePrice)
+    }] : [])
+    if(!lines.length) return alert('Selecciona un producto')
     const body = {
-      product_id: selected.id,
-      quantity: Number(saleQty || 1),
-      unit_price: salePrice === '' ? null : Number(salePrice),
+      lines: lines.map(l => ({ product_id: l.id, quantity: l.quantity, unit_price: l.unit_price })),
       customer, note
     }
     try{
       const r = await authedFetch('/sales', { method:'POST', body: JSON.stringify(body) })
       const j = await r.json()
-      alert(`Venta #${j.id} creada: ${j.id_code} x${j.quantity} total=${j.total}`)
+      alert(`Venta #${j.id} creada: ${j.items.map(i => `${i.id_code} x${i.quantity}`).join(', ')} total=${j.total}`)
+      setCart([])
     }catch(e){ alert(e.message) }
   }
 
@@ -238,6 +253,23 @@ export default function Sales({ token, role }){
           </div>
         </div>
 
+        {cart.length > 0 && (
+          <table className="mt-8" style={{width:'100%'}}>
+            <thead><tr><th>Código</th><th>Descripción</th><th className="right">Cantidad</th><th className="right">Precio</th><th></th></tr></thead>
+            <tbody>
+              {cart.map((l, i) => (
+                <tr key={i}>
+                  <td className="mono">{l.id_code}</td>
+                  <td>{l.description}</td>
+                  <td className="right">{l.quantity}</td>
+                  <td className="right">{l.unit_price ?? '(costo)'}</td>
+                  <td><button onClick={()=> setCart(c => c.filter((_, j) => j !== i))}>Quitar</button></td>
+                </tr>
+              ))}
+            </tbody>
+          </table>
+        )}
+
         <div className="row mt-8">
           <div className="grow">
             <div className="muted">Cliente (opcional)</div>
@@ -248,7 +280,10 @@ export default function Sales({ token, role }){
             <input value={note} onChange={e=>setNote(e.target.value)} />
           </div>
           <div style={{alignSelf:'flex-end'}}>
-            <button className="btn-primary" onClick={makeSale} disabled={!canMakeSale}>Crear venta</button>
+            <button onClick={addToCart} disabled={!canMakeSale || !selected}>Agregar al carrito</button>
+          </div>
+          <div style={{alignSelf:'flex-end'}}>
+            <button className="btn-primary" onClick={makeSale} disabled={!canMakeSale}>Crear venta{cart.length ? ` (${cart.length})` : ''}</button>
           </div>
         </div>
       </div>
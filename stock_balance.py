@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+from datetime import date
+
+from main import (SessionLocal, _verify_stock_balances, _rebuild_stock_balances, _sync_discrepancies,
+                  _rebuild_cost_layers, _rebuild_rollups)
+
+
+def verify() -> int:
+    """Print products whose Product.stock disagrees with the ledger. Returns the number found."""
+    with SessionLocal() as db:
+        drift = _verify_stock_balances(db)
+    for pid, code, stock, ledger in drift:
+        print(f"{code} (id={pid}): stock={stock} ledger={ledger}")
+    print(f"{len(drift)} product(s) out of sync")
+    return len(drift)
+
+
+def rebuild() -> int:
+    """Reset drifted Product.stock values to the ledger sum. Returns the number fixed."""
+    with SessionLocal() as db:
+        fixed = _rebuild_stock_balances(db)
+    print(f"Rebuilt {fixed} product balance(s)")
+    return fixed
+
+
+def reindex_discrepancies() -> None:
+    """Re-evaluate every product against the discrepancy rules and refresh open_discrepancies."""
+    with SessionLocal() as db:
+        _sync_discrepancies(db)
+        db.commit()
+    print("Discrepancy index rebuilt")
+
+
+def rebuild_costs() -> None:
+    """Recompute FIFO cost layers and cost of goods issued from the whole ledger."""
+    with SessionLocal() as db:
+        products, movements = _rebuild_cost_layers(db)
+    print(f"Cost layers rebuilt: {products} product(s), {movements} movement(s)")
+
+
+def rebuild_rollups(date_from, date_to) -> None:
+    """Recompute the daily movement rollups for a date range (whole ledger by default)."""
+    with SessionLocal() as db:
+        written = _rebuild_rollups(db, date_from, date_to)
+    print(f"Movement rollups rebuilt: {written} row(s)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Verify or rebuild Product.stock from the movement ledger.")
+    parser.add_argument("command", choices=["verify", "rebuild", "discrepancies", "costs", "rollups"],
+                        help="verify: report drift (exit 1 if any); rebuild: fix drifted balances; "
+                             "discrepancies: rebuild the discrepancy index; costs: rebuild FIFO cost layers; "
+                             "rollups: rebuild daily movement rollups.")
+    parser.add_argument("--date-from", type=date.fromisoformat, default=None, help="rollups: first day (YYYY-MM-DD)")
+    parser.add_argument("--date-to", type=date.fromisoformat, default=None, help="rollups: last day (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    if args.command == "verify":
+        sys.exit(1 if verify() else 0)
+    if args.command == "discrepancies":
+        reindex_discrepancies()
+        return
+    if args.command == "costs":
+        rebuild_costs()
+        return
+    if args.command == "rollups":
+        rebuild_rollups(args.date_from, args.date_to)
+        return
+    rebuild()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import argparse
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from main import SessionLocal, InventoryMovement, StockSnapshot, StockSnapshotLine, _take_snapshot
+
+
+def _midnight(value: datetime) -> datetime:
+    return datetime.combine(value.date(), datetime.min.time())
+
+
+def _next(at: datetime, every: str) -> datetime:
+    if every == "day":
+        return at + timedelta(days=1)
+    if every == "week":
+        return at + timedelta(days=7)
+    return (at.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def take(at: datetime) -> None:
+    """Checkpoint balances as of `at` (movements with moved_at < at)."""
+    with SessionLocal() as db:
+        snap = _take_snapshot(db, at)
+        db.commit()
+        lines = db.query(func.count()).filter(StockSnapshotLine.snapshot_id == snap.id).scalar()
+    print(f"Snapshot {at.isoformat()}: {lines} line(s)")
+
+
+def backfill(start, end: datetime, every: str) -> int:
+    """Checkpoint every day/week/month boundary in [start, end]. Returns the number of snapshots."""
+    with SessionLocal() as db:
+        if start is None:
+            first = db.query(func.min(InventoryMovement.moved_at)).scalar()
+            if first is None:
+                print("No movements, nothing to backfill")
+                return 0
+            start = _midnight(first) if every != "month" else _midnight(first).replace(day=1)
+        at, count = start, 0
+        while at <= end:
+            _take_snapshot(db, at)
+            db.commit()
+            count += 1
+            at = _next(at, every)
+    print(f"Backfilled {count} snapshot(s) up to {end.isoformat()}")
+    return count
+
+
+def list_snapshots() -> None:
+    with SessionLocal() as db:
+        rows = (db.query(StockSnapshot.taken_at, func.count(StockSnapshotLine.product_id))
+                  .outerjoin(StockSnapshotLine, StockSnapshotLine.snapshot_id == StockSnapshot.id)
+                  .group_by(StockSnapshot.id, StockSnapshot.taken_at)
+                  .order_by(StockSnapshot.taken_at).all())
+    for taken_at, lines in rows:
+        print(f"{taken_at.isoformat()}  {lines} line(s)")
+    print(f"{len(rows)} snapshot(s)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stock balance snapshots for point-in-time queries (/stock/as_of).")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("take", help="Checkpoint balances now (default: today 00:00 UTC, i.e. end of yesterday).")
+    p.add_argument("--at", type=datetime.fromisoformat, default=None)
+    p = sub.add_parser("backfill", help="Checkpoint every boundary over the movement history.")
+    p.add_argument("--from", dest="start", type=datetime.fromisoformat, default=None,
+                   help="first boundary (default: start of the first movement's day/month)")
+    p.add_argument("--to", dest="end", type=datetime.fromisoformat, default=None, help="last boundary (default: today)")
+    p.add_argument("--every", choices=["day", "week", "month"], default="month")
+    sub.add_parser("list", help="Show existing snapshots.")
+    args = parser.parse_args()
+
+    if args.command == "take":
+        take(args.at or _midnight(datetime.utcnow()))
+    elif args.command == "backfill":
+        backfill(args.start, args.end or _midnight(datetime.utcnow()), args.every)
+    else:
+        list_snapshots()
+
+
+if __name__ == "__main__":
+    main()
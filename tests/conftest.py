@@ -0,0 +1,60 @@
+# Each test run gets a throwaway SQLite database and evidence folder; they must be set before main is imported.
+import os, sys, tempfile
+
+_TMP = tempfile.mkdtemp(prefix="inventory-tests-")
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_TMP, "test.db")
+os.environ["EVIDENCE_DIR"] = os.path.join(_TMP, "evidence")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import itertools
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+_codes = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def client():
+    return TestClient(main.app)
+
+
+@pytest.fixture(scope="session")
+def auth(client):
+    client.post("/auth/register", json={"email": "admin@test", "password": "secret", "role": "admin"})
+    token = client.post("/auth/login", data={"username": "admin@test", "password": "secret"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def db():
+    with main.SessionLocal() as session:
+        yield session
+
+
+@pytest.fixture(scope="session", autouse=True)
+def default_warehouse():
+    with main.SessionLocal() as session:
+        if session.get(main.Warehouse, main.DEFAULT_WAREHOUSE_ID) is None:
+            session.add(main.Warehouse(id=main.DEFAULT_WAREHOUSE_ID, name="Principal"))
+            session.commit()
+
+
+@pytest.fixture
+def make_product(db):
+    """Product with `on_hand` units received into the default warehouse; returns its id."""
+    def make(on_hand: int = 0, unit_cost: float = 10.0) -> int:
+        code = f"T-{next(_codes):05d}"
+        product = main.Product(id_code=code, description=f"Producto {code}", unit_cost=unit_cost)
+        db.add(product)
+        db.flush()
+        main._ensure_warehouse_rows(db, [(product.id, main.DEFAULT_WAREHOUSE_ID)])
+        if on_hand:
+            main._apply_warehouse_deltas(db, {(product.id, main.DEFAULT_WAREHOUSE_ID): on_hand})
+            main._insert_movements(db, [dict(product_id=product.id, movement_type="IN", quantity=on_hand,
+                                             warehouse_id=main.DEFAULT_WAREHOUSE_ID)])
+        db.commit()
+        return product.id
+    return make
@@ -0,0 +1,91 @@
+import os
+import time
+from datetime import timedelta
+
+import evidence_gc
+import main
+
+_DAY = 24 * 3600
+
+
+def _age(path, seconds=2 * _DAY):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def _write(path, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    _age(path)
+    return path
+
+
+def _order_with_evidence(db, code, url):
+    order = main.Order(order_code=code, customer_name="Cliente", type="PURCHASE",
+                       status=main.OrderStatus.COMPLETED, evidence_photo_url=url)
+    db.add(order)
+    db.commit()
+    return order.id
+
+
+def _referenced_files(db):
+    """Every file some order's evidence_photo_url resolves to."""
+    files = set()
+    for (url,) in db.query(main.Order.evidence_photo_url).filter(main.Order.evidence_photo_url.isnot(None)):
+        if url.startswith("/evidence/"):
+            files.add(os.path.abspath(main._evidence_path(url.rsplit("/", 1)[-1])))
+        else:
+            files.update(p for p in main._legacy_evidence_paths(url) if os.path.exists(p))
+    return files
+
+
+def test_gc_never_deletes_a_file_an_order_points_to(client, auth, db, make_product):
+    # Content-addressed evidence, through the API
+    pid = make_product(on_hand=0)
+    order_id = client.post("/orders", json={"order_code": "GC-NEW", "customer_name": "Cliente", "type": "PURCHASE",
+                                            "items": [{"product_id": pid, "quantity": 1}]}).json()["id"]
+    r = client.post(f"/orders/{order_id}/complete", headers=auth,
+                    files={"file": ("foto.jpg", b"evidencia nueva", "image/jpeg")})
+    assert r.status_code == 200, r.text
+    _age(main._evidence_path(r.json()["evidence_url"].rsplit("/", 1)[-1]))
+    # Legacy evidence: the order kept the relative path it was written to
+    legacy = _write(os.path.join(main.EVIDENCE_DIR, "GC-OLD_foto.jpg"), b"evidencia vieja")
+    _order_with_evidence(db, "GC-OLD", "uploads/evidence/GC-OLD_foto.jpg")
+    # Nothing points to these
+    stray = _write(main._evidence_path("0" * 64), b"huerfano")
+    abandoned = _write(os.path.join(main.EVIDENCE_DIR, "tmp", "upload-abandonada"), b"a medias")
+
+    orphans = {os.path.abspath(p) for p in main._evidence_orphans(db, timedelta(hours=1))}
+    referenced = _referenced_files(db)
+    assert os.path.abspath(legacy) in referenced
+    assert not orphans & referenced
+    assert {os.path.abspath(stray), os.path.abspath(abandoned)} <= orphans
+
+    evidence_gc.sweep(1, dry_run=False)
+    assert all(os.path.exists(p) for p in referenced)
+    assert not os.path.exists(stray) and not os.path.exists(abandoned)
+
+
+def test_legacy_evidence_is_adopted_into_the_store(client, auth, db):
+    legacy = _write(os.path.join(main.EVIDENCE_DIR, "GC-ADOPT_recibo.png"), b"\x89PNG recibo")
+    order_id = _order_with_evidence(db, "GC-ADOPT", "uploads/evidence/GC-ADOPT_recibo.png")
+    missing_id = _order_with_evidence(db, "GC-GONE", "uploads/evidence/GC-GONE_perdida.jpg")
+
+    assert evidence_gc.adopt_legacy(dry_run=True) >= 1
+    db.expire_all()
+    assert db.get(main.Order, order_id).evidence_photo_url == "uploads/evidence/GC-ADOPT_recibo.png"
+
+    evidence_gc.adopt_legacy(dry_run=False)
+    db.expire_all()
+    url = db.get(main.Order, order_id).evidence_photo_url
+    assert url.startswith("/evidence/")
+    assert db.get(main.Order, missing_id).evidence_photo_url == "uploads/evidence/GC-GONE_perdida.jpg"
+    r = client.get(url, headers=auth)
+    assert r.status_code == 200 and r.content == b"\x89PNG recibo"
+    assert r.headers["content-type"] == "image/png"
+
+    # The old copy is no longer referenced; the adopted one is
+    evidence_gc.sweep(1, dry_run=False)
+    assert not os.path.exists(legacy)
+    assert os.path.exists(main._evidence_path(url.rsplit("/", 1)[-1]))
@@ -0,0 +1,64 @@
+import main
+
+
+def _order(client, code, items, type_="SALE"):
+    return client.post("/orders", json={"order_code": code, "customer_name": "Cliente", "type": type_,
+                                        "items": [{"product_id": pid, "quantity": qty} for pid, qty in items]})
+
+
+def _warehouse_row(db, pid):
+    return db.query(main.WarehouseStock.quantity, main.WarehouseStock.reserved)\
+             .filter(main.WarehouseStock.product_id == pid,
+                     main.WarehouseStock.warehouse_id == main.DEFAULT_WAREHOUSE_ID).one()
+
+
+def test_sale_reserves_stock(client, db, make_product):
+    pid = make_product(on_hand=5)
+    r = _order(client, "SALE-OK", [(pid, 2), (pid, 1)])
+    assert r.status_code == 200, r.text
+    assert tuple(_warehouse_row(db, pid)) == (5, 3)
+    lines = db.query(main.StockReservation).filter(main.StockReservation.order_id == r.json()["id"]).all()
+    assert [(l.product_id, l.quantity, l.status) for l in lines] == [(pid, 3, "ACTIVE")]
+
+
+def test_sale_beyond_available_stock_is_rejected(client, db, make_product):
+    pid = make_product(on_hand=3)
+    r = _order(client, "SALE-SHORT", [(pid, 4)])
+    assert r.status_code == 400
+    assert "Stock insuficiente" in r.json()["detail"]
+    # Nothing is left behind: no order, no reservation
+    assert db.query(main.Order).filter(main.Order.order_code == "SALE-SHORT").first() is None
+    assert tuple(_warehouse_row(db, pid)) == (3, 0)
+
+
+def test_sale_cannot_take_units_reserved_by_another_order(client, db, make_product):
+    pid = make_product(on_hand=3)
+    assert _order(client, "SALE-FIRST", [(pid, 3)]).status_code == 200
+    r = _order(client, "SALE-SECOND", [(pid, 1)])
+    assert r.status_code == 400
+    assert tuple(_warehouse_row(db, pid)) == (3, 3)
+
+
+def test_purchase_is_not_checked_against_stock(client, db, make_product):
+    pid = make_product(on_hand=0)
+    assert _order(client, "PO-1", [(pid, 50)], type_="PURCHASE").status_code == 200
+    assert tuple(_warehouse_row(db, pid)) == (0, 0)
+
+
+def test_sale_without_default_warehouse_is_409(client, db, make_product, monkeypatch):
+    pid = make_product(on_hand=5)
+    monkeypatch.setattr(main, "DEFAULT_WAREHOUSE_ID", 999)
+    r = _order(client, "SALE-NO-WH", [(pid, 1)])
+    assert r.status_code == 409
+    assert "almacén predeterminado" in r.json()["detail"]
+    assert db.query(main.Order).filter(main.Order.order_code == "SALE-NO-WH").first() is None
+    assert db.query(main.WarehouseStock).filter(main.WarehouseStock.warehouse_id == 999).count() == 0
+
+
+def test_complete_without_default_warehouse_is_409(client, auth, db, make_product, monkeypatch):
+    pid = make_product(on_hand=0)
+    order_id = _order(client, "PO-NO-WH", [(pid, 5)], type_="PURCHASE").json()["id"]
+    monkeypatch.setattr(main, "DEFAULT_WAREHOUSE_ID", 999)
+    r = client.post(f"/orders/{order_id}/complete", headers=auth, files={"file": ("ev.txt", b"evidencia", "text/plain")})
+    assert r.status_code == 409
+    assert db.get(main.Order, order_id).status == main.OrderStatus.PENDING.value